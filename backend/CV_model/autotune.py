@@ -0,0 +1,222 @@
+"""
+autotune.py
+Find the fastest inference configuration for best.pt on this machine.
+
+Sweeps batch size, input size, torch thread count and the export backends that are
+installed (PyTorch, TorchScript, ONNX Runtime, OpenVINO) over a sample of images. Each
+configuration runs in a fresh process, and its report covers preprocess/inference/
+postprocess ms per image, images/sec, that process's own peak RSS and detection
+agreement with the baseline (PyTorch, 640, batch 1). The thread sweep only applies to the
+torch backends; ONNX Runtime and OpenVINO run with their own default thread pools. The
+fastest config that keeps agreement above --min_agreement (including the device it was
+measured on) is written to inference_config.json, which detect_potholes, the sharded and
+dashcam runners and the model_tool inference service load automatically.
+
+Usage (from the repo root):
+    python backend/CV_model/autotune.py --images_dir backend/nj_images --sample 64 \\
+        --batch 1 4 8 --imgsz 416 512 640 --threads 2 4 8
+"""
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import torch
+from ultralytics import YOLO
+
+from cv import INFERENCE_CONFIG_PATH, IMAGE_EXTENSIONS, run_inference_batch
+from roi_eval import compare
+
+# Backend name -> (ultralytics export format, module that must be importable)
+BACKENDS = {
+    "pytorch": (None, None),
+    "torchscript": ("torchscript", None),
+    "onnx": ("onnx", "onnxruntime"),
+    "openvino": ("openvino", "openvino"),
+}
+# Backends whose thread count torch.set_num_threads controls; the others get no thread sweep
+TORCH_BACKENDS = ("pytorch", "torchscript")
+
+
+def available_backends(requested):
+    out = []
+    for name in requested:
+        fmt, module = BACKENDS[name]
+        if module and importlib.util.find_spec(module) is None:
+            print(f"Skipping backend {name}: {module} not installed")
+            continue
+        out.append(name)
+    return out
+
+
+def peak_rss_mb():
+    """Peak RSS of this process so far (VmHWM, else ru_maxrss)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+_exported = {}
+
+def weights_for(backend, model_path, imgsz):
+    """Weights path for a backend, exporting once per backend/imgsz if needed."""
+    fmt, _ = BACKENDS[backend]
+    if fmt is None:
+        return model_path
+    key = (backend, imgsz)
+    if key not in _exported:
+        print(f"Exporting {backend} @ {imgsz} ...")
+        _exported[key] = YOLO(model_path).export(format=fmt, imgsz=imgsz, dynamic=(fmt != "torchscript"))
+    return _exported[key]
+
+
+def run_config(model, paths, conf, device, imgsz, batch):
+    """Time one configuration. Returns (boxes_by_path, stats)."""
+    # Warm-up batch (graph build, allocator growth) is not timed
+    run_inference_batch(model, paths[:batch], conf, device, imgsz=imgsz)
+
+    boxes = {}
+    speed = {"preprocess": 0.0, "inference": 0.0, "postprocess": 0.0}
+    t0 = time.perf_counter()
+    for i in range(0, len(paths), batch):
+        chunk = paths[i:i + batch]
+        for p, (r, potholes, _) in zip(chunk, run_inference_batch(model, chunk, conf, device, imgsz=imgsz)):
+            boxes[p] = [box for _, box in potholes]
+            for k in speed:
+                speed[k] += (r.speed or {}).get(k, 0.0)
+    elapsed = time.perf_counter() - t0
+    n = len(paths)
+    return boxes, {
+        "preprocess_ms": round(speed["preprocess"] / n, 2),
+        "inference_ms": round(speed["inference"] / n, 2),
+        "postprocess_ms": round(speed["postprocess"] / n, 2),
+        "images_per_sec": round(n / elapsed, 2) if elapsed else None,
+    }
+
+
+def _measure_in_child(backend, weights, paths, conf, device, imgsz, threads, batch):
+    if threads:
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+    model = YOLO(weights) if BACKENDS[backend][0] is None else YOLO(weights, task="detect")
+    boxes, stats = run_config(model, paths, conf, device, imgsz, batch)
+    stats["peak_rss_mb"] = peak_rss_mb()
+    return boxes, stats
+
+
+def measure(backend, weights, paths, conf, device, imgsz, threads, batch):
+    """run_config in a fresh process, so its peak RSS (and thread settings) are its own. Returns (boxes, stats)."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(_measure_in_child, backend, weights, paths, conf, device, imgsz, threads, batch).result()
+
+
+def agreement(baseline, candidate):
+    """F1 of IoU-matched boxes against the baseline (1.0 when neither finds anything)."""
+    matched, base_total = compare(baseline, candidate)
+    cand_total = sum(len(v) for v in candidate.values())
+    if base_total + cand_total == 0:
+        return 1.0
+    return round(2 * matched / (base_total + cand_total), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep inference settings for best.pt and save the fastest.")
+    parser.add_argument("--images_dir", default="backend/nj_images")
+    parser.add_argument("--model_path", default="backend/CV_model/best.pt")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--sample", type=int, default=64, help="Number of images to profile on")
+    parser.add_argument("--batch", type=int, nargs="*", default=[1, 4, 8])
+    parser.add_argument("--imgsz", type=int, nargs="*", default=[416, 512, 640])
+    parser.add_argument("--threads", type=int, nargs="*", default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument("--backends", nargs="*", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument("--min_agreement", type=float, default=0.95)
+    parser.add_argument("--report", default=None, help="Optional JSON file for the full sweep table")
+    parser.add_argument("--out", default=INFERENCE_CONFIG_PATH, help="Where to write the winning config")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = []
+    for root, _, files in os.walk(args.images_dir):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    if not paths:
+        raise SystemExit(f"No images found in {args.images_dir}")
+    random.Random(args.seed).shuffle(paths)
+    paths = sorted(paths[:args.sample])
+
+    baseline, base_stats = measure("pytorch", args.model_path, paths, args.conf, args.device, 640, None, 1)
+    print(f"baseline pytorch imgsz=640 batch=1: {base_stats}")
+
+    rows = []
+    for backend in available_backends(args.backends):
+        thread_counts = args.threads
+        if backend not in TORCH_BACKENDS:
+            print(f"{backend}: thread count is not configurable through ultralytics; using its default")
+            thread_counts = [None]
+        for imgsz in args.imgsz:
+            try:
+                weights = weights_for(backend, args.model_path, imgsz)
+            except Exception as e:
+                print(f"Skipping {backend} @ {imgsz}: {e}")
+                continue
+            for threads in thread_counts:
+                for batch in args.batch:
+                    try:
+                        boxes, stats = measure(backend, weights, paths, args.conf, args.device, imgsz, threads, batch)
+                    except Exception as e:
+                        print(f"Failed {backend} imgsz={imgsz} threads={threads} batch={batch}: {e}")
+                        continue
+                    row = {
+                        "backend": backend,
+                        "model_path": os.path.abspath(weights),
+                        "imgsz": imgsz,
+                        "threads": threads,
+                        "batch": batch,
+                        **stats,
+                        "agreement": agreement(baseline, boxes),
+                    }
+                    rows.append(row)
+                    print(f"{backend:12} imgsz={imgsz:<4} threads={str(threads or '-'):<3} batch={batch:<3} "
+                          f"pre={row['preprocess_ms']:>7}ms inf={row['inference_ms']:>7}ms "
+                          f"post={row['postprocess_ms']:>6}ms {row['images_per_sec']:>7} img/s "
+                          f"peak_rss={row['peak_rss_mb']}MB agree={row['agreement']}")
+
+    eligible = [r for r in rows if r["agreement"] >= args.min_agreement and r["images_per_sec"]]
+    if not eligible:
+        raise SystemExit("No configuration met --min_agreement; nothing written.")
+    best = max(eligible, key=lambda r: r["images_per_sec"])
+
+    config = {k: best[k] for k in ("backend", "model_path", "imgsz", "threads", "batch")}
+    config.update({
+        "device": args.device,
+        "images_per_sec": best["images_per_sec"],
+        "baseline_images_per_sec": base_stats["images_per_sec"],
+        "agreement": best["agreement"],
+        "sample": len(paths),
+    })
+    with open(args.out, "w") as f:
+        json.dump(config, f, indent=2)
+    print(f"✅ Best: {json.dumps(config)}")
+    print(f"   Written to {args.out}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"baseline": base_stats, "configs": rows, "best": config}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+cascade_eval.py
+Measure the road-filter cascade (cv.RoadFilter) against running YOLO on every frame.
+
+Runs best.pt over every image as the baseline, then for each --thresholds value runs the
+cascade end to end (road_score on every frame, YOLO only on the kept ones). Reports
+images/sec, frames skipped, and the baseline detections lost because their frame was
+skipped. Use it to pick POTHOLE_ROAD_THRESHOLD.
+
+Usage (from the repo root):
+    python backend/CV_model/cascade_eval.py --images_dir backend/nj_images --thresholds 0.1 0.2 0.3
+"""
+
+import argparse
+import json
+import time
+
+from ultralytics import YOLO
+
+from cv import RoadFilter, road_score, run_inference
+from roi_eval import list_images, run_mode
+
+
+def run_cascade(model, paths, conf_thresh, device, threshold):
+    """Returns (kept_paths, images_per_sec) for the cascade at one threshold."""
+    road_filter = RoadFilter(threshold)
+    kept = []
+    t0 = time.perf_counter()
+    for p in paths:
+        if road_filter.keep(p):
+            run_inference(model, p, conf_thresh, device)
+            kept.append(p)
+    elapsed = time.perf_counter() - t0
+    return kept, len(paths) / elapsed if elapsed > 0 else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput/missed detections of the road-filter cascade.")
+    parser.add_argument("--images_dir", default="backend/nj_images")
+    parser.add_argument("--model_path", default="backend/CV_model/best.pt")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--thresholds", type=float, nargs="*", default=[0.05, 0.1, 0.2, 0.3])
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N images")
+    parser.add_argument("--out", default=None, help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    paths = list_images(args.images_dir, args.limit)
+    if not paths:
+        raise SystemExit(f"No images found in {args.images_dir}")
+    model = YOLO(args.model_path)
+
+    base_boxes, base_ips = run_mode(model, paths, args.conf, args.device)
+    base_total = sum(len(v) for v in base_boxes.values())
+
+    t0 = time.perf_counter()
+    scores = {p: road_score(p) for p in paths}
+    score_ms = (time.perf_counter() - t0) * 1000 / len(paths)
+
+    rows = []
+    for threshold in args.thresholds:
+        kept, ips = run_cascade(model, paths, args.conf, args.device, threshold)
+        kept = set(kept)
+        skipped = [p for p in paths if p not in kept]
+        missed = sum(len(base_boxes[p]) for p in skipped)
+        rows.append({
+            "threshold": threshold,
+            "skipped_frames": len(skipped),
+            "skip_rate": round(len(skipped) / len(paths), 3),
+            "images_per_sec": round(ips, 2),
+            "speedup": round(ips / base_ips, 2) if base_ips else None,
+            "missed_detections": missed,
+            "missed_frames_with_potholes": sum(1 for p in skipped if base_boxes[p]),
+            "recall_vs_baseline": round(1 - missed / base_total, 3) if base_total else None,
+        })
+        print(json.dumps(rows[-1]))
+
+    result = {
+        "images": len(paths),
+        "baseline_images_per_sec": round(base_ips, 2),
+        "baseline_detections": base_total,
+        "road_score_ms_per_image": round(score_ms, 2),
+        "frames_with_potholes_min_score": round(min((scores[p] for p in paths if base_boxes[p]), default=0.0), 3),
+        "cascade": rows,
+    }
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
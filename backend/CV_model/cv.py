@@ -1,96 +1,842 @@
 import os
 import re
+import json
+import math
+import time
+import uuid
+import shutil
+import threading
 import cv2
 import pandas as pd
+from collections import defaultdict
+from datetime import datetime, timezone
 from pathlib import Path
 from ultralytics import YOLO
 
+# backend/metrics.py is importable when running inside the server/benchmark
+try:
+    import metrics  # type: ignore
+except ImportError:
+    metrics = None
+
+# Optional pyarrow support for streaming Parquet outputs
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.compute as pc  # type: ignore
+    import pyarrow.dataset as pds  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+    _PYARROW_AVAILABLE = True
+except Exception:
+    _PYARROW_AVAILABLE = False
+
+DEFAULT_MODEL_PATH = "backend/CV_model/best.pt"
+# Written by autotune.py; picked up automatically when present
+INFERENCE_CONFIG_PATH = os.getenv(
+    "POTHOLE_INFERENCE_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "inference_config.json")
+)
+IMAGE_NAME_PATTERN = re.compile(r"lat_([-\d\.]+)_lon_([-\d\.]+)_hdg_(\d+)")
+# Road-aligned downloads (street_view heading_mode="road") are tilted down and tagged _pitch_<p>
+PITCH_PATTERN = re.compile(r"_pitch_(-?\d+)")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+# Height of the latitude stripes ParquetResultWriter.clusters() sweeps; one stripe (and
+# the one before it) of detections is in memory at a time
+CLUSTER_STRIPE_M = 1000.0
+
+# Street View capture geometry used to project a box onto the ground plane
+CAMERA_HEIGHT_M = 2.5
+DEFAULT_FOV = 90
+MAX_GROUND_DISTANCE_M = 30.0
+EARTH_RADIUS_M = 6371000.0
+
+
+def project_detection(lat, lon, hdg, box, img_w, img_h, fov=DEFAULT_FOV, camera_height=CAMERA_HEIGHT_M, pitch=0):
+    """
+    Estimate the ground position of a detection box from a Street View frame.
+
+    The horizontal box center gives the bearing offset from the camera heading;
+    the bottom edge plus the camera pitch (negative = tilted down) gives the depression
+    angle, and with a flat road and known camera height, the distance.
+    Returns (est_lat, est_lon, distance_m).
+    """
+    x1, y1, x2, y2 = box
+    focal = (img_w / 2) / math.tan(math.radians(fov) / 2)
+    bearing = (hdg + math.degrees(math.atan(((x1 + x2) / 2 - img_w / 2) / focal))) % 360
+    depression = math.atan((y2 - img_h / 2) / focal) - math.radians(pitch)
+    if depression <= 0:
+        dist = MAX_GROUND_DISTANCE_M
+    else:
+        dist = min(camera_height / math.tan(depression), MAX_GROUND_DISTANCE_M)
+
+    b = math.radians(bearing)
+    dlat = dist * math.cos(b) / EARTH_RADIUS_M
+    dlon = dist * math.sin(b) / (EARTH_RADIUS_M * math.cos(math.radians(lat)))
+    return lat + math.degrees(dlat), lon + math.degrees(dlon), dist
+
+
+PER_IMAGE_COLUMNS = ["filename", "lat", "lon", "hdg", "pothole_count", "processed_at"]
+DETECTION_COLUMNS = ["filename", "lat", "lon", "hdg", "conf", "x1", "y1", "x2", "y2",
+                     "est_lat", "est_lon", "est_distance_m", "processed_at"]
+CLUSTER_COLUMNS = ["cluster_id", "lat", "lon", "n_detections", "n_images", "n_panos",
+                   "headings", "max_conf", "mean_conf"]
+
+
+def region_key(lat, lon, tile_deg: float = 0.1) -> str:
+    """Coarse lat/lon tile label used to partition Parquet outputs by region."""
+    return f"{math.floor(lat / tile_deg) * tile_deg:.3f}_{math.floor(lon / tile_deg) * tile_deg:.3f}"
+
+
+class ParquetResultWriter:
+    """
+    Streams per-image and per-detection rows into two Parquet datasets.
+
+    Each run writes under its own root/run=<run_id> directory (run_id defaults to the
+    survey id, else a fresh timestamped id), and anything left there by an earlier run
+    with the same id is removed at open, so per_coordinate()/read_detections() only see
+    this run. Rows are buffered and every `flush_every` images written out as a new
+    part-NNNNN.parquet file per partition, so memory stays flat no matter how large
+    the folder is.
+    """
+
+    def __init__(self, root, flush_every: int = 500, partition_by=None, survey_id=None, run_id=None):
+        if not _PYARROW_AVAILABLE:
+            raise RuntimeError("pyarrow is required for Parquet outputs (pip install pyarrow)")
+        if partition_by not in (None, "survey", "region"):
+            raise ValueError("partition_by must be None, 'survey' or 'region'")
+        self.run_id = run_id or survey_id or f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+        self.root = Path(root) / f"run={self.run_id}"
+        if self.root.exists():
+            shutil.rmtree(self.root)
+        self.images_path = self.root / "per_image"
+        self.detections_path = self.root / "detections"
+        self.flush_every = flush_every
+        self.partition_by = partition_by
+        self.survey_id = survey_id or "default"
+        self._images = []
+        self._detections = []
+        self._part = 0
+        self._schemas = {
+            "per_image": pa.schema([
+                ("filename", pa.string()), ("lat", pa.float64()), ("lon", pa.float64()),
+                ("hdg", pa.int32()), ("pothole_count", pa.int32()), ("processed_at", pa.string()),
+            ]),
+            "detections": pa.schema([
+                ("filename", pa.string()), ("lat", pa.float64()), ("lon", pa.float64()),
+                ("hdg", pa.int32()), ("conf", pa.float64()),
+                ("x1", pa.float64()), ("y1", pa.float64()), ("x2", pa.float64()), ("y2", pa.float64()),
+                ("est_lat", pa.float64()), ("est_lon", pa.float64()), ("est_distance_m", pa.float64()),
+                ("processed_at", pa.string()),
+            ]),
+        }
+
+    def _partition(self, row):
+        if self.partition_by == "survey":
+            return f"survey={self.survey_id}"
+        if self.partition_by == "region":
+            return f"region={region_key(row['lat'], row['lon'])}"
+        return ""
+
+    def _write(self, base: Path, rows, schema):
+        by_part = defaultdict(list)
+        for row in rows:
+            by_part[self._partition(row)].append(row)
+        for part, part_rows in by_part.items():
+            out_dir = base / part if part else base
+            out_dir.mkdir(parents=True, exist_ok=True)
+            table = pa.Table.from_pylist(part_rows, schema=schema)
+            pq.write_table(table, out_dir / f"part-{self._part:05d}.parquet")
+
+    def add(self, record: dict, detections):
+        self._images.append(record)
+        self._detections.extend(detections)
+        if len(self._images) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._images:
+            self._write(self.images_path, self._images, self._schemas["per_image"])
+        if self._detections:
+            self._write(self.detections_path, self._detections, self._schemas["detections"])
+        if self._images or self._detections:
+            self._part += 1
+        self._images = []
+        self._detections = []
+
+    def close(self):
+        self.flush()
+
+    def per_coordinate(self):
+        """Per-coordinate sum/max of pothole counts, computed from the per-image dataset."""
+        if not self.images_path.exists():
+            return pd.DataFrame(columns=["lat", "lon", "pothole_count_sum", "pothole_count_max"])
+        table = pq.read_table(self.images_path, columns=["lat", "lon", "pothole_count"])
+        agg = table.group_by(["lat", "lon"]).aggregate([
+            ("pothole_count", "sum"),
+            ("pothole_count", "max"),
+        ])
+        df = agg.to_pandas()[["lat", "lon", "pothole_count_sum", "pothole_count_max"]]
+        return df[df["pothole_count_sum"] != 0].reset_index(drop=True)
+
+    def read_detections(self, batch_size: int = 65536):
+        """Yield this run's detection rows (the columns clustering needs), one record batch at a time."""
+        if not self.detections_path.exists():
+            return
+        dataset = pds.dataset(self.detections_path, format="parquet", partitioning="hive")
+        for batch in dataset.to_batches(columns=["filename", "lat", "lon", "hdg", "conf", "est_lat", "est_lon"],
+                                        batch_size=batch_size):
+            yield from batch.to_pylist()
+
+    def clusters(self, radius_m: float = 5.0, stripe_m: float = CLUSTER_STRIPE_M):
+        """
+        cluster_detections over this run's detections without loading them all: the rows are
+        first spooled into one partition per est_lat stripe, then swept stripe by stripe
+        (see sweep_clusters). Memory follows the densest pair of stripes, not the run size.
+        """
+        if not self.detections_path.exists():
+            return []
+        columns = ["filename", "lat", "lon", "hdg", "conf", "est_lat", "est_lon"]
+        dataset = pds.dataset(self.detections_path, format="parquet", partitioning="hive")
+        stripe_deg = max(stripe_m, radius_m) / (math.pi * EARTH_RADIUS_M / 180)
+        spool = self.root / "cluster_spool"
+        schema = pa.schema([dataset.schema.field(c) for c in columns] + [pa.field("stripe", pa.int64())])
+        totals = {"lat": 0.0, "n": 0}
+
+        def with_stripe():
+            for batch in dataset.to_batches(columns=columns):
+                est_lat = batch.column("est_lat")
+                totals["lat"] += pc.sum(est_lat).as_py() or 0.0
+                totals["n"] += batch.num_rows
+                stripe = pc.cast(pc.floor(pc.divide(est_lat, stripe_deg)), pa.int64())
+                yield pa.RecordBatch.from_arrays(batch.columns + [stripe], schema=schema)
+
+        pds.write_dataset(with_stripe(), spool, schema=schema, format="parquet", partitioning=["stripe"],
+                          partitioning_flavor="hive", max_partitions=1 << 16,
+                          existing_data_behavior="delete_matching")
+        try:
+            if not totals["n"]:
+                return []
+            stripe_dirs = sorted(spool.glob("stripe=*"), key=lambda p: int(p.name.split("=", 1)[1]))
+            stripes = (pq.read_table(d, columns=columns).to_pylist() for d in stripe_dirs)
+            return sweep_clusters(stripes, radius_m, totals["lat"] / totals["n"])
+        finally:
+            shutil.rmtree(spool, ignore_errors=True)
+
+
+def cluster_detections(detections, radius_m: float = 5.0):
+    """
+    Merge detections seen from neighboring panos/headings into physical pothole clusters.
+
+    Points are hashed into a grid of radius-sized cells, and each point is only
+    compared against the 3x3 neighborhood of its cell, so the pass is O(n) for
+    realistic densities. Connected points are merged with union-find.
+
+    All detections are held in memory; for a Parquet run use
+    ParquetResultWriter.clusters(), which sweeps them one latitude stripe at a time.
+
+    Args:
+        detections (iterable[dict]): Rows with at least est_lat, est_lon, filename, lat, lon, hdg, conf.
+        radius_m (float): Max distance between two detections of the same pothole.
+
+    Returns:
+        list[dict]: One row per cluster.
+    """
+    detections = detections if isinstance(detections, list) else list(detections)
+    if not detections:
+        return []
+    lat0 = sum(d["est_lat"] for d in detections) / len(detections)
+    return sweep_clusters([detections], radius_m, lat0)
+
+
+def sweep_clusters(stripes, radius_m: float, lat0: float):
+    """
+    cluster_detections over detections arriving as latitude stripes (lists of rows), in
+    increasing latitude order. Each stripe must be at least radius_m tall, so a point can
+    only join points of its own or the previous stripe: only those two stripes and the
+    clusters still touching them are held, and every other cluster is emitted as soon as
+    its stripe has passed. lat0 (degrees) sets the longitude scale.
+    """
+    m_per_deg_lat = math.pi * EARTH_RADIUS_M / 180
+    m_per_deg_lon = m_per_deg_lat * math.cos(math.radians(lat0))
+    r2 = radius_m * radius_m
+    parent = {}      # cluster id -> parent id, for clusters touching the current stripes
+    aggs = {}        # root cluster id -> running totals
+    prev = []        # (x, y, cluster id) of the previous stripe's points
+    next_id = 0
+    done = []
+
+    def find(c):
+        while parent[c] != c:
+            parent[c] = parent[parent[c]]
+            c = parent[c]
+        return c
+
+    def union(a, b):
+        ra, rb = find(a), find(b)
+        if ra == rb:
+            return
+        if aggs[ra]["n"] < aggs[rb]["n"]:
+            ra, rb = rb, ra
+        parent[rb] = ra
+        big, small = aggs[ra], aggs.pop(rb)
+        for k in ("n", "sum_lat", "sum_lon", "sum_conf"):
+            big[k] += small[k]
+        big["max_conf"] = max(big["max_conf"], small["max_conf"])
+        for k in ("files", "panos", "hdgs"):
+            big[k] |= small[k]
+
+    for rows in stripes:
+        cur = []
+        for d in rows:
+            parent[next_id] = next_id
+            aggs[next_id] = {
+                "n": 1, "sum_lat": d["est_lat"], "sum_lon": d["est_lon"],
+                "sum_conf": d["conf"], "max_conf": d["conf"],
+                "files": {d["filename"]}, "panos": {(d["lat"], d["lon"])}, "hdgs": {d["hdg"]},
+            }
+            cur.append((d["est_lon"] * m_per_deg_lon, d["est_lat"] * m_per_deg_lat, next_id))
+            next_id += 1
+
+        points = prev + cur
+        first_new = len(prev)
+        grid = defaultdict(list)
+        for i, (x, y, _) in enumerate(points):
+            grid[(int(x // radius_m), int(y // radius_m))].append(i)
+        for (cx, cy), members in grid.items():
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbors = grid.get((cx + dx, cy + dy))
+                    if not neighbors:
+                        continue
+                    for i in members:
+                        xi, yi, ci = points[i]
+                        for j in neighbors:
+                            # Pairs within the previous stripe were linked when it was current
+                            if j <= i or j < first_new:
+                                continue
+                            xj, yj, cj = points[j]
+                            if (xi - xj) ** 2 + (yi - yj) ** 2 <= r2:
+                                union(ci, cj)
+
+        # Clusters with no point in this stripe can't grow any more
+        live = {find(c) for _, _, c in cur}
+        for root in [r for r in aggs if r not in live]:
+            done.append(aggs.pop(root))
+        prev = [(x, y, find(c)) for x, y, c in cur]
+        parent = {r: r for r in live}
+    done.extend(aggs.values())
+
+    clusters = []
+    for cluster_id, agg in enumerate(done):
+        clusters.append({
+            "cluster_id": cluster_id,
+            "lat": agg["sum_lat"] / agg["n"],
+            "lon": agg["sum_lon"] / agg["n"],
+            "n_detections": agg["n"],
+            "n_images": len(agg["files"]),
+            "n_panos": len(agg["panos"]),
+            "headings": " ".join(str(h) for h in sorted(agg["hdgs"])),
+            "max_conf": agg["max_conf"],
+            "mean_conf": agg["sum_conf"] / agg["n"],
+        })
+    return clusters
+
+# cv2 flags that let libjpeg decode directly at 1/2, 1/4 or 1/8 scale
+_REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+_clamp_warned = set()
+
+def _clamp_reduce_factor(reduce_factor: int, full_long_side: int, min_long_side) -> int:
+    """Largest factor <= reduce_factor that keeps the decoded long side >= min_long_side."""
+    requested = reduce_factor
+    while min_long_side and reduce_factor > 1 and full_long_side / reduce_factor < min_long_side:
+        reduce_factor //= 2
+    if reduce_factor != requested and (requested, full_long_side, min_long_side) not in _clamp_warned:
+        _clamp_warned.add((requested, full_long_side, min_long_side))
+        print(f"⚠️ reduce_factor {requested} lowered to {reduce_factor}: {full_long_side}px images "
+              f"would decode below imgsz {min_long_side}")
+    return reduce_factor
+
+
+def decode_for_inference(img_path, reduce_factor: int = 1, min_long_side: int = None):
+    """
+    Decode an image (or take a decoded BGR frame) at 1/reduce_factor scale.
+
+    With min_long_side (the model's imgsz) the factor is lowered so the decoded long side
+    stays at or above it; YOLO would only upscale a smaller image back to imgsz. For files
+    the full size is only known after decoding, so a clamped file is decoded twice, the
+    first time at the requested (cheap) reduced scale.
+
+    Returns:
+        (image, factor) with the factor actually used.
+    """
+    if reduce_factor not in _REDUCED_DECODE_FLAGS:
+        raise ValueError("reduce_factor must be 1, 2, 4 or 8")
+    if hasattr(img_path, "shape"):
+        img = img_path
+        reduce_factor = _clamp_reduce_factor(reduce_factor, max(img.shape[:2]), min_long_side)
+        if reduce_factor != 1:
+            img = cv2.resize(img, (img.shape[1] // reduce_factor, img.shape[0] // reduce_factor),
+                             interpolation=cv2.INTER_AREA)
+    else:
+        img = cv2.imread(str(img_path), _REDUCED_DECODE_FLAGS[reduce_factor])
+        if img is not None and reduce_factor != 1:
+            clamped = _clamp_reduce_factor(reduce_factor, max(img.shape[:2]) * reduce_factor, min_long_side)
+            if clamped != reduce_factor:
+                reduce_factor = clamped
+                img = cv2.imread(str(img_path), _REDUCED_DECODE_FLAGS[reduce_factor])
+    if img is None:
+        raise ValueError(f"Could not decode {img_path}")
+    return img, reduce_factor
+
+
+def load_for_inference(img_path, roi=None, reduce_factor: int = 1, min_long_side: int = None):
+    """
+    Decode an image for inference, optionally at reduced scale and cropped to a road band.
+
+    Args:
+        img_path (str|ndarray): Image file, or an already-decoded BGR frame.
+        roi (tuple|None): (top, bottom) fractions of the frame height to keep, e.g. (0.5, 1.0)
+                          for the lower half of a pitch-0 Street View frame.
+        reduce_factor (int): 1, 2, 4 or 8. JPEGs are DCT-scaled while decoding;
+                             decoded frames are downscaled with cv2.resize.
+        min_long_side (int|None): Lower reduce_factor as needed to keep the decoded long
+                                  side at or above this (see decode_for_inference).
+
+    Returns:
+        (image, scale, y_offset, (full_w, full_h)) where a crop-space point (x, y)
+        maps to (x * scale, y * scale + y_offset) in the full frame.
+    """
+    img, reduce_factor = decode_for_inference(img_path, reduce_factor, min_long_side)
+    h, w = img.shape[:2]
+    y0 = 0
+    if roi:
+        top, bottom = roi
+        y0, y1 = int(h * top), int(math.ceil(h * bottom))
+        img = img[y0:y1]
+    return img, reduce_factor, y0 * reduce_factor, (w * reduce_factor, h * reduce_factor)
+
+
+# Road cascade: a cheap pavement check run before YOLO so frames facing fields, lawns or
+# house fronts are not sent to the detector. Disabled unless a threshold is given.
+ROAD_BAND = (0.55, 1.0)
+ROAD_THUMB_SIZE = (64, 24)
+DEFAULT_ROAD_THRESHOLD = float(os.getenv("POTHOLE_ROAD_THRESHOLD")) if os.getenv("POTHOLE_ROAD_THRESHOLD") else None
+
+
+def road_score(img_path) -> float:
+    """
+    Fraction (0-1) of the bottom band of the frame that looks like pavement: low saturation,
+    mid brightness and little fine texture. Decodes at 1/8 scale, so it costs a few ms.
+    Undecodable images score 1.0 and are left for the detector to report.
+    """
+    if hasattr(img_path, "shape"):
+        img = img_path
+    else:
+        img = cv2.imread(str(img_path), cv2.IMREAD_REDUCED_COLOR_8)
+    if img is None:
+        return 1.0
+    h = img.shape[0]
+    band = img[int(h * ROAD_BAND[0]):int(math.ceil(h * ROAD_BAND[1]))]
+    band = cv2.resize(band, ROAD_THUMB_SIZE, interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(band, cv2.COLOR_BGR2HSV)
+    gray = cv2.cvtColor(band, cv2.COLOR_BGR2GRAY)
+    texture = cv2.absdiff(gray, cv2.GaussianBlur(gray, (5, 5), 0))
+    sat, val = hsv[..., 1], hsv[..., 2]
+    mask = (sat < 50) & (val > 40) & (val < 215) & (texture < 14)
+    return float(mask.mean())
+
+
+class RoadFilter:
+    """
+    Cascade stage in front of the detector. keep() is False for frames with no visible road.
+    Safe to share between threads (the inference service calls it from every request thread).
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.checked = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def keep(self, img_path) -> bool:
+        passed = road_score(img_path) >= self.threshold
+        with self._lock:
+            self.checked += 1
+            if not passed:
+                self.skipped += 1
+        if passed:
+            return True
+        if metrics is not None:
+            metrics.inc("pothole_road_filter_skipped_total")
+        return False
+
+    def summary(self) -> str:
+        return f"Road filter (threshold {self.threshold}): skipped {self.skipped}/{self.checked} frames"
+
+
+def load_inference_config(path=None) -> dict:
+    """Load the tuned inference settings written by autotune.py ({} if there are none)."""
+    path = path or INFERENCE_CONFIG_PATH
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def iter_images(images_dir):
+    """Yield (fname, img_path, lat, lon, hdg) for every image whose name matches the survey pattern."""
+    for root, _, files in os.walk(images_dir):
+        for fname in sorted(files):
+            if not fname.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            m = IMAGE_NAME_PATTERN.search(fname)
+            if not m:
+                # Skip files that don't match naming pattern
+                continue
+            yield fname, os.path.join(root, fname), float(m.group(1)), float(m.group(2)), int(m.group(3))
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_inference_batch(model, img_paths, conf_thresh: float = 0.25, device=0, roi=None,
+                        reduce_factor: int = 1, imgsz: int = 640):
+    """
+    Run the detector on a batch of images (paths or BGR frames) and return pothole boxes
+    in full-frame coordinates.
+
+    Returns:
+        One (result, potholes, (img_w, img_h)) tuple per path, where potholes is a list
+        of (conf, [x1, y1, x2, y2]).
+    """
+    preprocess = bool(roi) or reduce_factor != 1
+    if preprocess:
+        loaded = [load_for_inference(p, roi, reduce_factor, imgsz) for p in img_paths]
+        sources = [img for img, _, _, _ in loaded]
+    else:
+        loaded = [(None, 1, 0, None) for _ in img_paths]
+        sources = [p if hasattr(p, "shape") else str(p) for p in img_paths]
+
+    results = model.predict(
+        sources,
+        conf=conf_thresh,
+        device=device,
+        imgsz=imgsz,
+        batch=len(sources),
+        verbose=False
+    )
+
+    outputs = []
+    for r, (_, scale, y_off, full_size) in zip(results, loaded):
+        boxes = r.boxes
+        if full_size is None:
+            full_size = (r.orig_shape[1], r.orig_shape[0])
+
+        # Map class IDs -> names
+        names = getattr(r, "names", None) or getattr(model.model, "names", {}) or {}
+        potholes = []
+        if boxes is not None and boxes.shape[0] > 0:
+            for cls_id, conf, box in zip(boxes.cls.tolist(), boxes.conf.tolist(), boxes.xyxy.tolist()):
+                name = names.get(int(cls_id), str(int(cls_id))).lower()
+                if name == "pothole" and conf >= conf_thresh:
+                    x1, y1, x2, y2 = box
+                    potholes.append((conf, [x1 * scale, y1 * scale + y_off, x2 * scale, y2 * scale + y_off]))
+        outputs.append((r, potholes, full_size))
+    return outputs
+
+
+def run_inference(model, img_path, conf_thresh: float = 0.25, device=0, roi=None,
+                  reduce_factor: int = 1, imgsz: int = 640):
+    """Single-image run_inference_batch: returns (result, potholes, (img_w, img_h))."""
+    return run_inference_batch(model, [img_path], conf_thresh, device, roi, reduce_factor, imgsz)[0]
+
+
+def annotate_full_frame(image, potholes):
+    """
+    Draw full-frame pothole boxes on the original image (used when inference ran on a crop).
+    image is a path or an already decoded BGR frame, which is drawn on a copy.
+    """
+    img = image.copy() if hasattr(image, "shape") else cv2.imread(str(image))
+    for conf, (x1, y1, x2, y2) in potholes:
+        x1, y1, x2, y2 = map(int, (x1, y1, x2, y2))
+        cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(img, f"Pothole {conf:.2f}", (x1, y1 - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+    return img
+
+
+def _detect_decoded(model, paths, conf_thresh, device, roi, reduce_factor, imgsz):
+    """
+    run_inference_batch for images that need preprocessing (roi or reduce_factor), keeping
+    each decoded frame so annotation can reuse it when it was decoded at full size.
+
+    Returns:
+        One (output, frame, factor) per path: output as from run_inference_batch
+        (full-frame coordinates), frame the decoded image and factor the reduce factor
+        it was actually decoded at (1 means frame is the full-size image).
+    """
+    frames = [decode_for_inference(p, reduce_factor, imgsz) for p in paths]
+    outputs = run_inference_batch(model, [img for img, _ in frames], conf_thresh, device, roi, 1, imgsz)
+    detected = []
+    for (r, frame_potholes, (w, h)), (img, factor) in zip(outputs, frames):
+        potholes = [(conf, [v * factor for v in box]) for conf, box in frame_potholes]
+        detected.append(((r, potholes, (w * factor, h * factor)), img, factor))
+    return detected
+
+
+def process_chunk(model, chunk, conf_thresh, device, annotated_dir, roi=None, reduce_factor: int = 1,
+                  imgsz: int = 640, road_filter=None):
+    """
+    Detect, project and annotate one batch of iter_images() tuples.
+    Images rejected by road_filter (a RoadFilter) are recorded with 0 potholes without running YOLO.
+
+    Returns:
+        One (record, image_dets, annotated) tuple per image, where record is a
+        PER_IMAGE_COLUMNS row, image_dets its DETECTION_COLUMNS rows and annotated
+        whether an annotated image was written to annotated_dir.
+    """
+    processed_at = datetime.now(timezone.utc).isoformat()
+    keep = [road_filter.keep(img_path) if road_filter else True for _, img_path, _, _, _ in chunk]
+    to_detect = [item for item, k in zip(chunk, keep) if k]
+    paths = [img_path for _, img_path, _, _, _ in to_detect]
+    preprocess = bool(roi) or reduce_factor != 1
+
+    def detect(batch_paths):
+        if preprocess:
+            return _detect_decoded(model, batch_paths, conf_thresh, device, roi, reduce_factor, imgsz)
+        return [(o, None, None) for o in run_inference_batch(model, batch_paths, conf_thresh, device, imgsz=imgsz)]
+
+    t0 = time.perf_counter()
+    try:
+        outputs = detect(paths) if paths else []
+    except Exception as e:
+        if len(to_detect) == 1:
+            print(f"Error processing {to_detect[0][0]}: {e}")
+            outputs = [None]
+        else:
+            # Fall back to one image at a time so one bad file doesn't sink the batch
+            outputs = []
+            for fname, img_path, _, _, _ in to_detect:
+                try:
+                    outputs.append(detect([img_path])[0])
+                except Exception as e:
+                    print(f"Error processing {fname}: {e}")
+                    outputs.append(None)
+    if metrics is not None and to_detect:
+        per_image = (time.perf_counter() - t0) / len(to_detect)
+        for _ in to_detect:
+            metrics.observe("detect_image", per_image)
+
+    detected = iter(outputs)
+    results = []
+    for (fname, img_path, lat, lon, hdg), k in zip(chunk, keep):
+        output = next(detected) if k else None
+        pothole_count = 0
+        image_dets = []
+        annotated_ok = False
+        if output is not None:
+            try:
+                (r, potholes, (img_w, img_h)), frame, factor = output
+                pothole_count = len(potholes)
+                pitch_match = PITCH_PATTERN.search(fname)
+                pitch = int(pitch_match.group(1)) if pitch_match else 0
+                for conf, box in potholes:
+                    est_lat, est_lon, dist = project_detection(lat, lon, hdg, box, img_w, img_h, pitch=pitch)
+                    image_dets.append({
+                        "filename": fname,
+                        "lat": lat,
+                        "lon": lon,
+                        "hdg": hdg,
+                        "conf": conf,
+                        "x1": box[0],
+                        "y1": box[1],
+                        "x2": box[2],
+                        "y2": box[3],
+                        "est_lat": est_lat,
+                        "est_lon": est_lon,
+                        "est_distance_m": dist,
+                        "processed_at": processed_at,
+                    })
+
+                # Save annotated image (Ultralytics returns BGR ndarray suitable for cv2.imwrite)
+                if frame is not None:
+                    # Full-frame boxes on the original image; a reduced frame is only reused when it is full size
+                    annotated = annotate_full_frame(frame if factor == 1 else img_path, potholes)
+                else:
+                    annotated = r.plot()  # labels+conf drawn by default
+                out_annot_path = Path(annotated_dir) / fname
+                cv2.imwrite(str(out_annot_path), annotated)
+                annotated_ok = True
+
+            except Exception as e:
+                print(f"Error processing {fname}: {e}")
+                pothole_count = 0
+                image_dets = []
+
+        record = {
+            "filename": fname,
+            "lat": lat,
+            "lon": lon,
+            "hdg": hdg,
+            "pothole_count": pothole_count,
+            "processed_at": processed_at,
+        }
+        results.append((record, image_dets, annotated_ok))
+    return results
+
+
 def detect_potholes(
     images_dir: str = "backend/nj_images",
     conf_thresh: float = 0.25,
-    model_path: str = "backend/CV_model/best.pt",
-    device=0,
+    model_path: str = None,
+    device=None,
     outputs_dir: str = "outputs",
-    annotated_dirname: str = "annotated"
+    annotated_dirname: str = "annotated",
+    cluster_radius_m: float = 5.0,
+    output_format: str = "csv",
+    flush_every: int = 500,
+    partition_by=None,
+    survey_id=None,
+    roi=None,
+    reduce_factor: int = 1,
+    imgsz: int = None,
+    batch: int = None,
+    threads: int = None,
+    inference_config: str = None,
+    road_threshold: float = None,
 ):
     """
     Run YOLO-based pothole detection over a folder of images, save CSVs and annotated images.
+    Detections are also projected onto the ground and merged across panos into clusters.
 
     Args:
         images_dir (str): Folder containing input images. Filenames must match:
                           lat_<LAT>_lon_<LON>_hdg_<HEADING>*.jpg
         conf_thresh (float): Confidence threshold for detections.
-        model_path (str): Path to YOLO .pt weights.
-        device (int|str): GPU id (e.g., 0) or "cpu".
+        model_path (str): Path to YOLO weights (defaults to the tuned config's model, then best.pt).
+        device (int|str): GPU id (e.g., 0) or "cpu" (defaults to the tuned config's device, then 0).
         outputs_dir (str): Where to write CSVs and annotated folder.
         annotated_dirname (str): Subfolder name under outputs_dir for annotated images.
+        cluster_radius_m (float): Max ground distance (m) for two detections to be merged.
+        output_format (str): "csv" (everything in memory, written at the end) or
+                             "parquet" (rows streamed to outputs_dir/parquet every flush_every images).
+        flush_every (int): Images per Parquet part file.
+        partition_by (str|None): Parquet partitioning: None, "survey" or "region".
+        survey_id (str|None): Survey label used when partition_by="survey".
+        roi (tuple|None): (top, bottom) frame-height fractions to run inference on, e.g. (0.5, 1.0).
+                          Boxes are mapped back to full-frame coordinates.
+        reduce_factor (int): Decode images at 1/reduce_factor scale (1, 2, 4 or 8) before inference,
+                             lowered per image so the decoded long side stays >= imgsz.
+        imgsz (int): Model input size. batch (int): Images per predict call.
+        threads (int): Torch CPU threads.
+                       Unset imgsz/batch/threads come from the autotune config, then 640/1/torch default.
+        inference_config (str): Path to an autotune config (defaults to CV_model/inference_config.json).
+        road_threshold (float|None): Skip YOLO on frames whose road_score() is below this
+                                     (defaults to POTHOLE_ROAD_THRESHOLD; unset = run on everything).
 
     Returns:
         (df_per_image, df_per_coordinate, annotated_count)
+        Per-detection and per-cluster outputs are written alongside.
+        With output_format="parquet", df_per_image is None (read it back with
+        pyarrow.parquet.read_table(outputs_dir/parquet/run=<run id>/per_image); the run id
+        is the survey_id when given).
     """
-    pattern = re.compile(r"lat_([-\d\.]+)_lon_([-\d\.]+)_hdg_(\d+)")
+    if output_format not in ("csv", "parquet"):
+        raise ValueError("output_format must be 'csv' or 'parquet'")
+
+    tuned = load_inference_config(inference_config)
+    model_path = model_path or tuned.get("model_path") or DEFAULT_MODEL_PATH
+    if device is None:
+        device = tuned.get("device", 0)
+    imgsz = imgsz or tuned.get("imgsz") or 640
+    batch = batch or tuned.get("batch") or 1
+    threads = threads or tuned.get("threads")
+    if threads:
+        import torch
+        torch.set_num_threads(int(threads))
+        cv2.setNumThreads(int(threads))
     model = YOLO(model_path)
+    if road_threshold is None:
+        road_threshold = DEFAULT_ROAD_THRESHOLD
+    road_filter = RoadFilter(road_threshold) if road_threshold is not None else None
 
     Path(outputs_dir).mkdir(exist_ok=True)
     annotated_dir = Path(outputs_dir) / annotated_dirname
     annotated_dir.mkdir(parents=True, exist_ok=True)
 
+    writer = None
+    if output_format == "parquet":
+        writer = ParquetResultWriter(
+            Path(outputs_dir) / "parquet",
+            flush_every=flush_every,
+            partition_by=partition_by,
+            survey_id=survey_id,
+        )
+
     records = []
+    detections = []
     annotated_saved = 0
 
-    for root, _, files in os.walk(images_dir):
-        for fname in sorted(files):
-            if not fname.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".webp")):
-                continue
+    for chunk in _chunks(iter_images(images_dir), batch):
+        for record, image_dets, annotated in process_chunk(
+            model, chunk, conf_thresh, device, annotated_dir, roi, reduce_factor, imgsz, road_filter
+        ):
+            annotated_saved += annotated
+            if writer is not None:
+                writer.add(record, image_dets)
+            else:
+                records.append(record)
+                detections.extend(image_dets)
 
-            m = pattern.search(fname)
-            if not m:
-                # Skip files that don't match naming pattern
-                continue
+    if road_filter is not None:
+        print(road_filter.summary())
 
-            lat, lon, hdg = float(m.group(1)), float(m.group(2)), int(m.group(3))
-            img_path = os.path.join(root, fname)
+    if writer is not None:
+        writer.close()
+        agg_both = writer.per_coordinate()
+        clusters = writer.clusters(radius_m=cluster_radius_m)
+        agg_both.to_parquet(Path(outputs_dir) / "pothole_per_coordinate.parquet", index=False)
+        pd.DataFrame(clusters, columns=CLUSTER_COLUMNS).to_parquet(
+            Path(outputs_dir) / "pothole_clusters.parquet", index=False
+        )
+        print(f"✅ Done. Parquet datasets written to: {writer.root}")
+        print(f"   {annotated_saved} annotated files written.")
+        print(f"   Coordinates with potholes: {len(agg_both)}")
+        print(f"   Pothole clusters: {len(clusters)}")
+        return None, agg_both, annotated_saved
 
-            try:
-                results = model.predict(
-                    img_path,
-                    conf=conf_thresh,
-                    device=device,
-                    verbose=False
-                )
-                r = results[0]
-                boxes = r.boxes
-
-                # Map class IDs -> names
-                names = getattr(r, "names", None) or getattr(model.model, "names", {}) or {}
-                pothole_count = 0
-
-                if boxes is not None and boxes.shape[0] > 0:
-                    cls_ids = boxes.cls.tolist()
-                    confs = boxes.conf.tolist()
-                    for cls_id, conf in zip(cls_ids, confs):
-                        name = names.get(int(cls_id), str(int(cls_id))).lower()
-                        if name == "pothole" and conf >= conf_thresh:
-                            pothole_count += 1
+    df, agg_both, clusters = write_csv_outputs(outputs_dir, records, detections, cluster_radius_m)
+    if df.empty:
+        return df, agg_both, annotated_saved
 
-                # Save annotated image (Ultralytics returns BGR ndarray suitable for cv2.imwrite)
-                annotated = r.plot()  # labels+conf drawn by default
-                out_annot_path = annotated_dir / fname
-                cv2.imwrite(str(out_annot_path), annotated)
-                annotated_saved += 1
+    print(f"✅ Done. Annotated images saved to: {annotated_dir}")
+    print(f"   {annotated_saved} annotated files written.")
+    print(f"   Coordinates with potholes: {len(agg_both)}")
+    print(f"   Pothole clusters: {len(clusters)} (from {len(detections)} detections)")
+    return df, agg_both, annotated_saved
 
-            except Exception as e:
-                print(f"Error processing {fname}: {e}")
-                pothole_count = 0
 
-            records.append({
-                "filename": fname,
-                "lat": lat,
-                "lon": lon,
-                "hdg": hdg,
-                "pothole_count": pothole_count
-            })
+def write_csv_outputs(outputs_dir, records, detections, cluster_radius_m: float = 5.0):
+    """
+    Write the per-image, per-coordinate, per-detection and per-cluster CSVs.
 
+    Returns:
+        (df_per_image, df_per_coordinate, clusters)
+    """
     # Build per-image DataFrame
     df = pd.DataFrame(records)
     if df.empty:
@@ -98,20 +844,15 @@ def detect_potholes(
         # Still write empty CSVs for consistency
         (Path(outputs_dir) / "pothole_per_image.csv").write_text("")
         (Path(outputs_dir) / "pothole_per_coordinate.csv").write_text("")
-        return df, pd.DataFrame(), annotated_saved
+        (Path(outputs_dir) / "pothole_detections.csv").write_text("")
+        (Path(outputs_dir) / "pothole_clusters.csv").write_text("")
+        return df, pd.DataFrame(), []
 
     # Aggregate across headings per coordinate
-    agg_sum = (
-        df.groupby(["lat", "lon"], as_index=False)["pothole_count"]
-          .sum()
-          .rename(columns={"pothole_count": "pothole_count_sum"})
+    agg_both = df.groupby(["lat", "lon"], as_index=False).agg(
+        pothole_count_sum=("pothole_count", "sum"),
+        pothole_count_max=("pothole_count", "max"),
     )
-    agg_max = (
-        df.groupby(["lat", "lon"], as_index=False)["pothole_count"]
-          .max()
-          .rename(columns={"pothole_count": "pothole_count_max"})
-    )
-    agg_both = pd.merge(agg_sum, agg_max, on=["lat", "lon"])
 
     # Filter out coordinates with zero total potholes
     agg_both = agg_both[agg_both["pothole_count_sum"] != 0]
@@ -120,10 +861,12 @@ def detect_potholes(
     df.to_csv(Path(outputs_dir) / "pothole_per_image.csv", index=False)
     agg_both.to_csv(Path(outputs_dir) / "pothole_per_coordinate.csv", index=False)
 
-    print(f"✅ Done. Annotated images saved to: {annotated_dir}")
-    print(f"   {annotated_saved} annotated files written.")
-    print(f"   Coordinates with potholes: {len(agg_both)}")
-    return df, agg_both, annotated_saved
+    # Per-detection boxes and cross-pano clusters
+    clusters = cluster_detections(detections, radius_m=cluster_radius_m)
+    pd.DataFrame(detections, columns=DETECTION_COLUMNS).to_csv(Path(outputs_dir) / "pothole_detections.csv", index=False)
+    pd.DataFrame(clusters, columns=CLUSTER_COLUMNS).to_csv(Path(outputs_dir) / "pothole_clusters.csv", index=False)
+    return df, agg_both, clusters
 
 
-detect_potholes()
\ No newline at end of file
+if __name__ == "__main__":
+    detect_potholes()
@@ -0,0 +1,362 @@
+"""
+dashcam.py
+Stream a dashcam video + GPS track through the pothole detector.
+
+Frames are sampled by distance traveled (not frame index), near-duplicate frames are
+dropped with a tiny grayscale thumbnail diff, and each kept frame is geotagged by
+interpolating the GPX/CSV track. A decoder thread feeds a bounded queue while the main
+thread runs batched inference, so decoding and inference overlap.
+
+Results use the same lat_<LAT>_lon_<LON>_hdg_<HDG> naming and the same per-image /
+per-coordinate / per-detection / per-cluster CSVs as detect_potholes.
+
+Usage (from the repo root):
+    python backend/CV_model/dashcam.py --video drive.mp4 --track drive.gpx --every_m 5 \\
+        --outputs_dir outputs/dashcam
+"""
+
+import argparse
+import bisect
+import csv
+import os
+import queue
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from pathlib import Path
+
+import cv2
+from ultralytics import YOLO
+
+from cv import (
+    DEFAULT_FOV,
+    DEFAULT_MODEL_PATH,
+    annotate_full_frame,
+    load_inference_config,
+    project_detection,
+    run_inference_batch,
+    write_csv_outputs,
+)
+
+# Geometry helpers live in backend/street_view.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from street_view import bearing_deg, haversine_m
+
+# Dashcams sit lower than the Street View rig
+DASHCAM_HEIGHT_M = 1.3
+THUMB_SIZE = (32, 18)
+# Track segments shorter than this (stopped, GPS jitter) keep the previous heading
+MIN_HEADING_MOVE_M = 1.0
+
+
+def _parse_time(value: str) -> float:
+    """Seconds as a float, or an ISO-8601 timestamp converted to epoch seconds."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.strip().replace("Z", "+00:00")).timestamp()
+
+
+def parse_track(path: str):
+    """
+    Read a GPX or CSV track into [(t, lat, lon), ...] with t in seconds from the first point.
+
+    CSV needs a header with a time column (time/timestamp/t, seconds or ISO-8601) and
+    lat/latitude + lon/lng/longitude columns.
+    """
+    points = []
+    if path.lower().endswith(".gpx"):
+        for el in ET.parse(path).iter():
+            if not el.tag.endswith("trkpt"):
+                continue
+            t_el = next((c for c in el if c.tag.endswith("time")), None)
+            if t_el is None or not t_el.text:
+                continue
+            points.append((_parse_time(t_el.text), float(el.get("lat")), float(el.get("lon"))))
+    else:
+        with open(path, "r", newline="") as f:
+            reader = csv.DictReader(f)
+            cols = {c.lower().strip(): c for c in reader.fieldnames or []}
+            t_col = next((cols[c] for c in ("time", "timestamp", "t") if c in cols), None)
+            lat_col = next((cols[c] for c in ("lat", "latitude") if c in cols), None)
+            lon_col = next((cols[c] for c in ("lon", "lng", "longitude") if c in cols), None)
+            if not (t_col and lat_col and lon_col):
+                raise ValueError("Track CSV needs time, lat and lon columns")
+            for row in reader:
+                points.append((_parse_time(row[t_col]), float(row[lat_col]), float(row[lon_col])))
+
+    if len(points) < 2:
+        raise ValueError(f"Track {path} has fewer than 2 timestamped points")
+    points.sort()
+    t0 = points[0][0]
+    return [(t - t0, lat, lon) for t, lat, lon in points]
+
+
+class Track:
+    """
+    Time-indexed GPS track with linear interpolation of position and cumulative distance.
+    While the vehicle is stationary the last heading it moved along is carried forward
+    (and a track that starts stationary takes its first real heading).
+    """
+
+    def __init__(self, points):
+        self.times = [t for t, _, _ in points]
+        self.points = points
+        self.cum_dist = [0.0]
+        self.headings = []
+        for (_, la1, lo1), (_, la2, lo2) in zip(points, points[1:]):
+            step = haversine_m(la1, lo1, la2, lo2)
+            self.cum_dist.append(self.cum_dist[-1] + step)
+            self.headings.append(bearing_deg(la1, lo1, la2, lo2) if step >= MIN_HEADING_MOVE_M else None)
+        last = next((h for h in self.headings if h is not None), 0.0)
+        for i, h in enumerate(self.headings):
+            if h is None:
+                self.headings[i] = last
+            else:
+                last = h
+        self.duration = self.times[-1]
+
+    def at(self, t):
+        """(lat, lon, heading_deg, distance_m) at track time t, or None outside the track."""
+        if t < 0 or t > self.duration:
+            return None
+        i = max(1, bisect.bisect_left(self.times, t))
+        t1, la1, lo1 = self.points[i - 1]
+        t2, la2, lo2 = self.points[i]
+        f = (t - t1) / (t2 - t1) if t2 > t1 else 0.0
+        lat = la1 + (la2 - la1) * f
+        lon = lo1 + (lo2 - lo1) * f
+        dist = self.cum_dist[i - 1] + (self.cum_dist[i] - self.cum_dist[i - 1]) * f
+        return lat, lon, self.headings[i - 1], dist
+
+
+def decode_frames(video_path, track, out_q, stats, every_m=5.0, offset_s=0.0, dedup_threshold=4.0,
+                  stop=None):
+    """
+    Producer: push (frame_idx, video_t, lat, lon, hdg, frame) for every sampled frame, then None.
+
+    Frames are only grabbed (not retrieved/converted) until the vehicle has moved every_m
+    meters since the last kept frame.
+    """
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            raise ValueError(f"Could not open video {video_path}")
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        last_dist = None
+        last_thumb = None
+        frame_idx = -1
+        while not (stop and stop.is_set()) and cap.grab():
+            frame_idx += 1
+            stats["frames_total"] += 1
+            video_t = frame_idx / fps
+            pos = track.at(video_t + offset_s)
+            if pos is None:
+                continue
+            lat, lon, hdg, dist = pos
+            if last_dist is not None and dist - last_dist < every_m:
+                continue
+            ok, frame = cap.retrieve()
+            if not ok:
+                continue
+            last_dist = dist
+
+            thumb = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), THUMB_SIZE, interpolation=cv2.INTER_AREA)
+            if last_thumb is not None and cv2.absdiff(thumb, last_thumb).mean() < dedup_threshold:
+                stats["frames_duplicate"] += 1
+                continue
+            last_thumb = thumb
+
+            stats["frames_sampled"] += 1
+            out_q.put((frame_idx, video_t, lat, lon, hdg, frame))
+        stats["video_seconds"] = (frame_idx + 1) / fps
+    finally:
+        cap.release()
+        out_q.put(None)
+
+
+def process_dashcam(
+    video_path: str,
+    track_path: str,
+    outputs_dir: str = "outputs/dashcam",
+    every_m: float = 5.0,
+    offset_s: float = 0.0,
+    dedup_threshold: float = 4.0,
+    conf_thresh: float = 0.25,
+    model_path: str = None,
+    device=None,
+    imgsz: int = None,
+    batch: int = None,
+    roi=None,
+    fov: float = DEFAULT_FOV,
+    camera_height: float = DASHCAM_HEIGHT_M,
+    save_frames: bool = False,
+    cluster_radius_m: float = 5.0,
+    queue_size: int = 32,
+):
+    """
+    Run pothole detection over a dashcam video geotagged by a GPX/CSV track.
+
+    Args:
+        video_path (str): Video file readable by OpenCV.
+        track_path (str): .gpx or .csv track (see parse_track).
+        outputs_dir (str): Where to write CSVs and annotated frames.
+        every_m (float): Keep one frame per this many meters traveled.
+        offset_s (float): Track time at video time 0 (positive if the GPS started first).
+        dedup_threshold (float): Mean abs diff (0-255) on a 32x18 thumbnail below which
+                                 a frame counts as a near-duplicate of the previous one.
+        roi (tuple|None): (top, bottom) frame-height fractions to run inference on.
+        fov (float): Horizontal field of view of the camera, for ground projection.
+        camera_height (float): Camera height above the road in meters.
+        save_frames (bool): Also save every sampled frame (not just annotated detections).
+
+    Returns:
+        (df_per_image, df_per_coordinate, stats)
+    """
+    track = Track(parse_track(track_path))
+    tuned = load_inference_config()
+    if device is None:
+        device = tuned.get("device", "cpu")
+    model = YOLO(model_path or tuned.get("model_path") or DEFAULT_MODEL_PATH)
+    imgsz = imgsz or tuned.get("imgsz") or 640
+    batch = batch or tuned.get("batch") or 4
+    if tuned.get("threads"):
+        import torch
+        torch.set_num_threads(int(tuned["threads"]))
+
+    out = Path(outputs_dir)
+    annotated_dir = out / "annotated"
+    annotated_dir.mkdir(parents=True, exist_ok=True)
+    frames_dir = out / "frames"
+    if save_frames:
+        frames_dir.mkdir(parents=True, exist_ok=True)
+
+    stats = {"frames_total": 0, "frames_sampled": 0, "frames_duplicate": 0, "video_seconds": 0.0}
+    frame_q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    decoder_error = []
+
+    def _decoder():
+        try:
+            decode_frames(video_path, track, frame_q, stats, every_m, offset_s, dedup_threshold, stop)
+        except Exception as e:
+            decoder_error.append(e)
+
+    t_start = time.perf_counter()
+    decoder = threading.Thread(target=_decoder, daemon=True)
+    decoder.start()
+
+    records = []
+    detections = []
+    done = False
+    try:
+        while not done:
+            item = frame_q.get()
+            if item is None:
+                break
+            items = [item]
+            # Top up the batch with whatever is already decoded, without waiting
+            while len(items) < batch:
+                try:
+                    nxt = frame_q.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    done = True
+                    break
+                items.append(nxt)
+
+            outputs = run_inference_batch(model, [it[5] for it in items], conf_thresh, device, roi=roi, imgsz=imgsz)
+            for (frame_idx, video_t, lat, lon, hdg, frame), (r, potholes, (img_w, img_h)) in zip(items, outputs):
+                lat, lon, hdg = round(lat, 7), round(lon, 7), int(round(hdg)) % 360
+                fname = f"lat_{lat}_lon_{lon}_hdg_{hdg}_dashcam_{frame_idx:06d}.jpg"
+                for conf, box in potholes:
+                    est_lat, est_lon, dist = project_detection(
+                        lat, lon, hdg, box, img_w, img_h, fov=fov, camera_height=camera_height
+                    )
+                    detections.append({
+                        "filename": fname, "lat": lat, "lon": lon, "hdg": hdg, "conf": conf,
+                        "x1": box[0], "y1": box[1], "x2": box[2], "y2": box[3],
+                        "est_lat": est_lat, "est_lon": est_lon, "est_distance_m": dist,
+                        "processed_at": datetime.now(timezone.utc).isoformat(),
+                    })
+                if potholes:
+                    # With an ROI, r is the crop; boxes are already in full-frame coordinates
+                    annotated = annotate_full_frame(frame, potholes) if roi else r.plot()
+                    cv2.imwrite(str(annotated_dir / fname), annotated)
+                if save_frames:
+                    cv2.imwrite(str(frames_dir / fname), frame)
+                records.append({
+                    "filename": fname,
+                    "lat": lat,
+                    "lon": lon,
+                    "hdg": hdg,
+                    "pothole_count": len(potholes),
+                    "processed_at": datetime.now(timezone.utc).isoformat(),
+                    "video_t": round(video_t, 3),
+                })
+    finally:
+        stop.set()
+        # Unblock the decoder if it is waiting on a full queue
+        while decoder.is_alive():
+            try:
+                frame_q.get_nowait()
+            except queue.Empty:
+                decoder.join(timeout=0.1)
+    if decoder_error:
+        raise decoder_error[0]
+
+    wall = time.perf_counter() - t_start
+    stats["wall_seconds"] = round(wall, 2)
+    stats["realtime_factor"] = round(stats["video_seconds"] / wall, 2) if wall else None
+
+    df, agg, clusters = write_csv_outputs(outputs_dir, records, detections, cluster_radius_m)
+    print(f"✅ Done. {stats['frames_sampled']} frames analyzed "
+          f"({stats['frames_duplicate']} near-duplicates skipped of {stats['frames_total']} decoded)")
+    print(f"   {stats['video_seconds']:.1f}s of video in {wall:.1f}s ({stats['realtime_factor']}x real time)")
+    print(f"   Coordinates with potholes: {len(agg)}, clusters: {len(clusters)}")
+    return df, agg, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect potholes in a dashcam video geotagged by a GPX/CSV track.")
+    parser.add_argument("--video", required=True)
+    parser.add_argument("--track", required=True, help=".gpx or .csv (time,lat,lon)")
+    parser.add_argument("--outputs_dir", default="outputs/dashcam")
+    parser.add_argument("--every_m", type=float, default=5.0, help="Meters traveled between sampled frames")
+    parser.add_argument("--offset", type=float, default=0.0, help="Track seconds at video start")
+    parser.add_argument("--dedup_threshold", type=float, default=4.0)
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--model_path", default=None)
+    parser.add_argument("--device", default=None, help="Defaults to the tuned config's device, then cpu")
+    parser.add_argument("--imgsz", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=None)
+    parser.add_argument("--roi", type=float, nargs=2, default=None, metavar=("TOP", "BOTTOM"))
+    parser.add_argument("--fov", type=float, default=DEFAULT_FOV)
+    parser.add_argument("--camera_height", type=float, default=DASHCAM_HEIGHT_M)
+    parser.add_argument("--save_frames", action="store_true")
+    args = parser.parse_args()
+
+    process_dashcam(
+        video_path=args.video,
+        track_path=args.track,
+        outputs_dir=args.outputs_dir,
+        every_m=args.every_m,
+        offset_s=args.offset,
+        dedup_threshold=args.dedup_threshold,
+        conf_thresh=args.conf,
+        model_path=args.model_path,
+        device=args.device,
+        imgsz=args.imgsz,
+        batch=args.batch,
+        roi=tuple(args.roi) if args.roi else None,
+        fov=args.fov,
+        camera_height=args.camera_height,
+        save_frames=args.save_frames,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+roi_eval.py
+Compare full-frame inference against road-ROI cropping / reduced-resolution decoding.
+
+Runs best.pt over the images in a folder twice (baseline vs. preprocessed) and reports
+images/sec for each mode and the recall of the preprocessed mode against the baseline
+detections (IoU match in full-frame coordinates).
+
+Usage (from the repo root):
+    python backend/CV_model/roi_eval.py --images_dir backend/nj_images --roi 0.5 1.0 --reduce 2
+"""
+
+import argparse
+import json
+import os
+import time
+
+from ultralytics import YOLO
+
+from cv import run_inference
+
+
+def iou(a, b):
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, ix2 - ix1) * max(0.0, iy2 - iy1)
+    if inter == 0:
+        return 0.0
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    return inter / (area_a + area_b - inter)
+
+
+def list_images(images_dir, limit=None):
+    paths = []
+    for root, _, files in os.walk(images_dir):
+        for fname in sorted(files):
+            if fname.lower().endswith((".jpg", ".jpeg", ".png")):
+                paths.append(os.path.join(root, fname))
+    return paths[:limit] if limit else paths
+
+
+def run_mode(model, paths, conf_thresh, device, roi=None, reduce_factor=1):
+    """
+    Returns ({path: [box, ...]}, images_per_sec, factors), factors being the reduce factors
+    actually used (run_inference lowers reduce_factor when it would decode below imgsz).
+    """
+    # Warm up so model fusing / first-call allocation isn't timed
+    run_inference(model, paths[0], conf_thresh, device, roi=roi, reduce_factor=reduce_factor)
+    boxes = {}
+    factors = set()
+    t0 = time.perf_counter()
+    for p in paths:
+        r, potholes, (full_w, _) = run_inference(model, p, conf_thresh, device, roi=roi, reduce_factor=reduce_factor)
+        boxes[p] = [box for _, box in potholes]
+        # The ROI only crops rows, so the width ratio is the decode factor
+        factors.add(round(full_w / r.orig_shape[1]))
+    elapsed = time.perf_counter() - t0
+    return boxes, len(paths) / elapsed if elapsed > 0 else 0.0, sorted(factors)
+
+
+def compare(baseline, candidate, iou_thresh=0.5):
+    matched = total = 0
+    for path, base_boxes in baseline.items():
+        cand = list(candidate.get(path, []))
+        for b in base_boxes:
+            total += 1
+            best = max(range(len(cand)), key=lambda i: iou(b, cand[i]), default=None)
+            if best is not None and iou(b, cand[best]) >= iou_thresh:
+                matched += 1
+                cand.pop(best)
+    return matched, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure throughput/recall of ROI cropping and reduced decoding.")
+    parser.add_argument("--images_dir", default="backend/nj_images")
+    parser.add_argument("--model_path", default="backend/CV_model/best.pt")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--roi", type=float, nargs=2, default=[0.5, 1.0], metavar=("TOP", "BOTTOM"))
+    parser.add_argument("--reduce", type=int, default=1, choices=[1, 2, 4, 8])
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N images")
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--out", default=None, help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    paths = list_images(args.images_dir, args.limit)
+    if not paths:
+        raise SystemExit(f"No images found in {args.images_dir}")
+    model = YOLO(args.model_path)
+
+    base_boxes, base_ips, _ = run_mode(model, paths, args.conf, args.device)
+    roi_boxes, roi_ips, factors = run_mode(model, paths, args.conf, args.device,
+                                           roi=tuple(args.roi), reduce_factor=args.reduce)
+    if factors != [args.reduce]:
+        print(f"⚠️ --reduce {args.reduce} was lowered to {factors} to keep images at or above imgsz")
+    matched, total = compare(base_boxes, roi_boxes, args.iou)
+
+    result = {
+        "images": len(paths),
+        "roi": args.roi,
+        "reduce_factor_requested": args.reduce,
+        "reduce_factor": factors[0] if len(factors) == 1 else factors,
+        "baseline_images_per_sec": round(base_ips, 2),
+        "roi_images_per_sec": round(roi_ips, 2),
+        "speedup": round(roi_ips / base_ips, 2) if base_ips else None,
+        "baseline_detections": total,
+        "roi_detections": sum(len(v) for v in roi_boxes.values()),
+        "recall_vs_baseline": round(matched / total, 3) if total else None,
+    }
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
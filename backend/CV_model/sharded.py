@@ -0,0 +1,304 @@
+"""
+sharded.py
+Run detect_potholes across several CPU worker processes.
+
+The images in images_dir are split round-robin into one shard per worker. Each worker
+loads its own copy of the model with torch/OpenCV/OpenMP threads pinned to
+threads_per_worker (so N workers don't oversubscribe the cores) and streams per-batch
+results back to the parent over a queue. The parent merges them into the same
+per-image / per-coordinate / per-detection / per-cluster outputs as detect_potholes
+and prints combined progress. If a worker dies, only the images of its shard that
+have not been reported yet are re-run in a fresh process; messages carry the attempt
+number, so anything still queued from the crashed process is ignored.
+
+Usage (from the repo root):
+    python backend/CV_model/sharded.py --images_dir backend/nj_images --workers 8 \\
+        --threads_per_worker 4 --device cpu
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import time
+from pathlib import Path
+
+import cv2
+import pandas as pd
+import torch
+from ultralytics import YOLO
+
+from cv import (
+    CLUSTER_COLUMNS,
+    DEFAULT_MODEL_PATH,
+    DEFAULT_ROAD_THRESHOLD,
+    ParquetResultWriter,
+    RoadFilter,
+    _chunks,
+    iter_images,
+    load_inference_config,
+    process_chunk,
+    write_csv_outputs,
+)
+
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+PROGRESS_EVERY_S = 5.0
+
+
+def _worker(shard_id, attempt, items, opts, out_q):
+    """
+    Process one shard; puts ("chunk", shard_id, attempt, results) per batch, then
+    ("done", shard_id, attempt, road-filter skips).
+    """
+    threads = opts["threads"]
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+    model = YOLO(opts["model_path"])
+    road_filter = RoadFilter(opts["road_threshold"]) if opts["road_threshold"] is not None else None
+
+    for chunk in _chunks(items, opts["batch"]):
+        results = process_chunk(
+            model, chunk, opts["conf_thresh"], opts["device"], opts["annotated_dir"],
+            opts["roi"], opts["reduce_factor"], opts["imgsz"], road_filter,
+        )
+        out_q.put(("chunk", shard_id, attempt, results))
+    out_q.put(("done", shard_id, attempt, road_filter.skipped if road_filter else 0))
+
+
+def _start(ctx, shard_id, attempt, items, opts, out_q):
+    # Thread-count env vars must be in place before the child imports torch
+    saved = {k: os.environ.get(k) for k in THREAD_ENV_VARS}
+    os.environ.update({k: str(opts["threads"]) for k in THREAD_ENV_VARS})
+    try:
+        p = ctx.Process(target=_worker, args=(shard_id, attempt, items, opts, out_q), daemon=True)
+        p.start()
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    return p
+
+
+def detect_potholes_sharded(
+    images_dir: str = "backend/nj_images",
+    workers: int = None,
+    threads_per_worker: int = None,
+    conf_thresh: float = 0.25,
+    model_path: str = None,
+    device=None,
+    outputs_dir: str = "outputs",
+    annotated_dirname: str = "annotated",
+    cluster_radius_m: float = 5.0,
+    output_format: str = "csv",
+    flush_every: int = 500,
+    partition_by=None,
+    survey_id=None,
+    roi=None,
+    reduce_factor: int = 1,
+    imgsz: int = None,
+    batch: int = None,
+    max_retries: int = 2,
+    inference_config: str = None,
+    road_threshold: float = None,
+):
+    """
+    Sharded detect_potholes. Arguments match detect_potholes, plus:
+
+    Args:
+        workers (int): Worker processes (defaults to cpu_count // threads_per_worker).
+        threads_per_worker (int): Torch/OpenCV threads per worker (defaults to the
+                                  autotune config's threads, then 1).
+        max_retries (int): Times a crashed shard's unfinished images are re-run.
+
+    Returns:
+        (df_per_image, df_per_coordinate, annotated_count), as detect_potholes.
+    """
+    if output_format not in ("csv", "parquet"):
+        raise ValueError("output_format must be 'csv' or 'parquet'")
+
+    tuned = load_inference_config(inference_config)
+    cpus = os.cpu_count() or 1
+    threads_per_worker = threads_per_worker or tuned.get("threads") or 1
+    workers = workers or max(1, cpus // threads_per_worker)
+    if workers * threads_per_worker > cpus:
+        print(f"⚠️ {workers} workers x {threads_per_worker} threads exceeds {cpus} CPUs")
+
+    Path(outputs_dir).mkdir(exist_ok=True)
+    annotated_dir = Path(outputs_dir) / annotated_dirname
+    annotated_dir.mkdir(parents=True, exist_ok=True)
+
+    opts = {
+        "model_path": model_path or tuned.get("model_path") or DEFAULT_MODEL_PATH,
+        "conf_thresh": conf_thresh,
+        "device": device if device is not None else tuned.get("device", "cpu"),
+        "annotated_dir": str(annotated_dir),
+        "roi": roi,
+        "reduce_factor": reduce_factor,
+        "imgsz": imgsz or tuned.get("imgsz") or 640,
+        "batch": batch or tuned.get("batch") or 1,
+        "threads": threads_per_worker,
+        "road_threshold": road_threshold if road_threshold is not None else DEFAULT_ROAD_THRESHOLD,
+    }
+
+    images = list(iter_images(images_dir))
+    total = len(images)
+    workers = max(1, min(workers, total))
+    # Round-robin keeps shards balanced even when one area's images are slower to decode
+    pending = {i: {item[0]: item for item in images[i::workers]} for i in range(workers)}
+    retries = {i: 0 for i in range(workers)}
+
+    writer = None
+    if output_format == "parquet":
+        writer = ParquetResultWriter(
+            Path(outputs_dir) / "parquet",
+            flush_every=flush_every,
+            partition_by=partition_by,
+            survey_id=survey_id,
+        )
+
+    records = []
+    detections = []
+    annotated_saved = 0
+    failed = []
+    done_count = 0
+    road_skipped = 0
+
+    # spawn, not fork: the parent has already imported torch and forking it is unsafe
+    ctx = mp.get_context("spawn")
+    out_q = ctx.Queue()
+    procs = {i: _start(ctx, i, 0, list(pending[i].values()), opts, out_q) for i in range(workers) if pending[i]}
+    print(f"Started {len(procs)} workers x {threads_per_worker} threads for {total} images")
+
+    def handle(msg):
+        nonlocal done_count, annotated_saved, road_skipped
+        kind, shard_id, attempt, results = msg
+        if attempt != retries[shard_id]:
+            return  # from a process already written off as crashed; its retry covers these images
+        if kind == "chunk":
+            for record, image_dets, annotated in results:
+                if pending[shard_id].pop(record["filename"], None) is None:
+                    continue
+                done_count += 1
+                annotated_saved += annotated
+                if writer is not None:
+                    writer.add(record, image_dets)
+                else:
+                    records.append(record)
+                    detections.extend(image_dets)
+        elif kind == "done":
+            road_skipped += results
+            # "done" is the child's last message, so nothing it wrote is left unread
+            procs.pop(shard_id).join()
+
+    t0 = time.perf_counter()
+    last_report = t0
+    while procs:
+        try:
+            handle(out_q.get(timeout=0.5))
+        except queue.Empty:
+            # A worker can put its last results and exit between the get() timing out and
+            # is_alive(); read everything it left in the queue before calling it a crash
+            exited = [shard_id for shard_id, p in procs.items() if not p.is_alive()]
+            if exited:
+                while True:
+                    try:
+                        handle(out_q.get_nowait())
+                    except queue.Empty:
+                        break
+            for shard_id in exited:
+                p = procs.get(shard_id)
+                if p is None:
+                    continue  # its "done" was in the drained messages
+                procs.pop(shard_id)
+                remaining = list(pending[shard_id].values())
+                if not remaining:
+                    continue
+                if p.exitcode == 0:
+                    # Clean exit without a "done" we could read: don't re-run, report the gap
+                    print(f"⚠️ Worker {shard_id} exited cleanly without reporting {len(remaining)} images")
+                    failed.extend(fname for fname, *_ in remaining)
+                    pending[shard_id].clear()
+                elif retries[shard_id] < max_retries:
+                    retries[shard_id] += 1
+                    print(f"⚠️ Worker {shard_id} exited with code {p.exitcode}; "
+                          f"retrying {len(remaining)} images (attempt {retries[shard_id]})")
+                    procs[shard_id] = _start(ctx, shard_id, retries[shard_id], remaining, opts, out_q)
+                else:
+                    print(f"❌ Worker {shard_id} failed {max_retries + 1} times; giving up on {len(remaining)} images")
+                    failed.extend(fname for fname, *_ in remaining)
+                    pending[shard_id].clear()
+
+        now = time.perf_counter()
+        if now - last_report >= PROGRESS_EVERY_S or not procs:
+            rate = done_count / (now - t0) if now > t0 else 0.0
+            print(f"[{done_count}/{total}] {rate:.1f} img/s, {len(procs)} workers running")
+            last_report = now
+
+    if failed:
+        print(f"⚠️ {len(failed)} images were not processed")
+    if opts["road_threshold"] is not None:
+        print(f"Road filter (threshold {opts['road_threshold']}): skipped {road_skipped}/{total} frames")
+
+    if writer is not None:
+        writer.close()
+        agg_both = writer.per_coordinate()
+        clusters = writer.clusters(radius_m=cluster_radius_m)
+        agg_both.to_parquet(Path(outputs_dir) / "pothole_per_coordinate.parquet", index=False)
+        pd.DataFrame(clusters, columns=CLUSTER_COLUMNS).to_parquet(
+            Path(outputs_dir) / "pothole_clusters.parquet", index=False
+        )
+        print(f"✅ Done. Parquet datasets written to: {writer.root}")
+        print(f"   {annotated_saved} annotated files written.")
+        return None, agg_both, annotated_saved
+
+    # Same row order as a single-process run regardless of which worker finished first
+    records.sort(key=lambda r: r["filename"])
+    detections.sort(key=lambda d: d["filename"])
+    df, agg_both, clusters = write_csv_outputs(outputs_dir, records, detections, cluster_radius_m)
+    print(f"✅ Done. Annotated images saved to: {annotated_dir}")
+    print(f"   {annotated_saved} annotated files written.")
+    print(f"   Coordinates with potholes: {len(agg_both)}")
+    print(f"   Pothole clusters: {len(clusters)} (from {len(detections)} detections)")
+    return df, agg_both, annotated_saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run pothole detection sharded across worker processes.")
+    parser.add_argument("--images_dir", default="backend/nj_images")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads_per_worker", type=int, default=None)
+    parser.add_argument("--outputs_dir", default="outputs")
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--model_path", default=None)
+    parser.add_argument("--device", default=None, help="Defaults to the tuned config's device, then cpu")
+    parser.add_argument("--imgsz", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=None)
+    parser.add_argument("--roi", type=float, nargs=2, default=None, metavar=("TOP", "BOTTOM"))
+    parser.add_argument("--reduce_factor", type=int, default=1, choices=[1, 2, 4, 8])
+    parser.add_argument("--output_format", default="csv", choices=["csv", "parquet"])
+    parser.add_argument("--max_retries", type=int, default=2)
+    parser.add_argument("--road_threshold", type=float, default=None, help="Skip frames with less road than this")
+    args = parser.parse_args()
+
+    detect_potholes_sharded(
+        images_dir=args.images_dir,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        conf_thresh=args.conf,
+        model_path=args.model_path,
+        device=args.device,
+        outputs_dir=args.outputs_dir,
+        output_format=args.output_format,
+        roi=tuple(args.roi) if args.roi else None,
+        reduce_factor=args.reduce_factor,
+        imgsz=args.imgsz,
+        batch=args.batch,
+        max_retries=args.max_retries,
+        road_threshold=args.road_threshold,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+adaptive_survey.py
+Coarse-to-fine Street View sampling for large survey bboxes.
+
+The bbox is first sampled on a coarse grid. Images are run through the pothole detector,
+and only the grid points whose pano showed damage (or, with refine_on="roads", had any
+pano at all) are refined: each spawns its 8 neighbours at half the step. This repeats
+until the step would drop below min_step or the image-request budget is spent.
+Hot points are refined first, so a tight budget goes to the worst areas.
+
+With pano_state and skip_unchanged (an incremental re-survey), panos whose id and capture
+date are unchanged are not downloaded again; their hazards from the previous survey count
+as detections when choosing where to refine.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from street_view import RoadIndex, _ensure_env_loaded, generate_grid, new_download_summary, run_downloader
+
+IMAGE_PATTERN = re.compile(r"lat_([-\d\.]+)_lon_([-\d\.]+)_hdg_(\d+)")
+DEFAULT_HEADINGS = [0, 90, 180, 270]
+
+
+def yolo_detector(model_path: Optional[str] = None, conf_thresh: Optional[float] = None,
+                  device="cpu", batch: int = 8) -> Callable[[List[str]], Dict[str, int]]:
+    """Build a detector(image_paths) -> {path: pothole_count} backed by the YOLO weights."""
+    from ultralytics import YOLO
+    from CV_model.cv import run_inference_batch
+
+    model_path = model_path or os.getenv("POTHOLE_MODEL_PATH") or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "CV_model", "best.pt"
+    )
+    if conf_thresh is None:
+        conf_thresh = float(os.getenv("POTHOLE_THRESHOLD") or 0.25)
+    model = YOLO(model_path)
+
+    def detect(paths):
+        counts = {}
+        for i in range(0, len(paths), batch):
+            chunk = paths[i:i + batch]
+            for p, (_, potholes, _) in zip(chunk, run_inference_batch(model, chunk, conf_thresh, device)):
+                counts[p] = len(potholes)
+        return counts
+
+    return detect
+
+
+def _pano_key(fname: str) -> Optional[str]:
+    m = IMAGE_PATTERN.search(fname)
+    return f"{float(m.group(1))}_{float(m.group(2))}" if m else None
+
+
+def generate_folder_adaptive(
+    lat_min, lat_max, lon_min, lon_max,
+    coarse_step: float = 0.02,
+    min_step: float = 0.002,
+    budget: int = 2000,
+    refine_on: str = "hazards",
+    detector: Optional[Callable[[List[str]], Dict[str, int]]] = None,
+    headings: Optional[List[int]] = None,
+    heading_mode: str = "fixed",
+    road_index: Optional[RoadIndex] = None,
+    pano_state: Optional[dict] = None,
+    skip_unchanged: bool = False,
+):
+    """
+    Download Street View images for a bbox with adaptive grid refinement.
+
+    Args:
+        coarse_step (float): Grid step (degrees) of the first pass.
+        min_step (float): Finest step refinement may reach.
+        budget (int): Max Street View image requests across all passes.
+        refine_on (str): "hazards" (refine around points with detections) or
+                         "roads" (refine around every point that has a pano).
+        detector (callable): image_paths -> {path: pothole_count}; defaults to yolo_detector().
+        heading_mode, road_index: As in run_downloader ("road" = two road-aligned views per pano).
+        pano_state, skip_unchanged: As in run_downloader, applied to every pass.
+
+    Returns:
+        (folder_path, summary) where summary has "requests", "points_visited",
+        "hazard_images" (filenames with detections), per-pass "levels" and "download",
+        the run_downloader summaries of all passes merged (for commit_points).
+    """
+    if refine_on not in ("hazards", "roads"):
+        raise ValueError("refine_on must be 'hazards' or 'roads'")
+    _ensure_env_loaded()
+    api_key = os.environ.get("GOOGLE_MAPS_API_KEY")
+    if not api_key:
+        raise ValueError("Missing API key. Set GOOGLE_MAPS_API_KEY env var.")
+    headings = headings or DEFAULT_HEADINGS
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        if refine_on == "hazards" and detector is None:
+            detector = yolo_detector()
+
+        visited = set()
+        seen_panos = set()
+        download = new_download_summary()
+        hazard_images = set()
+        levels = []
+        used = 0
+        step = coarse_step
+        frontier = generate_grid((lat_min, lat_max, lon_min, lon_max), coarse_step)
+
+        while frontier and used < budget:
+            points = []
+            for lat, lon in frontier:
+                key = f"{lat},{lon}"
+                if key not in visited:
+                    visited.add(key)
+                    points.append((lat, lon))
+            if not points:
+                break
+
+            summary = run_downloader(
+                api_key=api_key,
+                points=points,
+                output_dir=temp_dir,
+                headings=headings,
+                max_requests=budget - used,
+                skip_panos=seen_panos,
+                heading_mode=heading_mode,
+                road_index=road_index,
+                pano_state=pano_state,
+                skip_unchanged=skip_unchanged,
+            )
+            used += summary["requests"]
+            new_panos = summary["downloaded_panos"]
+            seen_panos |= new_panos | summary["unchanged_panos"]
+            for key, value in summary.items():
+                if isinstance(value, set):
+                    download[key] |= value
+                elif isinstance(value, dict):
+                    # Earlier passes staged a pano first; keep that entry (it holds the previous hazards)
+                    for k, v in value.items():
+                        download[key].setdefault(k, v)
+                else:
+                    download[key] += value
+
+            pano_hits = defaultdict(int)
+            if refine_on == "hazards":
+                level_images = [
+                    os.path.join(temp_dir, f) for f in sorted(os.listdir(temp_dir))
+                    if f.lower().endswith((".jpg", ".jpeg", ".png")) and _pano_key(f) in new_panos
+                ]
+                for path, count in detector(level_images).items():
+                    if count > 0:
+                        hazard_images.add(os.path.basename(path))
+                        pano_hits[_pano_key(os.path.basename(path))] += count
+                if pano_state is not None:
+                    # Not re-downloaded, but known to be damaged from the previous survey
+                    for pano_key in summary["unchanged_panos"]:
+                        known = len(pano_state["panos"].get(pano_key, {}).get("hazard_ids", []))
+                        if known:
+                            pano_hits[pano_key] += known
+
+            scored = []
+            for grid_key, pano_key in summary["point_panos"].items():
+                score = pano_hits.get(pano_key, 0) if refine_on == "hazards" else 1
+                if score > 0:
+                    lat, lon = (float(x) for x in grid_key.split(","))
+                    scored.append((score, lat, lon))
+
+            levels.append({
+                "step": step,
+                "points": len(points),
+                "requests": summary["requests"],
+                "new_panos": len(new_panos),
+                "hot_points": len(scored),
+            })
+
+            child_step = step / 2
+            if child_step < min_step - 1e-12:
+                break
+            # Refine the worst areas first so a tight budget is spent where it matters
+            scored.sort(reverse=True)
+            frontier = []
+            for _, lat, lon in scored:
+                for dlat in (-child_step, 0.0, child_step):
+                    for dlon in (-child_step, 0.0, child_step):
+                        if dlat == 0.0 and dlon == 0.0:
+                            continue
+                        clat, clon = round(lat + dlat, 6), round(lon + dlon, 6)
+                        if lat_min <= clat <= lat_max and lon_min <= clon <= lon_max:
+                            frontier.append((clat, clon))
+            step = child_step
+
+        print(f"Adaptive survey: {used} image requests over {len(levels)} passes, "
+              f"{len(visited)} points, {len(hazard_images)} images with detections")
+        return temp_dir, {
+            "requests": used,
+            "points_visited": len(visited),
+            "hazard_images": hazard_images,
+            "levels": levels,
+            "download": download,
+        }
+    except Exception as e:
+        # Clean up the temporary directory in case of an error
+        shutil.rmtree(temp_dir)
+        raise e
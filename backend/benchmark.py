@@ -0,0 +1,570 @@
+"""
+benchmark.py
+Offline end-to-end benchmark for the survey pipeline.
+
+Starts one local HTTP server that stands in for the Street View metadata/image API,
+Nominatim reverse geocoding, Gemini generateContent (REST) and Supabase Storage/PostgREST,
+points the pipeline at it through env vars, then drives run_downloader, detect_potholes
+and process_survey_in_background end-to-end. No external quota is used.
+
+Each stand-in has configurable latency and error/429 rates:
+
+    python backend/benchmark.py --bbox 38.92 38.93 -75.45 -75.43 --grid_step 0.002 \\
+        --latency streetview=40 nominatim=150 gemini=900 supabase=30 \\
+        --rate_429 gemini=0.05 --error_rate nominatim=0.01 \\
+        --out bench_results/$(git rev-parse --short HEAD).json
+
+    # Gemini batch analyses/sec and replies lost to parsing, with 2% truncated replies
+    python backend/benchmark.py --stages gemini --analyses 500 --gemini_in_flight 16 --bad_json_rate 0.02
+
+    # Sharded survey throughput with 1, 2 and 4 tile workers
+    python backend/benchmark.py --stages tiled --tile_workers 1 2 4 --latency gemini=900
+
+    # Compare two runs
+    python backend/benchmark.py --compare bench_results/a1b2c3d.json bench_results/e4f5a6b.json
+"""
+
+import argparse
+import functools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICES = ("streetview", "nominatim", "gemini", "supabase")
+
+# Looks like a JWT so supabase.create_client accepts it
+FAKE_SUPABASE_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYmVuY2gifQ.YmVuY2g"
+
+FAKE_ANALYSIS = {
+    "hazard_type": "pothole",
+    "severity": 5,
+    "location_context": "residential street",
+    "description": "Benchmark stand-in analysis of a medium pothole in the travel lane.",
+    "projected_repair_cost": 450,
+    "projected_worsening": "moderate",
+    "future_worsening_description": "Edges will continue to ravel under traffic.",
+}
+
+
+# ---------------------------------------------------------------------------
+# Stand-in server
+# ---------------------------------------------------------------------------
+
+class StandInConfig:
+    def __init__(self, latency_ms=None, error_rate=None, rate_429=None, retry_after=1, image_bytes=b"", bad_json_rate=0.0):
+        self.latency_ms = {s: 0.0 for s in SERVICES}
+        self.error_rate = {s: 0.0 for s in SERVICES}
+        self.rate_429 = {s: 0.0 for s in SERVICES}
+        self.latency_ms.update(latency_ms or {})
+        self.error_rate.update(error_rate or {})
+        self.rate_429.update(rate_429 or {})
+        self.retry_after = retry_after
+        self.image_bytes = image_bytes
+        self.bad_json_rate = bad_json_rate
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def count(self, service, outcome):
+        with self._lock:
+            self.counts[service][outcome] += 1
+
+
+def _service_for(path: str) -> str:
+    if path.startswith("/maps/api/streetview"):
+        return "streetview"
+    if path.startswith("/reverse"):
+        return "nominatim"
+    if ":generateContent" in path:
+        return "gemini"
+    return "supabase"
+
+
+def make_handler(cfg: StandInConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body=b"", ctype="application/json", headers=None):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _handle(self):
+            url = urlparse(self.path)
+            service = _service_for(url.path)
+            body = self._read_body()
+            time.sleep(cfg.latency_ms[service] / 1000.0)
+
+            roll = random.random()
+            if roll < cfg.rate_429[service]:
+                cfg.count(service, "429")
+                return self._send(429, {"error": "rate limited"}, headers={"Retry-After": str(cfg.retry_after)})
+            if roll < cfg.rate_429[service] + cfg.error_rate[service]:
+                cfg.count(service, "5xx")
+                return self._send(503, {"error": "unavailable"})
+            cfg.count(service, "ok")
+
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if service == "streetview":
+                if url.path.endswith("/metadata"):
+                    lat, lon = (float(x) for x in q.get("location", "0,0").split(","))
+                    return self._send(200, {
+                        "status": "OK",
+                        "pano_id": f"bench_{lat:.5f}_{lon:.5f}",
+                        "location": {"lat": lat, "lng": lon},
+                        "date": "2023-06",
+                    })
+                return self._send(200, cfg.image_bytes, ctype="image/jpeg")
+            if service == "nominatim":
+                return self._send(200, {"display_name": f"Bench Road, {q.get('lat')}, {q.get('lon')}"})
+            if service == "gemini":
+                text = json.dumps(FAKE_ANALYSIS)
+                if random.random() < cfg.bad_json_rate:
+                    cfg.count(service, "bad_json")
+                    text = text[:len(text) // 2]   # cut off mid-object, like a truncated reply
+                elif b"responseSchema" not in body and b"response_schema" not in body:
+                    text = f"```json\n{text}\n```"  # what an unconstrained model tends to send
+                return self._send(200, {
+                    "candidates": [{
+                        "content": {"role": "model", "parts": [{"text": text}]},
+                        "finishReason": "STOP",
+                        "index": 0,
+                    }]
+                })
+            # Supabase
+            if url.path.startswith("/storage/v1/object/public/"):
+                return self._send(200, cfg.image_bytes, ctype="image/jpeg")
+            if url.path.startswith("/storage/v1/object/list/"):
+                return self._send(200, [])
+            if url.path.startswith("/storage/v1/object/"):
+                key = url.path[len("/storage/v1/object/"):]
+                return self._send(200, {"Key": key, "Id": str(uuid.uuid4())})
+            if url.path.startswith("/rest/v1/"):
+                try:
+                    rows = json.loads(body or b"[]")
+                except ValueError:
+                    rows = []
+                if isinstance(rows, dict):
+                    rows = [rows]
+                if self.command == "POST":
+                    rows = [dict(r, id=str(uuid.uuid4()), created_at=datetime.now(timezone.utc).isoformat()) for r in rows]
+                    return self._send(201, rows)
+                return self._send(200, rows if self.command == "PATCH" else [])
+            return self._send(404, {"error": "not found"})
+
+        do_GET = _handle
+        do_POST = _handle
+        do_PATCH = _handle
+        do_PUT = _handle
+
+    return Handler
+
+
+def start_stand_ins(cfg: StandInConfig, port: int = 0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(cfg))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def configure_env(base_url: str):
+    """Point every external client at the stand-in server. Must run before the pipeline modules are imported."""
+    os.environ["STREET_VIEW_BASE_URL"] = f"{base_url}/maps/api/streetview"
+    os.environ["NOMINATIM_URL"] = f"{base_url}/reverse"
+    os.environ["GEMINI_API_ENDPOINT"] = base_url
+    os.environ["SUPABASE_URL"] = base_url
+    os.environ["SUPABASE_KEY"] = FAKE_SUPABASE_KEY
+    os.environ["GOOGLE_MAPS_API_KEY"] = "bench"
+    os.environ["NADULAS_GEMINI_API_KEY"] = "bench"
+    os.environ.setdefault("DEDALUS_API_KEY", "bench")
+    # The stand-in has no usage policy; lift the Nominatim ceilings (see rate_control.py)
+    os.environ.setdefault("NOMINATIM_MAX_CONCURRENCY", "16")
+    os.environ.setdefault("NOMINATIM_MAX_PER_MINUTE", "1000000")
+
+
+# ---------------------------------------------------------------------------
+# Measurement helpers
+# ---------------------------------------------------------------------------
+
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def wrap(self, stage, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.samples[stage].append(time.perf_counter() - t0)
+        return timed
+
+    def summary(self):
+        out = {}
+        for stage, xs in self.samples.items():
+            xs = sorted(xs)
+            out[stage] = {
+                "count": len(xs),
+                "p50_ms": round(_percentile(xs, 50) * 1000, 2),
+                "p90_ms": round(_percentile(xs, 90) * 1000, 2),
+                "p99_ms": round(_percentile(xs, 99) * 1000, 2),
+                "max_ms": round(xs[-1] * 1000, 2),
+            }
+        return out
+
+
+def _percentile(sorted_xs, pct):
+    if not sorted_xs:
+        return 0.0
+    k = (len(sorted_xs) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_xs) - 1)
+    return sorted_xs[lo] + (sorted_xs[hi] - sorted_xs[lo]) * (k - lo)
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def _count_images(folder):
+    return sum(1 for f in os.listdir(folder) if f.lower().endswith((".jpg", ".jpeg", ".png")))
+
+
+# ---------------------------------------------------------------------------
+# Pipeline stages
+# ---------------------------------------------------------------------------
+
+def bench_downloader(timer, points, headings):
+    import street_view
+
+    street_view.request_with_retries = timer.wrap("streetview_request", street_view.request_with_retries)
+    out_dir = tempfile.mkdtemp(prefix="bench_dl_")
+    t0 = time.perf_counter()
+    street_view.run_downloader(
+        api_key="bench", points=points, output_dir=out_dir, headings=headings,
+    )
+    elapsed = time.perf_counter() - t0
+    n = _count_images(out_dir)
+    return out_dir, {"images": n, "seconds": round(elapsed, 3), "images_per_sec": round(n / elapsed, 2) if elapsed else None}
+
+
+def bench_detection(timer, images_dir, model_path, device):
+    try:
+        sys.path.insert(0, os.path.join(BACKEND_DIR, "CV_model"))
+        import cv as cv_model
+    except ImportError as e:
+        return {"skipped": f"detection dependencies unavailable: {e}"}
+    if not os.path.exists(model_path):
+        return {"skipped": f"model weights not found at {model_path}"}
+
+    cv_model.run_inference_batch = timer.wrap("detect_batch", cv_model.run_inference_batch)
+    out_dir = tempfile.mkdtemp(prefix="bench_cv_")
+    t0 = time.perf_counter()
+    df, _, _ = cv_model.detect_potholes(
+        images_dir=images_dir, model_path=model_path, device=device, outputs_dir=out_dir,
+    )
+    elapsed = time.perf_counter() - t0
+    n = len(df) if df is not None else _count_images(images_dir)
+    return {"images": n, "seconds": round(elapsed, 3), "images_per_sec": round(n / elapsed, 2) if elapsed else None}
+
+
+def _instrument_server(timer):
+    import server
+    import street_hazard_upload
+
+    if getattr(server, "_bench_instrumented", False):
+        return server
+    server.generate_folder_incremental = timer.wrap("download_folder", server.generate_folder_incremental)
+    server.coord_to_address = timer.wrap("geocode", server.coord_to_address)
+    from gemini_prompt import main as gemini
+
+    # The folder path analyzes through gemini.analyze_many, the stream path through server's import
+    server.analyze_hazard_image = gemini.analyze_hazard_image = timer.wrap("gemini_analyze", server.analyze_hazard_image)
+    street_hazard_upload.upload_local_file_to_supabase = timer.wrap(
+        "upload", street_hazard_upload.upload_local_file_to_supabase
+    )
+    server._bench_instrumented = True
+    return server
+
+
+def bench_survey(timer, bbox, grid_step):
+    server = _instrument_server(timer)
+
+    t0 = time.perf_counter()
+    server.process_survey_in_background(*bbox, grid_step)
+    elapsed = time.perf_counter() - t0
+    n = len(timer.samples.get("gemini_analyze", []))
+    return {"images": n, "seconds": round(elapsed, 3), "images_per_sec": round(n / elapsed, 2) if elapsed else None}
+
+
+def bench_gemini(image_bytes, n, max_in_flight, retries):
+    """analyze_many over n copies of the sample image: analyses/sec and how many replies were lost to parsing."""
+    from gemini_prompt import main as gemini
+
+    calls = defaultdict(int)
+    lock = threading.Lock()
+    original = gemini.analyze_hazard_bytes
+
+    def counted(image, location):
+        try:
+            result = original(image, location)
+        except Exception:
+            with lock:
+                calls["error"] += 1
+            raise
+        with lock:
+            calls["parse_error" if gemini.is_failed(result) else "ok"] += 1
+        return result
+
+    gemini.analyze_hazard_bytes = counted
+    try:
+        t0 = time.perf_counter()
+        results = gemini.analyze_many([(image_bytes, "Bench Road")] * n, max_in_flight=max_in_flight, retries=retries)
+        elapsed = time.perf_counter() - t0
+    finally:
+        gemini.analyze_hazard_bytes = original
+
+    total = sum(calls.values())
+    lost = sum(1 for r in results if gemini.is_failed(r))
+    return {
+        "analyses": n,
+        "max_in_flight": max_in_flight,
+        "calls": total,
+        "retried_calls": total - n,
+        "parse_errors": calls["parse_error"],
+        "call_errors": calls["error"],
+        "parse_failure_rate": round(calls["parse_error"] / total, 4) if total else None,
+        "lost": lost,
+        "lost_rate": round(lost / n, 4) if n else None,
+        "seconds": round(elapsed, 3),
+        "analyses_per_sec": round((n - lost) / elapsed, 2) if elapsed else None,
+    }
+
+
+def bench_tiled(timer, bbox, grid_step, worker_counts, n_tiles=None):
+    """
+    Sharded survey through a fresh TileStore with N in-process survey_worker loops per run.
+    Workers here share this process's upstream limiters; separate nodes would not.
+    """
+    import survey_worker
+    from survey_tiles import TileStore, partition_survey
+
+    _instrument_server(timer)
+    runs = []
+    for n in worker_counts:
+        db_dir = tempfile.mkdtemp(prefix="bench_tiles_")
+        store = TileStore(os.path.join(db_dir, "tiles.db"))
+        survey_id = f"bench-{uuid.uuid4().hex[:8]}"
+        tiles = partition_survey(*bbox, grid_step, n_tiles or max(worker_counts) * 4)
+        store.create_survey(survey_id, {"grid_step": grid_step}, tiles)
+        before = len(timer.samples.get("gemini_analyze", []))
+
+        t0 = time.perf_counter()
+        threads = [
+            threading.Thread(target=survey_worker.work, args=(f"bench-{i}", survey_id, True),
+                             kwargs={"store": store})
+            for i in range(n)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+
+        images = len(timer.samples.get("gemini_analyze", [])) - before
+        by_status = store.status(survey_id)["tiles_by_status"]
+        runs.append({
+            "workers": n,
+            "tiles": len(tiles),
+            "images": images,
+            "seconds": round(elapsed, 3),
+            "images_per_sec": round(images / elapsed, 2) if elapsed else None,
+            "tiles_by_status": by_status,
+            # Failed or expired tiles did less (or repeated) work, so throughput is not comparable
+            "complete": by_status.get("done", 0) == len(tiles),
+        })
+        print(json.dumps(runs[-1]))
+    # Scaling only between complete runs, against the first complete one
+    base_run = next((r for r in runs if r["complete"] and r["images_per_sec"]), None)
+    for r in runs:
+        if base_run is None or not r["complete"]:
+            r["scaling"] = None
+            continue
+        r["scaling"] = round(r["images_per_sec"] / base_run["images_per_sec"] / (r["workers"] / base_run["workers"]), 2)
+    incomplete = [r["workers"] for r in runs if not r["complete"]]
+    if incomplete:
+        print(f"Runs with {incomplete} workers left tiles unfinished; excluded from scaling")
+    return {"runs": runs, "baseline_workers": base_run["workers"] if base_run else None}
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def _parse_kv(pairs, name):
+    out = {}
+    for pair in pairs or []:
+        if "=" not in pair:
+            raise SystemExit(f"--{name} expects service=value pairs, got {pair!r}")
+        k, v = pair.split("=", 1)
+        if k not in SERVICES:
+            raise SystemExit(f"--{name}: unknown service {k!r} (choose from {', '.join(SERVICES)})")
+        out[k] = float(v)
+    return out
+
+
+def compare_results(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'metric':45} {'old':>12} {'new':>12} {'change':>9}")
+    for stage in ("downloader", "detection", "survey"):
+        a = (old["stages"].get(stage) or {}).get("images_per_sec")
+        b = (new["stages"].get(stage) or {}).get("images_per_sec")
+        if a and b:
+            print(f"{stage + ' images/sec':45} {a:>12} {b:>12} {(b - a) / a:>+9.1%}")
+    for stage in sorted(set(old["latency"]) | set(new["latency"])):
+        a = old["latency"].get(stage, {}).get("p90_ms")
+        b = new["latency"].get(stage, {}).get("p90_ms")
+        if a and b:
+            print(f"{stage + ' p90 ms':45} {a:>12} {b:>12} {(b - a) / a:>+9.1%}")
+    a, b = old.get("peak_rss_mb"), new.get("peak_rss_mb")
+    if a and b:
+        print(f"{'peak RSS MB':45} {a:>12} {b:>12} {(b - a) / a:>+9.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark with local service stand-ins.")
+    parser.add_argument("--bbox", type=float, nargs=4, default=[38.928, 38.934, -75.45, -75.43],
+                        metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"))
+    parser.add_argument("--grid_step", type=float, default=0.002)
+    parser.add_argument("--headings", type=int, nargs="*", default=[0, 90, 180, 270])
+    parser.add_argument("--latency", nargs="*", help="Per-service latency in ms, e.g. gemini=800")
+    parser.add_argument("--error_rate", nargs="*", help="Per-service 5xx probability, e.g. nominatim=0.02")
+    parser.add_argument("--rate_429", nargs="*", help="Per-service 429 probability, e.g. gemini=0.05")
+    parser.add_argument("--retry_after", type=int, default=1, help="Retry-After seconds on stand-in 429s")
+    parser.add_argument("--sample_image", default=None, help="JPEG served as every Street View image")
+    parser.add_argument("--stages", nargs="*", default=["downloader", "detection", "survey"],
+                        choices=["downloader", "detection", "survey", "tiled", "gemini"])
+    parser.add_argument("--analyses", type=int, default=200, help="Analyses for the gemini stage")
+    parser.add_argument("--gemini_in_flight", type=int, default=8, help="max_in_flight for the gemini stage")
+    parser.add_argument("--gemini_retries", type=int, default=1, help="Retry rounds for the gemini stage")
+    parser.add_argument("--bad_json_rate", type=float, default=0.0,
+                        help="Probability the Gemini stand-in returns a truncated, unparseable reply")
+    parser.add_argument("--tile_workers", type=int, nargs="*", default=[1, 2, 4],
+                        help="Worker counts for the tiled stage")
+    parser.add_argument("--tiles", type=int, default=None, help="Tiles for the tiled stage (default 4x max workers)")
+    parser.add_argument("--model_path", default=os.path.join(BACKEND_DIR, "CV_model", "best.pt"))
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="Write results JSON here")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    random.seed(args.seed)
+    sample = args.sample_image
+    if not sample:
+        nj = os.path.join(BACKEND_DIR, "nj_images")
+        sample = os.path.join(nj, next(f for f in sorted(os.listdir(nj)) if f.endswith(".jpg")))
+    with open(sample, "rb") as f:
+        image_bytes = f.read()
+
+    cfg = StandInConfig(
+        latency_ms=_parse_kv(args.latency, "latency"),
+        error_rate=_parse_kv(args.error_rate, "error_rate"),
+        rate_429=_parse_kv(args.rate_429, "rate_429"),
+        retry_after=args.retry_after,
+        image_bytes=image_bytes,
+        bad_json_rate=args.bad_json_rate,
+    )
+    server, base_url = start_stand_ins(cfg)
+    configure_env(base_url)
+    sys.path.insert(0, BACKEND_DIR)
+
+    from street_view import generate_grid
+    points = generate_grid(tuple(args.bbox), args.grid_step)
+
+    timer = StageTimer()
+    stages = {}
+    images_dir = None
+    if "downloader" in args.stages:
+        images_dir, stages["downloader"] = bench_downloader(timer, points, args.headings)
+    if "detection" in args.stages:
+        stages["detection"] = bench_detection(timer, images_dir or os.path.join(BACKEND_DIR, "nj_images"),
+                                              args.model_path, args.device)
+    if "survey" in args.stages:
+        stages["survey"] = bench_survey(timer, args.bbox, args.grid_step)
+    if "gemini" in args.stages:
+        stages["gemini"] = bench_gemini(image_bytes, args.analyses, args.gemini_in_flight, args.gemini_retries)
+    if "tiled" in args.stages:
+        stages["tiled"] = bench_tiled(timer, args.bbox, args.grid_step, args.tile_workers, args.tiles)
+    server.shutdown()
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "bbox": args.bbox,
+            "grid_step": args.grid_step,
+            "points": len(points),
+            "headings": args.headings,
+            "latency_ms": cfg.latency_ms,
+            "error_rate": cfg.error_rate,
+            "rate_429": cfg.rate_429,
+            "bad_json_rate": cfg.bad_json_rate,
+        },
+        "stages": stages,
+        "latency": timer.summary(),
+        "stand_in_requests": {s: dict(c) for s, c in cfg.counts.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(json.dumps(result, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,31 @@
+import os
 import requests
 
+import metrics
+from rate_control import get_limiter
+
+NOMINATIM_URL = os.getenv("NOMINATIM_URL", "https://nominatim.openstreetmap.org/reverse")
+
 def coord_to_address(lat, lon):
     """Convert coordinates to address using OpenStreetMap Nominatim API safely."""
-    url = f"https://nominatim.openstreetmap.org/reverse?format=jsonv2&lat={lat}&lon={lon}"
+    url = f"{NOMINATIM_URL}?format=jsonv2&lat={lat}&lon={lon}"
     headers = {
         # Nominatim requires a user-agent or it may reject the request
         "User-Agent": "HazardDetectionApp/1.0 (contact@example.com)"
     }
 
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        with metrics.timed("geocode"), get_limiter("nominatim").call() as call:
+            response = requests.get(url, headers=headers, timeout=10)
+            if response.status_code == 429 or response.status_code >= 500:
+                call.throttled(response.headers.get("Retry-After"))
         response.raise_for_status()
     except requests.RequestException as e:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        metrics.record_call("nominatim", "429" if status == 429 else "error")
         print(f"[coord_to_address] Network or HTTP error: {e}")
         return "Address lookup failed"
+    metrics.record_call("nominatim", "ok")
 
     # Try parsing JSON safely
     try:
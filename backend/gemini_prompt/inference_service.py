@@ -0,0 +1,232 @@
+"""
+inference_service.py
+Long-running local pothole detection service used by model_tool.process_image.
+
+Holds the YOLO model once and collects concurrent requests into dynamic batches: a
+batch is run as soon as it has INFERENCE_MAX_BATCH images, or INFERENCE_MAX_WAIT_MS
+after its first image arrived, whichever comes first.
+
+    POST /detect  {"image_path": "/abs/path.jpg", "annotate": false}
+                  -> {"summary", "count", "detections", "annotated_image"}
+    GET  /health  -> {"ok": true, "batches": ..., "images": ..., "avg_batch": ...}
+
+Usage (from the repo root):
+    python backend/gemini_prompt/inference_service.py
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ultralytics import YOLO
+
+# Shared helpers from CV_model/cv.py (road cascade)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CV_model"))
+from cv import DEFAULT_ROAD_THRESHOLD, RoadFilter, load_inference_config
+
+HOST = os.getenv("INFERENCE_SERVICE_HOST", "127.0.0.1")
+PORT = int(os.getenv("INFERENCE_SERVICE_PORT", "8765"))
+CONF_THRESH = 0.5
+
+# Tuned settings written by CV_model/autotune.py (model_path, imgsz, threads, batch, ...)
+_config = load_inference_config()
+IMGSZ = int(_config.get("imgsz", 640))
+MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH") or _config.get("batch") or 8)
+MAX_WAIT_S = float(os.getenv("INFERENCE_MAX_WAIT_MS") or 10) / 1000
+DEVICE = _config.get("device")   # None = let ultralytics pick
+
+
+def load_model():
+    if _config.get("threads"):
+        import torch
+        torch.set_num_threads(int(_config["threads"]))
+    model_path = _config.get("model_path")
+    if not model_path or not os.path.exists(model_path):
+        model_path = os.path.join(os.path.dirname(__file__), "best.pt")
+    return YOLO(model_path)
+
+
+def summarize(results, model, image_path, annotate) -> dict:
+    """Detection dict for one Ultralytics result (the process_image response format)."""
+    potholes = []
+    for box in results.boxes:
+        x1, y1, x2, y2 = map(float, box.xyxy[0])   # bounding box
+        conf = float(box.conf[0])                  # confidence
+        cls_id = int(box.cls[0])                   # class index
+        cls_name = model.names[cls_id]             # e.g., "pothole"
+
+        potholes.append({
+            "bbox": [x1, y1, x2, y2],
+            "conf": conf,
+            "cls": cls_name
+        })
+
+    # Create a human-friendly summary
+    n = len(potholes)
+    if n == 0:
+        summary = "No potholes detected."
+    elif n == 1:
+        summary = "Detected 1 pothole."
+    else:
+        summary = f"Detected {n} potholes."
+
+    annotated_path = None
+    if annotate:
+        annotated_path = os.path.splitext(image_path)[0] + "_annotated.jpg"
+        results.save(filename=annotated_path)
+
+    return {
+        "summary": summary,
+        "count": n,
+        "detections": potholes,
+        "annotated_image": annotated_path
+    }
+
+
+class _Pending:
+    def __init__(self, image_path, annotate):
+        self.image_path = image_path
+        self.annotate = annotate
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Batcher:
+    """Runs queued requests through the model in batches of up to max_batch, waiting at most max_wait."""
+
+    def __init__(self, model, max_batch: int = MAX_BATCH, max_wait: float = MAX_WAIT_S):
+        self.model = model
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.images = 0
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, image_path: str, annotate: bool = False) -> dict:
+        item = _Pending(image_path, annotate)
+        self.requests.put(item)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, batch):
+        results = self.model.predict(
+            [item.image_path for item in batch], conf=CONF_THRESH, imgsz=IMGSZ, batch=len(batch), device=DEVICE,
+            verbose=False
+        )
+        for item, r in zip(batch, results):
+            item.result = summarize(r, self.model, item.image_path, item.annotate)
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._run(batch)
+            except Exception:
+                # One unreadable image fails the whole predict call; retry one by one
+                for item in batch:
+                    try:
+                        self._run([item])
+                    except Exception as e:
+                        item.error = e
+            self.batches += 1
+            self.images += len(batch)
+            for item in batch:
+                item.done.set()
+
+
+def make_handler(batcher, road_filter=None):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self._send(404, {"error": "not found"})
+            self._send(200, {
+                "ok": True,
+                "batches": batcher.batches,
+                "images": batcher.images,
+                "avg_batch": round(batcher.images / batcher.batches, 2) if batcher.batches else None,
+                "road_filter_skipped": road_filter.skipped if road_filter else 0,
+            })
+
+        def do_POST(self):
+            if self.path != "/detect":
+                return self._send(404, {"error": "not found"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                image_path = body["image_path"]
+            except (ValueError, KeyError):
+                return self._send(400, {"error": "expected JSON body with 'image_path'"})
+            if not os.path.exists(image_path):
+                return self._send(400, {"error": f"File not found: {image_path}"})
+            try:
+                result = detect(batcher, road_filter, image_path, bool(body.get("annotate", False)))
+            except Exception as e:
+                return self._send(500, {"error": str(e)})
+            self._send(200, result)
+
+    return Handler
+
+
+def make_road_filter():
+    return RoadFilter(DEFAULT_ROAD_THRESHOLD) if DEFAULT_ROAD_THRESHOLD is not None else None
+
+
+def detect(batcher, road_filter, image_path: str, annotate: bool = False) -> dict:
+    """One /detect request: road check, then the batched detector."""
+    # Cheap pavement check before YOLO; POTHOLE_ROAD_THRESHOLD unset = always run the detector
+    if road_filter is not None and not road_filter.keep(image_path):
+        return {
+            "summary": "No road surface visible; detection skipped.",
+            "count": 0,
+            "detections": [],
+            "annotated_image": None,
+            "skipped": True,
+        }
+    return batcher.submit(image_path, annotate)
+
+
+def main():
+    batcher = Batcher(load_model())
+    road_filter = make_road_filter()
+    server = ThreadingHTTPServer((HOST, PORT), make_handler(batcher, road_filter))
+    server.daemon_threads = True
+    print(f"Inference service on http://{HOST}:{PORT} (max batch {batcher.max_batch}, "
+          f"max wait {batcher.max_wait * 1000:.0f} ms)")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,62 +1,182 @@
 import google.generativeai as genai
 import requests
 from dotenv import load_dotenv
+import asyncio
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from image_payload import maybe_normalize
+from per_process import PerProcess
+from rate_control import get_limiter
 
 load_dotenv()  # Load environment variables from .env file
 
 
 # Configure Gemini API key once
-genai.configure(api_key=os.getenv("NADULAS_GEMINI_API_KEY"))
+# GEMINI_API_ENDPOINT (e.g. a local stand-in) switches the client to REST against that host
+if os.getenv("GEMINI_API_ENDPOINT"):
+    genai.configure(
+        api_key=os.getenv("NADULAS_GEMINI_API_KEY"),
+        transport="rest",
+        client_options={"api_endpoint": os.getenv("GEMINI_API_ENDPOINT")},
+    )
+else:
+    genai.configure(api_key=os.getenv("NADULAS_GEMINI_API_KEY"))
+
+def _is_throttle_error(e: Exception) -> bool:
+    """429 / 5xx from the Gemini client (google.api_core exceptions or REST errors)."""
+    code = getattr(e, "code", None)
+    code = getattr(code, "value", code)
+    if isinstance(code, int):
+        return code == 429 or code >= 500
+    return type(e).__name__ in ("ResourceExhausted", "ServiceUnavailable", "InternalServerError", "DeadlineExceeded")
+
+# Schema-constrained output: the model must answer with exactly this object, so the
+# reply is parsed with one json.loads instead of hoping the prompt is followed
+HAZARD_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "hazard_type": {"type": "STRING"},
+        "severity": {"type": "NUMBER"},
+        "location_context": {"type": "STRING"},
+        "description": {"type": "STRING"},
+        "projected_repair_cost": {"type": "NUMBER"},
+        "projected_worsening": {"type": "STRING", "enum": ["none", "slow", "moderate", "rapid"]},
+        "future_worsening_description": {"type": "STRING"},
+    },
+    "required": [
+        "hazard_type", "severity", "location_context", "description",
+        "projected_repair_cost", "projected_worsening", "future_worsening_description",
+    ],
+}
+
+SYSTEM_PROMPT = """
+Analyze the road image. The user message gives the location to use.
+location_context = short description of surroundings (e.g., “residential area”, “highway”), not an address.
+description = detailed description of the hazard and its dangers.
+severity: 0–10, based on realistic danger (no exaggeration).
+projected_worsening: "none", "slow", "moderate", or "rapid".
+projected_repair_cost: estimated from severity and typical repair costs.
+future_worsening_description: realistic description of how the hazard might worsen over time.
+
+If the image is not a real road or clear safety hazard, set description to an empty string.
+hazard_type: choose from pothole, flooding, debris, damaged_signage; otherwise use your own label.
+"""
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+# Upper bound on concurrent calls from analyze_many; the gemini limiter may allow fewer
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", "8"))
+PARSE_ERROR = "Model did not return valid JSON"
+
+# One model (and underlying client) per process, reused by every call
+_model = PerProcess(lambda: genai.GenerativeModel(
+    GEMINI_MODEL,
+    system_instruction=SYSTEM_PROMPT,
+    generation_config={"response_mime_type": "application/json", "response_schema": HAZARD_SCHEMA},
+))
+
+def _parse(text: str):
+    """Parsed reply dict, or None. Tolerates markdown fences / stray prose around the object."""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        # Only reached if the model ignored the response schema: take the outermost {...}
+        start, end = text.find("{"), text.rfind("}")
+        if start < 0 or end <= start:
+            return None
+        try:
+            data = json.loads(text[start:end + 1])
+        except ValueError:
+            return None
+    if isinstance(data, list) and len(data) == 1:
+        data = data[0]
+    return data if isinstance(data, dict) else None
 
 def analyze_hazard_image(url: str, location: str) -> dict:
     """Analyzes a road hazard image via Gemini 2.5 Flash and returns parsed JSON."""
     
     # 1. Fetch image bytes
-    resp = requests.get(url)
+    with metrics.timed("gemini_fetch_image"):
+        resp = requests.get(url)
     resp.raise_for_status()
-    
-    # 2. Prepare model and prompt
-    model = genai.GenerativeModel("gemini-2.5-flash")
-
-    prompt = f"""
-    Analyze the road image and output only valid JSON.
-
-    Use {location} for the location.
-    location_context = short description of surroundings (e.g., “residential area”, “highway”), not an address.
-    description = detailed description of the hazard and its dangers.
-    severity: 0–10, based on realistic danger (no exaggeration).
-    projected_worsening: "none", "slow", "moderate", or "rapid".
-    projected_repair_cost: estimated from severity and typical repair costs.
-    future_worsening_description: realistic description of how the hazard might worsen over time.
-
-    If the image is not a real road or clear safety hazard, return an error (not JSON).
-    hazard_type: choose from pothole, flooding, debris, damaged_signage; otherwise use your own label.
-
-    JSON schema:
-    {{
-      "hazard_type": string,
-      "severity": number,
-      "location_context": string,
-      "description": string,
-      "projected_repair_cost": number,
-      "projected_worsening": string,
-      "future_worsening_description": string
-    }}
-    Return only JSON — no markdown or explanations.
-    """
 
-    # 3. Generate content
-    result = model.generate_content([
-        {"text": prompt},
-        {"inline_data": {"mime_type": "image/jpeg", "data": resp.content}}
-    ])
+    # User photos arrive full size with EXIF; survey uploads are already normalized and pass through
+    return analyze_hazard_bytes(maybe_normalize(resp.content, url), location)
 
-    # 4. Try parsing the result into JSON
+def analyze_hazard_bytes(image: bytes, location: str) -> dict:
+    """analyze_hazard_image for JPEG bytes already in memory."""
+
+    # 2. Generate content (instructions and schema live on the shared model)
+    try:
+        with metrics.timed("gemini_analyze"), get_limiter("gemini").call() as call:
+            try:
+                result = _model.generate_content([
+                    {"text": f"Location: {location}"},
+                    {"inline_data": {"mime_type": "image/jpeg", "data": image}}
+                ])
+            except Exception as e:
+                if _is_throttle_error(e):
+                    call.throttled()
+                raise
+    except Exception as e:
+        metrics.record_call("gemini", "429" if "429" in str(e) or "ResourceExhausted" in type(e).__name__ else "error")
+        raise
+    metrics.record_call("gemini", "ok")
+
+    # 3. Parse the result
+    try:
+        text = result.text
+    except ValueError:
+        # No text part at all (e.g. blocked by safety filters)
+        text = ""
+    data = _parse(text)
+    if data is None:
+        metrics.inc("pothole_gemini_results_total", {"outcome": "parse_error"})
+        return {"error": PARSE_ERROR, "raw_output": text}
+    desc = data.get("description")
+    no_hazard = not isinstance(desc, str) or not desc.strip()
+    metrics.inc("pothole_gemini_results_total", {"outcome": "no_hazard" if no_hazard else "ok"})
+    return data
+
+def is_failed(result) -> bool:
+    """True for an analyze_many result worth retrying: an exception or an unparseable reply."""
+    return isinstance(result, Exception) or (isinstance(result, dict) and result.get("error") == PARSE_ERROR)
+
+def _analyze_one(item):
+    image, location = item
     try:
-        import json
-        data = json.loads(result.text)
-        return data
-    except Exception:
-        # Return raw text if JSON parse fails
-        return {"error": "Model did not return valid JSON", "raw_output": result.text}
+        if isinstance(image, (bytes, bytearray)):
+            return analyze_hazard_bytes(image, location)
+        return analyze_hazard_image(image, location)
+    except Exception as e:
+        return e
+
+def analyze_many(items, max_in_flight: int = GEMINI_MAX_IN_FLIGHT, retries: int = 1) -> list:
+    """
+    Analyze [(url_or_jpeg_bytes, location), ...] with at most max_in_flight calls in flight.
+
+    Returns one result per item, in input order: the analysis dict, or for an item that
+    still failed after `retries` extra rounds, its exception / parse-error dict. Each retry
+    round only re-sends the items that failed in the previous one.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = list(range(len(items)))
+    analyze_one = metrics.bind_trace(_analyze_one)
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as pool:
+        for attempt in range(retries + 1):
+            if attempt:
+                metrics.inc("pothole_gemini_retries_total", value=len(pending))
+            for i, result in zip(pending, pool.map(analyze_one, [items[i] for i in pending])):
+                results[i] = result
+            pending = [i for i in pending if is_failed(results[i])]
+            if not pending:
+                break
+    metrics.inc("pothole_gemini_lost_total", value=len(pending))
+    return results
+
+async def analyze_many_async(items, max_in_flight: int = GEMINI_MAX_IN_FLIGHT, retries: int = 1) -> list:
+    """analyze_many for callers on an event loop; the calls themselves run on its bounded thread pool."""
+    return await asyncio.to_thread(analyze_many, items, max_in_flight, retries)
@@ -1,50 +1,66 @@
 """
 model_tool.py
 This file defines your image-processing tool(s) for Dedalus.
+
+Detection runs in the local inference service (inference_service.py), which holds the
+model once and batches concurrent requests. When the service is not reachable, the model
+is loaded into this process instead (once, with the same batching), unless
+INFERENCE_LOCAL_FALLBACK=0, in which case process_image raises with instructions.
 """
 
-from ultralytics import YOLO
 import os
+import sys
+import threading
+
+import requests
+
+INFERENCE_SERVICE_URL = os.getenv(
+    "INFERENCE_SERVICE_URL",
+    f"http://{os.getenv('INFERENCE_SERVICE_HOST', '127.0.0.1')}:{os.getenv('INFERENCE_SERVICE_PORT', '8765')}",
+)
+
+LOCAL_FALLBACK = os.getenv("INFERENCE_LOCAL_FALLBACK", "1").lower() not in ("0", "false", "no")
+
+_session = requests.Session()
+_local = None
+_local_lock = threading.Lock()
+
+def _detect_locally(image_path: str, annotate: bool) -> dict:
+    """In-process detection with the inference service's model, batcher and road filter."""
+    global _local
+    with _local_lock:
+        if _local is None:
+            print(f"[model_tool] inference service not reachable at {INFERENCE_SERVICE_URL}; "
+                  "loading the model in-process")
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            import inference_service
+
+            _local = (inference_service, inference_service.Batcher(inference_service.load_model()),
+                      inference_service.make_road_filter())
+    service, batcher, road_filter = _local
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(image_path)
+    return service.detect(batcher, road_filter, image_path, annotate)
 
-# ✅ Load your YOLO model once (so it doesn't reload every time)
-# Make sure best.pt is in the same folder or give full path
-model = YOLO(os.path.join(os.path.dirname(__file__), "best.pt"))
-
-def process_image(image_path: str) -> dict:
-    # Run YOLO inference
-    results = model(image_path, conf=0.5)[0]  # first (and only) batch
-    potholes = []
-
-    # Loop over all bounding boxes
-    for box in results.boxes:
-        x1, y1, x2, y2 = map(float, box.xyxy[0])   # bounding box
-        conf = float(box.conf[0])                  # confidence
-        cls_id = int(box.cls[0])                   # class index
-        cls_name = model.names[cls_id]             # e.g., "pothole"
-
-        potholes.append({
-            "bbox": [x1, y1, x2, y2],
-            "conf": conf,
-            "cls": cls_name
-        })
-
-    # Create a human-friendly summary
-    n = len(potholes)
-    if n == 0:
-        summary = "No potholes detected."
-    elif n == 1:
-        summary = "Detected 1 pothole."
-    else:
-        summary = f"Detected {n} potholes."
-
-    # Optional: save annotated image (for your dashboard or website)
-    annotated_path = os.path.splitext(image_path)[0] + "_annotated.jpg"
-    annotated_image = results.plot()
-    results.save(filename=annotated_path)
-
-    return {
-        "summary": summary,
-        "count": n,
-        "detections": potholes,
-        "annotated_image": annotated_path
-    }
+def process_image(image_path: str, annotate: bool = False) -> dict:
+    """Detect potholes in a local image; with annotate=True an annotated copy is saved next to it."""
+    image_path = os.path.abspath(image_path)
+    if _local is not None:
+        return _detect_locally(image_path, annotate)
+    try:
+        resp = _session.post(
+            f"{INFERENCE_SERVICE_URL}/detect",
+            json={"image_path": image_path, "annotate": annotate},
+            timeout=120,
+        )
+    except requests.ConnectionError as e:
+        if LOCAL_FALLBACK:
+            return _detect_locally(image_path, annotate)
+        raise RuntimeError(
+            f"Inference service not reachable at {INFERENCE_SERVICE_URL}; "
+            "start it with: python backend/gemini_prompt/inference_service.py "
+            "(or set INFERENCE_LOCAL_FALLBACK=1 to load the model in-process)"
+        ) from e
+    if resp.status_code != 200:
+        raise RuntimeError(f"Inference service error ({resp.status_code}): {resp.text[:200]}")
+    return resp.json()
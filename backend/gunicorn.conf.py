@@ -0,0 +1,92 @@
+"""
+gunicorn.conf.py
+Production serving for server.py: a pre-forking gunicorn with shared preloaded state.
+
+    cd backend && gunicorn -c gunicorn.conf.py
+
+With SERVER_PRELOAD on, the master calls server.create_app(), which runs
+preload_shared_state() (road index, upload/payload indexes, YOLO weights), before forking,
+then freezes the GC so workers keep those pages shared copy-on-write. Network clients are
+created lazily inside each worker. Each worker logs its cold start and RSS/PSS/private
+memory, also exported on its /metrics.
+
+Graceful reload: `kill -HUP <master>` starts fresh workers and lets the old ones finish.
+An old worker stops accepting requests but keeps running (and heartbeating) until its
+in-flight surveys finish, for at most SERVER_GRACEFUL_TIMEOUT. With preload on, HUP
+re-forks from the already loaded master, so to deploy new code send USR2 (new master)
+and then QUIT the old one.
+
+    SERVER_BIND=0.0.0.0:5001   SERVER_WORKERS=4   SERVER_THREADS=8
+    SERVER_PRELOAD=1           SERVER_GRACEFUL_TIMEOUT=1800
+"""
+
+import gc
+import os
+import time
+
+from gunicorn.workers.gthread import ThreadWorker
+
+bind = os.getenv("SERVER_BIND", "0.0.0.0:5001")
+workers = int(os.getenv("SERVER_WORKERS", "4"))
+threads = int(os.getenv("SERVER_THREADS", "8"))
+preload_app = os.getenv("SERVER_PRELOAD", "1").lower() not in ("0", "false", "no")
+wsgi_app = "server:create_app()"
+timeout = 120
+graceful_timeout = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "1800"))
+
+# The config is read before the app is loaded, so this also covers the preload
+_started = time.perf_counter()
+
+
+class SurveyDrainingWorker(ThreadWorker):
+    """gthread worker that, once told to stop, keeps heartbeating until its surveys are done."""
+
+    def run(self):
+        super().run()
+        import server as backend_server
+
+        deadline = time.monotonic() + graceful_timeout
+        running = backend_server.wait_for_surveys(0)
+        if running:
+            self.log.info("worker %s waiting for %d in-flight survey(s)", self.pid, running)
+        while running and time.monotonic() < deadline:
+            self.notify()
+            running = backend_server.wait_for_surveys(min(5.0, timeout / 4))
+        if running:
+            self.log.warning("worker %s exiting with %d survey(s) unfinished", self.pid, running)
+
+
+worker_class = SurveyDrainingWorker
+
+
+def when_ready(arbiter):
+    import metrics
+    from per_process import memory_usage
+
+    if preload_app:
+        # Preloaded objects live for the whole process; keep the GC from touching (and copying) them
+        gc.freeze()
+    mem = memory_usage()
+    elapsed = time.perf_counter() - _started
+    metrics.set_gauge("pothole_cold_start_seconds", elapsed, {"phase": "master"})
+    arbiter.log.info("master ready in %.2fs (preload=%s), rss %.0f MB", elapsed, preload_app, (mem["rss"] or 0) / 1e6)
+
+
+def post_fork(arbiter, worker):
+    worker._forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    import metrics
+    from per_process import memory_usage
+
+    elapsed = time.perf_counter() - worker._forked_at
+    mem = memory_usage()
+    metrics.set_gauge("pothole_cold_start_seconds", elapsed, {"phase": "worker"})
+    for kind, value in mem.items():
+        if value is not None:
+            metrics.set_gauge("pothole_process_memory_bytes", value, {"kind": kind})
+    worker.log.info(
+        "worker %s ready in %.2fs after fork: rss %.0f MB, pss %.0f MB, private %.0f MB",
+        worker.pid, elapsed, (mem["rss"] or 0) / 1e6, (mem["pss"] or 0) / 1e6, (mem["private"] or 0) / 1e6,
+    )
@@ -0,0 +1,229 @@
+"""
+image_payload.py
+Shrink images before they are uploaded to Supabase or sent to Gemini.
+
+normalize_bytes() decodes an image, applies its EXIF orientation, optionally crops it to
+the road region (the bottom part of the frame), downsizes it so its longest side is at
+most IMAGE_MAX_DIM and re-encodes it as JPEG at IMAGE_JPEG_QUALITY with no metadata.
+An image that needs none of that and would not get smaller is passed through unchanged.
+
+Every derived image is recorded in the PayloadMap (original sha256 -> derived sha256,
+sizes, settings), so a stored object can be traced back to the bytes it came from and an
+already-normalized image is never re-encoded a second time. Passthrough images are
+recorded too (derived == original), so the Gemini fetch of an uploaded survey image is
+not decoded and re-encoded again. The map keeps the newest IMAGE_PAYLOAD_MAP_MAX entries
+in memory and compacts its file once it holds twice that many lines.
+
+The stage is opt-in:
+
+    IMAGE_NORMALIZE=1          turn the stage on (default off)
+    IMAGE_MAX_DIM=1280         longest side in pixels (0 = no resize)
+    IMAGE_JPEG_QUALITY=85
+    IMAGE_ROAD_CROP=0.0        crop away this fraction of the frame from the top (0 = off)
+    IMAGE_NORMALIZE_WORKERS=4  pool size for normalize_files()
+    IMAGE_PAYLOAD_MAP_MAX=100000
+"""
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from PIL import Image, ImageOps
+
+import metrics
+
+NORMALIZE_ENABLED = os.getenv("IMAGE_NORMALIZE", "0").lower() in ("1", "true", "yes")
+MAX_DIM = int(os.getenv("IMAGE_MAX_DIM", "1280"))
+JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+ROAD_CROP = float(os.getenv("IMAGE_ROAD_CROP", "0") or 0)
+NORMALIZE_WORKERS = int(os.getenv("IMAGE_NORMALIZE_WORKERS", "4"))
+PAYLOAD_MAP_PATH = os.getenv(
+    "IMAGE_PAYLOAD_MAP_PATH", os.path.join(os.path.dirname(__file__), ".payload_map.jsonl")
+)
+PAYLOAD_MAP_MAX = int(os.getenv("IMAGE_PAYLOAD_MAP_MAX", "100000"))
+
+
+class PayloadMap:
+    """JSONL record of original -> derived images, keyed by derived sha256; keeps the newest max_entries."""
+
+    def __init__(self, path: str = PAYLOAD_MAP_PATH, max_entries: int = PAYLOAD_MAP_MAX):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._by_derived = OrderedDict()
+        self._lines = 0
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._by_derived[entry["derived_sha256"]] = entry
+                        self._by_derived.move_to_end(entry["derived_sha256"])
+                        self._lines += 1
+                        if len(self._by_derived) > self.max_entries:
+                            self._by_derived.popitem(last=False)
+
+    def is_derived(self, sha: str) -> bool:
+        with self._lock:
+            return sha in self._by_derived
+
+    def original_of(self, sha: str) -> Optional[dict]:
+        with self._lock:
+            return self._by_derived.get(sha)
+
+    def add(self, entry: dict):
+        with self._lock:
+            if entry["derived_sha256"] in self._by_derived:
+                return
+            self._by_derived[entry["derived_sha256"]] = entry
+            if len(self._by_derived) > self.max_entries:
+                self._by_derived.popitem(last=False)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self._lines += 1
+            if self._lines > 2 * self.max_entries:
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the file with just the entries kept in memory (caller holds the lock)."""
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".",
+                                        dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                for entry in self._by_derived.values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp_path, self.path)
+            self._lines = len(self._by_derived)
+        except OSError as e:
+            print(f"[image_payload] compacting {self.path} failed ({e})")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+_map: Optional[PayloadMap] = None
+_map_lock = threading.Lock()
+
+def get_payload_map() -> PayloadMap:
+    global _map
+    with _map_lock:
+        if _map is None:
+            _map = PayloadMap()
+        return _map
+
+
+class Normalized(NamedTuple):
+    data: bytes
+    changed: bool
+    original_bytes: int
+    derived_bytes: int
+    size: tuple            # (width, height) of the returned image, or None if undecodable
+
+
+def normalize_bytes(data: bytes, name: str = "", max_dim: int = MAX_DIM, quality: int = JPEG_QUALITY,
+                    road_crop: float = ROAD_CROP, record: bool = True) -> Normalized:
+    """Normalized copy of one encoded image; undecodable input comes back unchanged."""
+    original_sha = hashlib.sha256(data).hexdigest()
+    if record and get_payload_map().is_derived(original_sha):
+        return Normalized(data, False, len(data), len(data), None)
+
+    t0 = time.perf_counter()
+    try:
+        img = Image.open(io.BytesIO(data))
+        has_exif = bool(img.info.get("exif")) or bool(img.getexif())
+        is_jpeg = img.format == "JPEG"
+        img = ImageOps.exif_transpose(img)
+    except Exception as e:
+        print(f"[image_payload] {name or 'image'}: cannot decode ({e}); sending as-is")
+        return Normalized(data, False, len(data), len(data), None)
+
+    reshaped = False
+    if 0 < road_crop < 1:
+        w, h = img.size
+        img = img.crop((0, int(h * road_crop), w, h))
+        reshaped = True
+    if max_dim and max(img.size) > max_dim:
+        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        reshaped = True
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality, optimize=True)
+    derived = out.getvalue()
+    metrics.observe("image_normalize", time.perf_counter() - t0)
+
+    # Nothing to strip or shrink and the re-encode is no smaller: keep the original bytes,
+    # and remember them as final so the Gemini fetch of the uploaded copy skips all this
+    if not reshaped and not has_exif and is_jpeg and len(derived) >= len(data):
+        if record:
+            get_payload_map().add({
+                "name": name,
+                "original_sha256": original_sha,
+                "original_bytes": len(data),
+                "derived_sha256": original_sha,
+                "derived_bytes": len(data),
+                "width": img.size[0],
+                "height": img.size[1],
+                "passthrough": True,
+            })
+        return Normalized(data, False, len(data), len(data), img.size)
+
+    metrics.inc("pothole_image_payload_bytes_total", {"stage": "original"}, len(data))
+    metrics.inc("pothole_image_payload_bytes_total", {"stage": "derived"}, len(derived))
+    if record:
+        get_payload_map().add({
+            "name": name,
+            "original_sha256": original_sha,
+            "original_bytes": len(data),
+            "derived_sha256": hashlib.sha256(derived).hexdigest(),
+            "derived_bytes": len(derived),
+            "width": img.size[0],
+            "height": img.size[1],
+            "max_dim": max_dim,
+            "quality": quality,
+            "road_crop": road_crop,
+        })
+    return Normalized(derived, True, len(data), len(derived), img.size)
+
+
+def maybe_normalize(data: bytes, name: str = "") -> bytes:
+    """normalize_bytes(...).data when the stage is enabled, else data untouched."""
+    if not NORMALIZE_ENABLED:
+        return data
+    return normalize_bytes(data, name).data
+
+
+def normalize_file(path: str | Path, **kwargs) -> Path:
+    """Replace a local image by its normalized JPEG; returns the (possibly renamed) path."""
+    p = Path(path)
+    result = normalize_bytes(p.read_bytes(), p.name, **kwargs)
+    if not result.changed:
+        return p
+    target = p if p.suffix.lower() in (".jpg", ".jpeg") else p.with_suffix(".jpg")
+    target.write_bytes(result.data)
+    if target != p:
+        p.unlink()
+    return target
+
+
+def normalize_files(paths, max_workers: int = NORMALIZE_WORKERS, **kwargs) -> List[Path]:
+    """normalize_file over a thread pool, in input order; a file that fails is left as it was."""
+    def _one(path):
+        try:
+            return normalize_file(path, **kwargs)
+        except Exception as e:
+            print(f"[image_payload] {path}: normalize failed ({e}); keeping original")
+            return Path(path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(_one, paths))
@@ -0,0 +1,178 @@
+"""
+metrics.py
+In-process metrics and per-survey traces for the backend.
+
+Stage latencies go into fixed-bucket histograms, upstream call outcomes into counters,
+and queue depths / in-flight surveys into gauges. render() returns everything in the
+Prometheus text exposition format for the Flask /metrics endpoint.
+
+A survey thread can call start_trace(survey_id); every timed() block on that thread, or in
+a callable it wrapped with bind_trace() for a pool thread, is then also recorded as a span,
+retrievable with get_trace(survey_id).
+"""
+
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+# Seconds; spans everything from a cached lookup to a slow Gemini call
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MAX_TRACES = 50
+MAX_SPANS_PER_TRACE = 20000
+
+_lock = threading.Lock()
+_histograms = {}                 # stage -> [bucket counts..., +Inf count], sum
+_counters = defaultdict(float)   # (name, labels) -> value
+_gauges = defaultdict(float)     # (name, labels) -> value
+_traces = OrderedDict()          # survey_id -> {"started": ts, "spans": [...]}
+_local = threading.local()
+
+
+def _labels(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def observe(stage: str, seconds: float):
+    with _lock:
+        h = _histograms.get(stage)
+        if h is None:
+            h = _histograms[stage] = {"buckets": [0] * (len(BUCKETS) + 1), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h["buckets"][i] += 1
+                break
+        else:
+            h["buckets"][-1] += 1
+        h["sum"] += seconds
+        h["count"] += 1
+
+
+def inc(name: str, labels=None, value: float = 1):
+    with _lock:
+        _counters[(name, _labels(labels))] += value
+
+
+def set_gauge(name: str, value: float, labels=None):
+    with _lock:
+        _gauges[(name, _labels(labels))] = value
+
+
+def add_gauge(name: str, delta: float, labels=None):
+    with _lock:
+        _gauges[(name, _labels(labels))] += delta
+
+
+def record_call(api: str, outcome: str):
+    """Count one upstream call outcome: ok, error, retry or 429."""
+    inc("pothole_upstream_calls_total", {"api": api, "outcome": outcome})
+
+
+@contextmanager
+def timed(stage: str, **attrs):
+    """Time a block into the stage histogram (and the current survey trace, if any)."""
+    t0 = time.perf_counter()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        observe(stage, elapsed)
+        _add_span(stage, t0, elapsed, ok, attrs)
+
+
+# --- Traces ---
+
+def start_trace(survey_id):
+    if survey_id is None:
+        return
+    _local.survey_id = survey_id
+    with _lock:
+        _traces[survey_id] = {"started": time.time(), "t0": time.perf_counter(), "spans": []}
+        while len(_traces) > MAX_TRACES:
+            _traces.popitem(last=False)
+
+
+def end_trace():
+    _local.survey_id = None
+
+
+def bind_trace(fn):
+    """
+    fn wrapped to record its spans in the calling thread's survey trace, wherever it runs.
+    Wrap callables handed to thread pools; traces are per thread otherwise.
+    """
+    survey_id = getattr(_local, "survey_id", None)
+    if survey_id is None:
+        return fn
+
+    def run(*args, **kwargs):
+        previous = getattr(_local, "survey_id", None)
+        _local.survey_id = survey_id
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.survey_id = previous
+    return run
+
+
+def _add_span(stage, t0, elapsed, ok, attrs):
+    survey_id = getattr(_local, "survey_id", None)
+    if survey_id is None:
+        return
+    with _lock:
+        trace = _traces.get(survey_id)
+        if trace is None or len(trace["spans"]) >= MAX_SPANS_PER_TRACE:
+            return
+        trace["spans"].append({
+            "stage": stage,
+            "offset_ms": round((t0 - trace["t0"]) * 1000, 2),
+            "duration_ms": round(elapsed * 1000, 2),
+            "ok": ok,
+            **attrs,
+        })
+
+
+def get_trace(survey_id):
+    with _lock:
+        trace = _traces.get(survey_id)
+        if trace is None:
+            return None
+        return {"survey_id": survey_id, "started": trace["started"], "spans": list(trace["spans"])}
+
+
+# --- Exposition ---
+
+def _fmt_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render() -> str:
+    """Prometheus text format for all metrics."""
+    lines = []
+    with _lock:
+        if _histograms:
+            lines.append("# HELP pothole_stage_seconds Latency of pipeline stages.")
+            lines.append("# TYPE pothole_stage_seconds histogram")
+        for stage, h in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, n in zip(BUCKETS, h["buckets"]):
+                cumulative += n
+                lines.append(f'pothole_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'pothole_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h["count"]}')
+            lines.append(f'pothole_stage_seconds_sum{{stage="{stage}"}} {h["sum"]}')
+            lines.append(f'pothole_stage_seconds_count{{stage="{stage}"}} {h["count"]}')
+
+        for kind, series in (("counter", _counters), ("gauge", _gauges)):
+            seen = set()
+            for (name, labels), value in sorted(series.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} {kind}")
+                    seen.add(name)
+                lines.append(f"{name}{_fmt_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,155 @@
+"""
+payload_eval.py
+Measure the image-normalization stage (image_payload.py) against unmodified images.
+
+For every image: original vs normalized bytes and the time spent normalizing. With
+--upload each version is also uploaded to Supabase Storage under payload_eval/ and timed;
+with --gemini N the first N images are analyzed by Gemini in both versions, reporting
+latency and whether the hazard_type / severity answers still agree.
+
+Usage (from the repo root):
+    python backend/payload_eval.py --images_dir backend/nj_images --max_dim 1024 --quality 80
+    python backend/payload_eval.py --images_dir photos/ --upload --gemini 20 --out payload.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from image_payload import JPEG_QUALITY, MAX_DIM, ROAD_CROP, normalize_bytes
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+
+
+def list_images(images_dir, limit=None):
+    paths = sorted(
+        os.path.join(images_dir, f) for f in os.listdir(images_dir) if f.lower().endswith(IMAGE_EXTS)
+    )
+    return paths[:limit] if limit else paths
+
+
+def _timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def _summary(seconds):
+    if not seconds:
+        return None
+    ordered = sorted(seconds)
+    return {
+        "mean_ms": round(statistics.mean(ordered) * 1000, 1),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+        "total_s": round(sum(ordered), 2),
+    }
+
+
+def measure_upload(pairs, workers):
+    from street_hazard_upload import upload_bytes_to_supabase
+
+    def _one(item):
+        name, data, variant = item
+        _, elapsed = _timed(upload_bytes_to_supabase, data, name, storage_prefix=f"payload_eval/{variant}", upsert=True)
+        return variant, elapsed
+
+    items = [(os.path.basename(p), orig, "original") for p, orig, _ in pairs]
+    items += [(os.path.splitext(os.path.basename(p))[0] + ".jpg", derived, "derived") for p, _, derived in pairs]
+    times = {"original": [], "derived": []}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for variant, elapsed in pool.map(_one, items):
+            times[variant].append(elapsed)
+    return {variant: _summary(t) for variant, t in times.items()}
+
+
+def measure_gemini(pairs, location):
+    from gemini_prompt.main import analyze_hazard_bytes
+
+    times = {"original": [], "derived": []}
+    agree_type = agree_severity = compared = 0
+    for path, orig, derived in pairs:
+        try:
+            a, t_orig = _timed(analyze_hazard_bytes, orig, location)
+            b, t_derived = _timed(analyze_hazard_bytes, derived, location)
+        except Exception as e:
+            print(f"{os.path.basename(path)}: Gemini error ({e})")
+            continue
+        times["original"].append(t_orig)
+        times["derived"].append(t_derived)
+        if isinstance(a, dict) and isinstance(b, dict) and "error" not in a and "error" not in b:
+            compared += 1
+            agree_type += a.get("hazard_type") == b.get("hazard_type")
+            try:
+                agree_severity += abs(float(a.get("severity")) - float(b.get("severity"))) <= 1
+            except (TypeError, ValueError):
+                pass
+    return {
+        "latency": {variant: _summary(t) for variant, t in times.items()},
+        "compared": compared,
+        "hazard_type_agreement": round(agree_type / compared, 3) if compared else None,
+        "severity_within_1": round(agree_severity / compared, 3) if compared else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes/upload time/Gemini latency of normalized vs original images.")
+    parser.add_argument("--images_dir", default="backend/nj_images")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N images")
+    parser.add_argument("--max_dim", type=int, default=MAX_DIM)
+    parser.add_argument("--quality", type=int, default=JPEG_QUALITY)
+    parser.add_argument("--road_crop", type=float, default=ROAD_CROP)
+    parser.add_argument("--upload", action="store_true", help="Also time Supabase uploads of both versions")
+    parser.add_argument("--upload_workers", type=int, default=8)
+    parser.add_argument("--gemini", type=int, default=0, help="Analyze the first N images with Gemini in both versions")
+    parser.add_argument("--location", default="Test location")
+    parser.add_argument("--out", default=None, help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    paths = list_images(args.images_dir, args.limit)
+    if not paths:
+        raise SystemExit(f"No images found in {args.images_dir}")
+
+    pairs, normalize_s = [], []
+    for p in paths:
+        with open(p, "rb") as f:
+            data = f.read()
+        result, elapsed = _timed(
+            normalize_bytes, data, os.path.basename(p),
+            max_dim=args.max_dim, quality=args.quality, road_crop=args.road_crop, record=False,
+        )
+        pairs.append((p, data, result.data))
+        normalize_s.append(elapsed)
+
+    original_bytes = sum(len(o) for _, o, _ in pairs)
+    derived_bytes = sum(len(d) for _, _, d in pairs)
+    result = {
+        "images": len(pairs),
+        "settings": {"max_dim": args.max_dim, "quality": args.quality, "road_crop": args.road_crop},
+        "changed": sum(1 for _, o, d in pairs if o is not d),
+        "original_bytes": original_bytes,
+        "derived_bytes": derived_bytes,
+        "bytes_saved": original_bytes - derived_bytes,
+        "ratio": round(derived_bytes / original_bytes, 3) if original_bytes else None,
+        "normalize": _summary(normalize_s),
+    }
+    print(json.dumps(result))
+
+    if args.upload:
+        result["upload"] = measure_upload(pairs, args.upload_workers)
+        print(json.dumps({"upload": result["upload"]}))
+    if args.gemini:
+        result["gemini"] = measure_gemini(pairs[:args.gemini], args.location)
+        print(json.dumps({"gemini": result["gemini"]}))
+
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
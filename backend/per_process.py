@@ -0,0 +1,63 @@
+"""
+per_process.py
+Helpers for running the backend under a pre-forking server (see gunicorn.conf.py).
+
+Network clients (Supabase/httpx pools, Dedalus, requests sessions) hold sockets and locks
+that break when a forked worker inherits them. PerProcess builds its object on first use
+in each process, so the master can preload read-only state without ever creating one and
+every worker starts from a clean client.
+
+memory_usage() reads the current process's RSS / PSS / private memory from /proc, which is
+how copy-on-write sharing between the master and its workers shows up.
+"""
+
+import os
+import resource
+import threading
+
+
+class PerProcess:
+    """Lazy per-process singleton; attribute access is forwarded to the wrapped object."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._obj = None
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._obj = self._factory()
+                    self._pid = pid
+        return self._obj
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def memory_usage(pid: str | int = "self") -> dict:
+    """{"rss", "pss", "private"} in bytes; pss/private are None where /proc has no smaps_rollup."""
+    out = {"rss": None, "pss": None, "private": None}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1]) * 1024
+        out["rss"] = fields.get("Rss")
+        out["pss"] = fields.get("Pss")
+        out["private"] = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    except OSError:
+        if pid == "self":
+            # ru_maxrss is KiB on Linux; peak rather than current, but better than nothing
+            out["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return out
@@ -0,0 +1,121 @@
+"""
+prefork_eval.py
+Cold start and memory of the gunicorn deployment (gunicorn.conf.py), with and without
+preloading shared state in the master.
+
+For each mode it starts gunicorn with --workers N, waits until all workers are up and
+/metrics answers, then reads RSS / PSS / private memory of the master and each worker
+from /proc (Linux). PSS splits shared pages between the processes sharing them, so the
+PSS total is what the deployment really costs; private memory is each worker's own share.
+
+Usage (from the repo root):
+    python backend/prefork_eval.py --workers 4 --out prefork.json
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from per_process import memory_usage
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _children(pid: int):
+    kids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # Fields after the ")" closing the command name: state, ppid, ...
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            kids.append(int(entry))
+    return kids
+
+
+def _ready(port: int) -> bool:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=2) as resp:
+            return resp.status == 200
+    except OSError:
+        return False
+
+
+def run_mode(preload: bool, workers: int, port: int, settle_s: float, start_timeout: float) -> dict:
+    env = dict(os.environ, SERVER_PRELOAD="1" if preload else "0", SERVER_WORKERS=str(workers),
+               SERVER_BIND=f"127.0.0.1:{port}")
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"], cwd=BACKEND_DIR, env=env)
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {proc.returncode}")
+            if time.perf_counter() - t0 > start_timeout:
+                raise RuntimeError("gunicorn did not become ready in time")
+            if len(_children(proc.pid)) >= workers and _ready(port):
+                break
+            time.sleep(0.1)
+        cold_start = time.perf_counter() - t0
+        time.sleep(settle_s)
+
+        master = memory_usage(proc.pid)
+        per_worker = [memory_usage(pid) for pid in _children(proc.pid)]
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    def mb(value):
+        return round(value / 1e6, 1) if value is not None else None
+
+    def avg(kind):
+        values = [m[kind] for m in per_worker if m[kind] is not None]
+        return mb(sum(values) / len(values)) if values else None
+
+    pss = [m["pss"] for m in [master] + per_worker]
+    return {
+        "preload": preload,
+        "workers": len(per_worker),
+        "cold_start_s": round(cold_start, 2),
+        "master_rss_mb": mb(master["rss"]),
+        "worker_rss_mb": avg("rss"),
+        "worker_pss_mb": avg("pss"),
+        "worker_private_mb": avg("private"),
+        "total_pss_mb": mb(sum(pss)) if None not in pss else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start and per-worker memory of the pre-fork deployment.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--modes", nargs="*", default=["preload", "no_preload"], choices=["preload", "no_preload"])
+    parser.add_argument("--settle", type=float, default=2.0, help="Seconds to wait after ready before measuring")
+    parser.add_argument("--start_timeout", type=float, default=300.0)
+    parser.add_argument("--out", default=None, help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    rows = []
+    for mode in args.modes:
+        rows.append(run_mode(mode == "preload", args.workers, args.port, args.settle, args.start_timeout))
+        print(json.dumps(rows[-1]))
+
+    print(json.dumps(rows, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
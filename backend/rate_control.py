@@ -0,0 +1,170 @@
+"""
+rate_control.py
+Adaptive (AIMD) concurrency limits for the upstream APIs.
+
+Each upstream (streetview, nominatim, gemini) gets one shared AdaptiveLimiter. The
+concurrency limit grows by about one slot per round of successful calls and is halved on
+429/5xx or when latency rises well above its running average. A Retry-After pauses every
+caller of that API, not just the one that got the 429. The limit never exceeds a hard
+ceiling, and an optional per-minute cap and minimum spacing between request starts are
+enforced on top (Nominatim: one request per second, never a burst).
+
+Usage:
+    with get_limiter("nominatim").call() as call:
+        resp = requests.get(...)
+        if resp.status_code == 429:
+            call.throttled(resp.headers.get("Retry-After"))
+
+Current limits are exported as pothole_upstream_concurrency_limit{api=...} gauges.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+# api -> (initial concurrency, hard ceiling, max calls per minute or 0 for none)
+DEFAULTS = {
+    "streetview": (8, 50, 30000),
+    "nominatim": (1, 1, 60),
+    "gemini": (4, 16, 0),
+}
+# api -> minimum seconds between the starts of two requests (<API>_MIN_INTERVAL_S overrides)
+MIN_INTERVALS = {
+    # Nominatim's usage policy: at most one request per second; a per-minute cap alone
+    # would still let 60 fast calls through back to back
+    "nominatim": 1.0,
+}
+LATENCY_TOLERANCE = 2.0   # latency above this multiple of the running average counts as congestion
+LATENCY_MIN_EXCESS_S = 0.05  # ...but only if it is also this much slower (ignores jitter on fast calls)
+MIN_LATENCY_SAMPLES = 20
+DECREASE_FACTOR = 0.5
+
+
+class AdaptiveLimiter:
+    def __init__(self, name: str, initial: int, max_limit: int, max_per_minute: int = 0, min_limit: int = 1,
+                 min_interval: float = 0.0):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = float(min(max(initial, min_limit), self.max_limit))
+        self.max_per_minute = max_per_minute
+        self.min_interval = min_interval
+        self.last_start = None
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.avg_latency = None
+        self.samples = 0
+        self.last_decrease = 0.0
+        self.timestamps = deque()
+        self._cond = threading.Condition()
+        self._publish()
+
+    def _publish(self):
+        metrics.set_gauge("pothole_upstream_concurrency_limit", int(self.limit), {"api": self.name})
+        metrics.set_gauge("pothole_upstream_in_flight", self.in_flight, {"api": self.name})
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self.timestamps and now - self.timestamps[0] > 60:
+                    self.timestamps.popleft()
+                wait_s = self.paused_until - now
+                if self.max_per_minute and len(self.timestamps) >= self.max_per_minute:
+                    wait_s = max(wait_s, 60 - (now - self.timestamps[0]))
+                if self.min_interval and self.last_start is not None:
+                    wait_s = max(wait_s, self.last_start + self.min_interval - now)
+                if wait_s <= 0 and self.in_flight < int(self.limit):
+                    break
+                self._cond.wait(timeout=wait_s if wait_s > 0 else None)
+            self.in_flight += 1
+            self.timestamps.append(now)
+            self.last_start = now
+            self._publish()
+
+    def release(self, outcome: str = "ok", latency: float = None, retry_after: float = None):
+        """outcome: "ok", "throttled" (429/5xx) or "error" (no signal about capacity)."""
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+            congested = outcome == "throttled"
+            if outcome == "ok" and latency is not None:
+                if (self.samples >= MIN_LATENCY_SAMPLES
+                        and latency > self.avg_latency * LATENCY_TOLERANCE
+                        and latency - self.avg_latency > LATENCY_MIN_EXCESS_S):
+                    congested = True
+                else:
+                    self.avg_latency = latency if self.avg_latency is None else 0.95 * self.avg_latency + 0.05 * latency
+                    self.samples += 1
+
+            if congested:
+                # One cut per round trip, so a burst of failures from the same window
+                # doesn't collapse the limit to the floor
+                if now - self.last_decrease > (self.avg_latency or 1.0):
+                    self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+                    self.last_decrease = now
+            elif outcome == "ok":
+                # +1 slot per `limit` successes, i.e. roughly one per round trip
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._publish()
+            self._cond.notify_all()
+
+    @contextmanager
+    def call(self):
+        """Hold one slot for the duration of an upstream call. Unreported exceptions count as "error"."""
+        self.acquire()
+        call = _Call()
+        t0 = time.monotonic()
+        try:
+            yield call
+        except BaseException:
+            if call.outcome == "ok":
+                call.outcome = "error"
+            raise
+        finally:
+            self.release(call.outcome, time.monotonic() - t0, call.retry_after)
+
+
+class _Call:
+    def __init__(self):
+        self.outcome = "ok"
+        self.retry_after = None
+
+    def throttled(self, retry_after=None):
+        """Report a 429/5xx; retry_after is the Retry-After header (seconds) if there was one."""
+        self.outcome = "throttled"
+        try:
+            self.retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            self.retry_after = None  # HTTP-date form; fall back to the caller's own backoff
+
+    def failed(self):
+        self.outcome = "error"
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(api: str) -> AdaptiveLimiter:
+    """
+    Shared limiter for an upstream; <API>_MAX_CONCURRENCY / <API>_MAX_PER_MINUTE /
+    <API>_MIN_INTERVAL_S override the defaults.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(api)
+        if limiter is None:
+            initial, ceiling, per_minute = DEFAULTS.get(api, (4, 16, 0))
+            ceiling = int(os.getenv(f"{api.upper()}_MAX_CONCURRENCY") or ceiling)
+            per_minute = int(os.getenv(f"{api.upper()}_MAX_PER_MINUTE") or per_minute)
+            min_interval = float(os.getenv(f"{api.upper()}_MIN_INTERVAL_S") or MIN_INTERVALS.get(api, 0.0))
+            limiter = _limiters[api] = AdaptiveLimiter(api, min(initial, ceiling), ceiling, per_minute,
+                                                       min_interval=min_interval)
+        return limiter
@@ -1,16 +1,33 @@
-from flask import Flask, jsonify, request
-from gemini_prompt.main import analyze_hazard_image
+from flask import Blueprint, Flask, Response, jsonify, request
+from gemini_prompt.main import GEMINI_MAX_IN_FLIGHT, PARSE_ERROR, analyze_hazard_image, analyze_many
 from coord_to_address import coord_to_address
 from supabase import create_client, Client
 from dotenv import load_dotenv
-from street_view import generate_folder
-from street_hazard_upload import upload_local_file_to_supabase
+from street_view import (
+    RoadIndex, _ensure_env_loaded, commit_points, generate_folder_incremental, generate_grid, iter_downloads,
+    load_pano_state, new_download_summary, pano_state_lock, save_pano_state,
+)
+from adaptive_survey import generate_folder_adaptive, yolo_detector
+from survey_stream import ChannelCancelled, SpillChannel
+from survey_tiles import TileStore, partition_survey
+from street_hazard_upload import (
+    UPLOAD_WORKERS, get_upload_index, upload_bytes_to_supabase, upload_many,
+)
+from image_payload import NORMALIZE_ENABLED, get_payload_map, maybe_normalize, normalize_files
+from per_process import PerProcess, memory_usage
+import metrics
 from werkzeug.exceptions import BadRequest
 import os
 import re
 import json
+import base64
+import shutil
 import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from flask_cors import CORS
+from cachetools import TTLCache
 from datetime import datetime, timezone
 from dedalus_labs import AsyncDedalus, DedalusRunner
 import asyncio 
@@ -19,9 +36,9 @@ import asyncio
 MCP_SERVERS = [os.getenv("DEDALUS_MCP_SLUG", "ez2103/pothole-mcp-server")]  # <-- put your slug here
 MODEL = os.getenv("DEDALUS_MODEL", "openai/gpt-5-mini")
 
-# Reuse one client/runner for all requests
-_client = AsyncDedalus()
-_runner = DedalusRunner(_client)
+# Reuse one client/runner for all requests (one per process, created on first use)
+_client = PerProcess(AsyncDedalus)
+_runner = PerProcess(lambda: DedalusRunner(_client.get()))
 
 
 load_dotenv()
@@ -30,26 +47,145 @@ load_dotenv()
 url = os.getenv("SUPABASE_URL")
 key = os.getenv("SUPABASE_KEY")
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET", "hazard-images")
-supabase: Client = create_client(url, key)
-
-app = Flask(__name__)
-
-# CORS: allow Vite dev ports and handle preflight
-CORS(
-    app,
-    origins=[
-        "http://localhost:5173",
-        "http://127.0.0.1:5173",
-        "http://localhost:5174",
-        "http://127.0.0.1:5174",
-    ],
-    supports_credentials=True,
-    allow_headers=["Content-Type", "Authorization"],
-    methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-)
+# Pano ids/capture dates from earlier surveys, used to skip unchanged imagery on re-survey
+PANO_STATE_PATH = os.getenv("PANO_STATE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".pano_state.json"))
+_pano_state_lock = threading.Lock()
+
+# Optional GeoJSON of road LineStrings for heading_mode="road"; without it the road bearing
+# is taken from neighbouring panos
+ROAD_GEOMETRY_PATH = os.getenv("ROAD_GEOMETRY_PATH")
+_road_index = None
+_road_index_lock = threading.Lock()
+
+def _get_road_index():
+    global _road_index
+    if not ROAD_GEOMETRY_PATH:
+        return None
+    with _road_index_lock:
+        if _road_index is None:
+            _road_index = RoadIndex.from_geojson(ROAD_GEOMETRY_PATH)
+        return _road_index
+
+# Sharded surveys (tiles > 1) are queued here and run by survey_worker.py processes
+_tile_store = None
+_tile_store_lock = threading.Lock()
+
+def _get_tile_store():
+    global _tile_store
+    with _tile_store_lock:
+        if _tile_store is None:
+            _tile_store = TileStore()
+        return _tile_store
+# Key survey images by SHA-256 so identical panos are never uploaded twice
+SUPABASE_CONTENT_ADDRESSED = os.getenv("SUPABASE_CONTENT_ADDRESSED", "false").lower() in ("1", "true", "yes")
+supabase: Client = PerProcess(lambda: create_client(url, key))
+
+api = Blueprint("api", __name__)
+
+# Short-lived cache for GET /hazards responses. An insert clears it only in the process that
+# made it; other gunicorn workers and survey-worker processes serve their cached pages until
+# they expire, so the TTL is the staleness bound for listings. Keep it short.
+HAZARDS_CACHE_TTL = float(os.getenv("HAZARDS_CACHE_TTL", "5"))
+_hazards_cache = TTLCache(maxsize=512, ttl=HAZARDS_CACHE_TTL)
+_hazards_cache_lock = threading.Lock()
+
+def _invalidate_hazards_cache():
+    with _hazards_cache_lock:
+        _hazards_cache.clear()
+
+# YOLO weights for adaptive surveys; loaded once per process, or once in the master when preloaded
+_adaptive_detector = None
+_adaptive_detector_lock = threading.Lock()
+
+def _get_adaptive_detector():
+    global _adaptive_detector
+    with _adaptive_detector_lock:
+        if _adaptive_detector is None:
+            detect = yolo_detector()
+            detect_lock = threading.Lock()  # one model, possibly several concurrent surveys
+
+            def locked(paths):
+                with detect_lock:
+                    return detect(paths)
+            _adaptive_detector = locked
+        return _adaptive_detector
+
+# Background survey threads, so a worker being stopped can let them finish
+_survey_threads = set()
+_survey_threads_lock = threading.Lock()
+
+def _start_survey_thread(*args):
+    def run():
+        try:
+            process_survey_in_background(*args)
+        finally:
+            with _survey_threads_lock:
+                _survey_threads.discard(thread)
+
+    thread = threading.Thread(target=run, name="survey")
+    with _survey_threads_lock:
+        _survey_threads.add(thread)
+    thread.start()
+
+def wait_for_surveys(timeout: float) -> int:
+    """Join in-flight surveys for up to timeout seconds; returns how many are still running."""
+    deadline = time.monotonic() + timeout
+    with _survey_threads_lock:
+        threads = list(_survey_threads)
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    with _survey_threads_lock:
+        return len(_survey_threads)
+
+PRELOAD_MODEL = os.getenv("SERVER_PRELOAD_MODEL", "1").lower() not in ("0", "false", "no")
+
+def preload_shared_state():
+    """
+    Load read-only state once so pre-forked workers share it copy-on-write: road index,
+    upload/payload indexes, tile store schema and (SERVER_PRELOAD_MODEL) the YOLO weights.
+    The upload index is reconciled with the bucket listing here; the Supabase client that
+    takes is per process (see per_process.py), so workers still start from a fresh one.
+    """
+    t0 = time.perf_counter()
+    _get_road_index()
+    _get_tile_store()
+    get_payload_map()
+    if SUPABASE_CONTENT_ADDRESSED:
+        get_upload_index(reconcile=True)
+    if PRELOAD_MODEL:
+        try:
+            _get_adaptive_detector()
+        except Exception as e:
+            print(f"[preload] YOLO weights not preloaded ({e}); adaptive surveys will load them on demand")
+    elapsed = time.perf_counter() - t0
+    metrics.set_gauge("pothole_cold_start_seconds", elapsed, {"phase": "preload"})
+    mem = memory_usage()
+    print(f"[preload] shared state loaded in {elapsed:.2f}s, rss {(mem['rss'] or 0) / 1e6:.0f} MB")
+    return elapsed
+
+def create_app(preload: bool = True):
+    """App factory; under gunicorn --preload this runs once in the master, before forking."""
+    if preload:
+        preload_shared_state()
+    app = Flask(__name__)
+    # CORS: allow Vite dev ports and handle preflight
+    CORS(
+        app,
+        origins=[
+            "http://localhost:5173",
+            "http://127.0.0.1:5173",
+            "http://localhost:5174",
+            "http://127.0.0.1:5174",
+        ],
+        supports_credentials=True,
+        allow_headers=["Content-Type", "Authorization"],
+        methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    )
+    app.register_blueprint(api)
+    return app
 
 # Example: POST endpoint (with preflight support)
-@app.route('/submit', methods=['POST', 'OPTIONS'])
+@api.route('/submit', methods=['POST', 'OPTIONS'])
 def submit_image(): 
     if request.method == 'OPTIONS':
         # Flask-CORS should handle this, but explicitly return OK to avoid 403s
@@ -122,6 +258,7 @@ def submit_image():
     except Exception as e:
         print("[Supabase Error]", e)
         return jsonify({"error": "Failed to insert into Supabase", "details": str(e)}), 500
+    _invalidate_hazards_cache()
     
     return analysis # Return the analysis result as JSON
 
@@ -132,119 +269,404 @@ def _to_float(name, val):
     except (TypeError, ValueError):
         raise BadRequest(f"Missing/invalid '{name}'")
 
-def process_survey_in_background(lat_min, lat_max, lon_min, lon_max, grid_step, survey_id=None):
-    # 1) Generate Street View images into a folder (your existing function)
-    folder_path = generate_folder(lat_min, lat_max, lon_min, lon_max, grid_step)
+def process_survey_in_background(lat_min, lat_max, lon_min, lon_max, grid_step, survey_id=None, incremental=False,
+                                 adaptive=None, heading_mode="fixed", stream=False):
+    metrics.add_gauge("pothole_surveys_in_flight", 1)
+    metrics.start_trace(survey_id)
+    try:
+        with metrics.timed("survey_total"):
+            _run_survey(lat_min, lat_max, lon_min, lon_max, grid_step, survey_id, incremental, adaptive, heading_mode,
+                        stream)
+    finally:
+        metrics.end_trace()
+        metrics.add_gauge("pothole_surveys_in_flight", -1)
+
+def _run_survey(lat_min, lat_max, lon_min, lon_max, grid_step, survey_id=None, incremental=False, adaptive=None,
+                heading_mode="fixed", stream=False):
+    pano_state, download_summary, inserted, failures = _survey_pipeline(
+        lat_min, lat_max, lon_min, lon_max, grid_step, incremental, adaptive, heading_mode, stream,
+    )
+    _finish_survey(survey_id, pano_state, download_summary, inserted, failures)
 
-    inserted = []
-    failures = []
 
-    for root, _, files in os.walk(folder_path):
-        for fname in sorted(files):
-            if not fname.lower().endswith((".jpg", ".jpeg", ".png")):
-                continue
+class SurveyCancelled(Exception):
+    """Raised out of _survey_pipeline once its gate reports cancelled (e.g. a lost tile lease)."""
 
-            m = pattern.search(fname)
-            if not m:
-                print(f"Skipping {fname}: does not match naming pattern")
-                continue
 
-            lat = float(m.group(1))
-            lon = float(m.group(2))
-            hdg = int(m.group(3))
+def _item_key(fname, lat, lon):
+    """(pano, heading) identity of one survey image, stable across re-runs of the same tile."""
+    m = pattern.search(fname)
+    return f"{lat}_{lon}|{m.group(3) if m else fname}"
 
-            img_path = os.path.join(root, fname)
 
-            try:
-                # 2) Upload image to Supabase Storage -> get URL
-                storage_prefix = f"survey/{lat:.6f}_{lon:.6f}"
-                storage_path, image_url = upload_local_file_to_supabase(
-                    file_path=img_path,
-                    storage_prefix=storage_prefix,
-                    bucket=SUPABASE_BUCKET,
-                    make_public=True,       # or False + sign_seconds=...
-                    # sign_seconds=3600,
-                    upsert=True
-                )
+def _survey_pipeline(lat_min, lat_max, lon_min, lon_max, grid_step, incremental=False, adaptive=None,
+                     heading_mode="fixed", stream=False, gate=None):
+    """
+    Download/upload/analyze one bbox. Returns (pano_state, download_summary, inserted, failures).
 
-                # 3) Reverse geocode
-                location = coord_to_address(lat, lon) or "Address not found"
+    gate (see survey_worker._TileGate) makes the run cancellable and its inserts idempotent:
+    gate.cancelled() is checked between stages and before every insert, images whose key
+    gate.is_recorded() are skipped, and each insert must first win gate.claim(key).
+    """
+    with _pano_state_lock, pano_state_lock(PANO_STATE_PATH):
+        pano_state = load_pano_state(PANO_STATE_PATH)
+    road_index = _get_road_index() if heading_mode == "road" else None
+    inserted = []
+    failures = []
 
-                # 4) Analyze with Gemini using the URL (NOT the local path)
-                # If your analyze_hazard_image can accept bytes/paths, you can change it.
-                analysis = analyze_hazard_image(image_url, location)
+    if stream:
+        with metrics.timed("survey_stream"):
+            download_summary = _stream_survey(
+                lat_min, lat_max, lon_min, lon_max, grid_step, pano_state, incremental,
+                heading_mode, road_index, inserted, failures, gate,
+            )
+    else:
+        download_summary = _download_survey_folder(
+            lat_min, lat_max, lon_min, lon_max, grid_step, pano_state, incremental, adaptive,
+            heading_mode, road_index, inserted, failures, gate,
+        )
+    return pano_state, download_summary, inserted, failures
+
+
+def _check_gate(gate):
+    if gate is not None and gate.cancelled():
+        raise SurveyCancelled()
+
+
+def _download_survey_folder(lat_min, lat_max, lon_min, lon_max, grid_step, pano_state, incremental, adaptive,
+                            heading_mode, road_index, inserted, failures, gate=None):
+    """Folder handoff: download everything to a temp dir, then upload/analyze. Returns the download summary."""
+    # 1) Generate Street View images into a folder (your existing function).
+    # On an incremental re-survey, panos whose id and capture date are unchanged are skipped.
+    # In adaptive mode the grid starts coarse and is refined around detections down to grid_step;
+    # only images the detector flagged are sent on to Gemini.
+    # heading_mode="road" takes two views per pano along the road instead of 0/90/180/270.
+    only_images = None
+    if adaptive:
+        with metrics.timed("download_folder", mode="adaptive"):
+            folder_path, adaptive_summary = generate_folder_adaptive(
+                lat_min, lat_max, lon_min, lon_max,
+                coarse_step=adaptive["coarse_step"], min_step=grid_step,
+                budget=adaptive["budget"], refine_on=adaptive["refine_on"],
+                heading_mode=heading_mode, road_index=road_index,
+                detector=_get_adaptive_detector() if adaptive["refine_on"] == "hazards" else None,
+                pano_state=pano_state, skip_unchanged=incremental,
+            )
+        download_summary = adaptive_summary["download"]
+        if adaptive["refine_on"] == "hazards":
+            only_images = adaptive_summary["hazard_images"]
+    else:
+        with metrics.timed("download_folder"):
+            folder_path, download_summary = generate_folder_incremental(
+                lat_min, lat_max, lon_min, lon_max, grid_step,
+                pano_state=pano_state, skip_unchanged=incremental,
+                heading_mode=heading_mode, road_index=road_index,
+            )
 
-                # If analysis is a JSON string, parse it
-                if isinstance(analysis, str):
-                    try:
-                        analysis = json.loads(analysis)
-                    except Exception:
-                        analysis = {}
+    try:
+        images = []
+        for root, _, files in os.walk(folder_path):
+            for fname in sorted(files):
+                if not fname.lower().endswith((".jpg", ".jpeg", ".png")):
+                    continue
+                if only_images is not None and fname not in only_images:
+                    continue
 
-                # 5) Build and insert row in hazards table (match DB schema)
-                # Inline normalization: clamp severity to int within [0, 10]
-                raw_severity = analysis.get("severity") if isinstance(analysis, dict) else None
-                severity = None
-                if raw_severity is not None:
-                    try:
-                        severity = int(round(float(raw_severity)))
-                        if severity < 0:
-                            severity = 0
-                        if severity > 10:
-                            severity = 10
-                    except Exception:
-                        severity = None
-
-                # Skip insert if description is missing or empty
-                desc = analysis.get("description") if isinstance(analysis, dict) else None
-                if (desc is None) or (not isinstance(desc, str)) or (desc.strip() == ""):
-                    failures.append({"filename": fname, "error": "Empty description from analysis; not inserting"})
+                m = pattern.search(fname)
+                if not m:
+                    print(f"Skipping {fname}: does not match naming pattern")
                     continue
 
-                row = {
-                    "source": "survey",
-                    "images": [image_url],
-                    "lat": lat,
-                    "lng": lon,
-                    "location": location,
-                    "hazard_type": (analysis.get("hazard_type") if isinstance(analysis, dict) else None),
-                    "severity": severity,
-                    "location_context": (analysis.get("location_context") if isinstance(analysis, dict) else None),
-                    "description": desc,
-                    "projected_repair_cost": (analysis.get("projected_repair_cost") if isinstance(analysis, dict) else None),
-                    "projected_worsening": (analysis.get("projected_worsening") if isinstance(analysis, dict) else None),
-                    "future_worsening_description": (analysis.get("future_worsening_description") if isinstance(analysis, dict) else None),
-                }
-
-                # Drop None values so Postgres uses column defaults
-                row = {k: v for k, v in row.items() if v is not None}
+                lat = float(m.group(1))
+                lon = float(m.group(2))
+                hdg = int(m.group(3))
+                if gate is not None and gate.is_recorded(_item_key(fname, lat, lon)):
+                    continue  # inserted by an earlier attempt at this tile
+                images.append((fname, os.path.join(root, fname), lat, lon, hdg))
+        _check_gate(gate)
+
+        # Resize / re-encode / strip EXIF in place before upload (see image_payload.py)
+        img_paths = [img_path for _, img_path, _, _, _ in images]
+        if NORMALIZE_ENABLED:
+            with metrics.timed("normalize_batch", images=len(images)):
+                img_paths = normalize_files(img_paths)
+
+        # 2) Upload images to Supabase Storage through a bounded pool -> get URLs
+        with metrics.timed("upload_batch", images=len(images)):
+            uploads = upload_many(
+                img_paths,
+                storage_prefixes=[f"survey/{lat:.6f}_{lon:.6f}" for _, _, lat, lon, _ in images],
+                bucket=SUPABASE_BUCKET,
+                make_public=True,       # or False + sign_seconds=...
+                # sign_seconds=3600,
+                upsert=True,
+                content_addressed=SUPABASE_CONTENT_ADDRESSED,
+            )
+
+        ready = []
+        for (fname, img_path, lat, lon, hdg), (upload, upload_error) in zip(images, uploads):
+            if upload_error is not None:
+                error = "File not found" if isinstance(upload_error, FileNotFoundError) else str(upload_error)
+                failures.append({"filename": fname, "error": error})
+                continue
+            storage_path, image_url = upload
+            ready.append((fname, lat, lon, image_url))
+        metrics.set_gauge("pothole_queue_depth", len(ready), {"queue": "survey_analysis"})
+
+        # 3) + 4) Geocode, then analyze all images as one bounded concurrent batch;
+        # only calls that fail or come back unparseable are sent again
+        _check_gate(gate)
+        with ThreadPoolExecutor(max_workers=GEMINI_MAX_IN_FLIGHT) as pool:
+            locations = list(pool.map(metrics.bind_trace(lambda r: _geocode(r[1], r[2])), ready))
+        with metrics.timed("analyze_batch", images=len(ready)):
+            analyses = analyze_many([(image_url, location) for (_, _, _, image_url), location in zip(ready, locations)])
+
+        for (fname, lat, lon, image_url), location, analysis in zip(ready, locations, analyses):
+            if isinstance(analysis, Exception):
+                failures.append({"filename": fname, "error": str(analysis)})
+                continue
+            _analyze_and_insert(fname, lat, lon, image_url, pano_state, inserted, failures,
+                                location=location, analysis=analysis, gate=gate, summary=download_summary)
+        metrics.set_gauge("pothole_queue_depth", 0, {"queue": "survey_analysis"})
+    finally:
+        # The temp folder is only a handoff between download and upload
+        shutil.rmtree(folder_path, ignore_errors=True)
+    return download_summary
+
+
+def _stream_survey(lat_min, lat_max, lon_min, lon_max, grid_step, pano_state, incremental, heading_mode,
+                   road_index, inserted, failures, gate=None):
+    """
+    Streaming handoff: images go from the downloader through a bounded SpillChannel straight
+    into UPLOAD_WORKERS upload/analyze workers, so nothing touches disk unless the channel
+    spills past its memory cap. Returns the download summary.
+    """
+    _ensure_env_loaded()
+    api_key = os.environ.get("GOOGLE_MAPS_API_KEY")
+    if not api_key:
+        raise ValueError("Missing API key. Set GOOGLE_MAPS_API_KEY env var.")
+    points = generate_grid((lat_min, lat_max, lon_min, lon_max), grid_step)
+    summary = new_download_summary()
+    producer_errors = []
+
+    def produce():
+        try:
+            for image in iter_downloads(
+                api_key, points, [0, 90, 180, 270], pano_state=pano_state, skip_unchanged=incremental,
+                heading_mode=heading_mode, road_index=road_index, summary=summary,
+            ):
+                channel.put((image.filename, image.lat, image.lon), image.content)
+        except ChannelCancelled:
+            pass
+        except Exception as e:
+            producer_errors.append(e)
+        finally:
+            channel.close()
+
+    def handle(meta, data):
+        fname, lat, lon = meta
+        if gate is not None and (gate.cancelled() or gate.is_recorded(_item_key(fname, lat, lon))):
+            return
+        try:
+            data = maybe_normalize(data, fname)
+            with metrics.timed("upload"):
+                _, image_url = upload_bytes_to_supabase(
+                    data, fname,
+                    storage_prefix=f"survey/{lat:.6f}_{lon:.6f}",
+                    bucket=SUPABASE_BUCKET,
+                    make_public=True,
+                    upsert=True,
+                    content_addressed=SUPABASE_CONTENT_ADDRESSED,
+                )
+        except Exception as e:
+            failures.append({"filename": fname, "error": str(e)})
+            return
+        _analyze_and_insert(fname, lat, lon, image_url, pano_state, inserted, failures, gate=gate, summary=summary)
+
+    # Both run on other threads; bind them so their spans land in this survey's trace
+    produce, handle = metrics.bind_trace(produce), metrics.bind_trace(handle)
+    with SpillChannel() as channel:
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        # Bound the images held by the pool, on top of what the channel buffers
+        slots = threading.BoundedSemaphore(UPLOAD_WORKERS * 2)
+        try:
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+                for meta, data in channel:
+                    if gate is not None and gate.cancelled():
+                        break
+                    slots.acquire()
+                    pool.submit(handle, meta, data).add_done_callback(lambda _: slots.release())
+        finally:
+            channel.cancel()  # unblocks the producer if we stopped early; no-op once drained
+            producer.join()
+        print(f"Stream buffer peak: {channel.peak_memory / 1e6:.1f} MB in memory, "
+              f"{channel.peak_disk / 1e6:.1f} MB spilled ({channel.spilled} images)")
+    if producer_errors:
+        raise producer_errors[0]
+    _check_gate(gate)
+    return summary
+
+
+def _geocode(lat, lon):
+    try:
+        return coord_to_address(lat, lon) or "Address not found"
+    except Exception as e:
+        print(f"[coord_to_address] {e}")
+        return "Address lookup failed"
+
+def _analyze_and_insert(fname, lat, lon, image_url, pano_state, inserted, failures, location=None, analysis=None,
+                        gate=None, summary=None):
+    """
+    Geocode, analyze and insert one uploaded survey image; outcomes go to inserted/failures.
+    A location/analysis already computed by a batch is used as-is. With a gate the insert
+    only happens if the image's key can still be claimed (see _survey_pipeline).
+    """
+    try:
+        # 3) Reverse geocode
+        if location is None:
+            location = coord_to_address(lat, lon) or "Address not found"
+
+        # 4) Analyze with Gemini using the URL (NOT the local path)
+        if analysis is None:
+            analysis = analyze_hazard_image(image_url, location)
 
+        # If analysis is a JSON string, parse it
+        if isinstance(analysis, str):
+            try:
+                analysis = json.loads(analysis)
+            except Exception:
+                analysis = {}
+
+        # 5) Build and insert row in hazards table (match DB schema)
+        # Inline normalization: clamp severity to int within [0, 10]
+        raw_severity = analysis.get("severity") if isinstance(analysis, dict) else None
+        severity = None
+        if raw_severity is not None:
+            try:
+                severity = int(round(float(raw_severity)))
+                if severity < 0:
+                    severity = 0
+                if severity > 10:
+                    severity = 10
+            except Exception:
+                severity = None
+
+        if isinstance(analysis, dict) and analysis.get("error") == PARSE_ERROR:
+            failures.append({"filename": fname, "error": "Unparseable analysis from Gemini; not inserting"})
+            return
+
+        # Skip insert if description is missing or empty
+        desc = analysis.get("description") if isinstance(analysis, dict) else None
+        if (desc is None) or (not isinstance(desc, str)) or (desc.strip() == ""):
+            # Analyzed fine, just nothing to insert; doesn't hold back the pano's state
+            failures.append({"filename": fname, "error": "Empty description from analysis; not inserting",
+                             "analyzed": True})
+            return
+
+        row = {
+            "source": "survey",
+            "images": [image_url],
+            "lat": lat,
+            "lng": lon,
+            "location": location,
+            "hazard_type": (analysis.get("hazard_type") if isinstance(analysis, dict) else None),
+            "severity": severity,
+            "location_context": (analysis.get("location_context") if isinstance(analysis, dict) else None),
+            "description": desc,
+            "projected_repair_cost": (analysis.get("projected_repair_cost") if isinstance(analysis, dict) else None),
+            "projected_worsening": (analysis.get("projected_worsening") if isinstance(analysis, dict) else None),
+            "future_worsening_description": (analysis.get("future_worsening_description") if isinstance(analysis, dict) else None),
+        }
+
+        # Drop None values so Postgres uses column defaults
+        row = {k: v for k, v in row.items() if v is not None}
+
+        key = _item_key(fname, lat, lon)
+        if gate is not None and not gate.claim(key):
+            failures.append({"filename": fname, "error": "Not inserted: tile lease lost or image already recorded"})
+            return
+        try:
+            with metrics.timed("insert"):
                 resp = supabase.table("hazards").insert(row).execute()
-                inserted.append(resp.data[0] if resp.data else row)
+        except Exception:
+            if gate is not None:
+                gate.release(key)
+            raise
+        if gate is not None:
+            gate.done(key, resp.data[0].get("id") if resp.data else None)
+        inserted.append(resp.data[0] if resp.data else row)
+        # New hazards go on the staged pano entry while the survey runs (see commit_points)
+        pano = (summary or {}).get("staged_panos", {}).get(f"{lat}_{lon}") or pano_state["panos"].get(f"{lat}_{lon}")
+        if pano is not None and resp.data and resp.data[0].get("id"):
+            pano["hazard_ids"].append(resp.data[0]["id"])
+        _invalidate_hazards_cache()
+
+    except FileNotFoundError:
+        failures.append({"filename": fname, "error": "File not found"})
+    except Exception as e:
+        failures.append({"filename": fname, "error": str(e)})
+
 
-            except FileNotFoundError:
-                failures.append({"filename": fname, "error": "File not found"})
-            except Exception as e:
-                failures.append({"filename": fname, "error": str(e)})
+def _finish_survey(survey_id, pano_state, download_summary, inserted, failures):
+    carried = _record_survey_outcome(pano_state, download_summary, inserted, failures)
 
-    print(f"Survey processing finished. Inserted: {len(inserted)}, Failed: {len(failures)}")
+    print(f"Survey processing finished. Inserted: {len(inserted)}, Carried forward: {carried}, "
+          f"Skipped unchanged panos: {len(download_summary['unchanged_panos'])}, Failed: {len(failures)}")
 
     # Update surveys table when background job completes
     if survey_id:
+        _mark_survey_complete(survey_id, len(inserted) + carried)
+
+def _record_survey_outcome(pano_state, download_summary, inserted, failures):
+    """Count results and merge pano state; returns the hazards carried forward from unchanged panos."""
+    metrics.inc("pothole_survey_images_total", {"result": "inserted"}, len(inserted))
+    metrics.inc("pothole_survey_images_total", {"result": "failed"}, len(failures))
+    # Hazards found earlier on panos that have not been re-captured still count for this survey
+    carried = sum(
+        len(pano_state["panos"].get(k, {}).get("hazard_ids", []))
+        for k in download_summary["unchanged_panos"]
+    )
+    failed_panos = set()
+    for f in failures:
+        m = pattern.search(f.get("filename") or "")
+        if m and not f.get("analyzed"):
+            failed_panos.add(f"{m.group(1)}_{m.group(2)}")
+    commit_points(pano_state, download_summary, failed_panos)
+    _merge_pano_state(pano_state, download_summary)
+    return carried
+
+def _mark_survey_complete(survey_id, hazards_found):
+    try:
+        supabase\
+            .from_("surveys")\
+            .update({
+                "status": "complete",
+                "hazards_found": hazards_found,
+                "completed_at": datetime.now(timezone.utc).isoformat()
+            })\
+            .eq("id", survey_id)\
+            .execute()
+    except Exception as e:
+        print("[Supabase Error] Failed to update survey status:", e)
+
+def _merge_pano_state(pano_state, download_summary):
+    """
+    Write back only the points/panos this survey touched, so concurrent surveys don't clobber each other.
+    The thread lock covers this process, the file lock the other gunicorn/survey-worker processes.
+    """
+    with _pano_state_lock, pano_state_lock(PANO_STATE_PATH):
+        current = load_pano_state(PANO_STATE_PATH)
+        for grid_key in download_summary["touched_points"]:
+            point = pano_state["points"][grid_key]
+            current["points"][grid_key] = point
+            current["panos"][point["pano_key"]] = pano_state["panos"][point["pano_key"]]
         try:
-            supabase\
-                .from_("surveys")\
-                .update({
-                    "status": "complete",
-                    "hazards_found": len(inserted),
-                    "completed_at": datetime.now(timezone.utc).isoformat()
-                })\
-                .eq("id", survey_id)\
-                .execute()
-        except Exception as e:
-            print("[Supabase Error] Failed to update survey status:", e)
+            save_pano_state(PANO_STATE_PATH, current)
+        except OSError as e:
+            print("[Pano State Error]", e)
 
-@app.route('/survey', methods=['POST'])
+@api.route('/survey', methods=['POST'])
 def survey():
     data = request.get_json(silent=True) or {}
 
@@ -255,16 +677,53 @@ def survey():
     lon_max = _to_float('lng_max/lon_max', data.get('lon_max', data.get('lng_max')))
     grid_step = float(data.get('grid_step', 0.005))  # ≈100m of latitude
     survey_id = data.get('survey_id')
+    incremental = bool(data.get('incremental', False))  # skip panos unchanged since the last survey
+    heading_mode = data.get('heading_mode', 'fixed')  # 'road': two road-aligned views per pano
+    if heading_mode not in ('fixed', 'road'):
+        raise BadRequest("'heading_mode' must be 'fixed' or 'road'")
+    adaptive = None
+    if data.get('mode') == 'adaptive':
+        # coarse-to-fine: grid_step becomes the finest step refinement may reach
+        adaptive = {
+            "coarse_step": float(data.get('coarse_step', grid_step * 8)),
+            "budget": int(data.get('budget', 2000)),
+            "refine_on": data.get('refine_on', 'hazards'),
+        }
+        if adaptive["refine_on"] not in ('hazards', 'roads'):
+            raise BadRequest("'refine_on' must be 'hazards' or 'roads'")
+    # stream: download -> upload -> analyze through a bounded in-memory channel instead of a temp folder
+    stream = data.get('mode') == 'stream'
+
+    # tiles > 1: split the bbox and queue it for survey_worker.py processes instead of running it here
+    try:
+        n_tiles = int(data.get('tiles', 1))
+    except (TypeError, ValueError):
+        raise BadRequest("Invalid 'tiles'")
 
     # normalize bounds if user swapped them
     if lat_min > lat_max: lat_min, lat_max = lat_max, lat_min
     if lon_min > lon_max: lon_min, lon_max = lon_max, lon_min
 
-    thread = threading.Thread(
-        target=process_survey_in_background,
-        args=(lat_min, lat_max, lon_min, lon_max, grid_step, survey_id)
-    )
-    thread.start()
+    if n_tiles > 1:
+        survey_id = survey_id or str(uuid.uuid4())
+        tiles = partition_survey(lat_min, lat_max, lon_min, lon_max, grid_step, n_tiles, road_index=_get_road_index())
+        if adaptive:
+            adaptive = dict(adaptive, budget=max(1, adaptive["budget"] // len(tiles)))
+        params = {"grid_step": grid_step, "incremental": incremental, "adaptive": adaptive,
+                  "heading_mode": heading_mode, "stream": stream}
+        try:
+            _get_tile_store().create_survey(survey_id, params, tiles)
+        except Exception as e:
+            return jsonify({"error": "Failed to queue survey tiles", "details": str(e)}), 409
+        return jsonify({
+            "ok": True,
+            "message": f"Survey queued as {len(tiles)} tiles for survey workers.",
+            "survey_id": survey_id,
+            "tiles": len(tiles),
+        }), 202
+
+    _start_survey_thread(lat_min, lat_max, lon_min, lon_max, grid_step, survey_id, incremental, adaptive, heading_mode,
+                         stream)
 
     return jsonify({
         "ok": True,
@@ -272,8 +731,148 @@ def survey():
     }), 202
 
 
+# Columns returned by GET /hazards when no ?fields= projection is given.
+# Long text columns (description, future_worsening_description) are opt-in.
+HAZARD_LIST_COLUMNS = [
+    "id", "created_at", "source", "status", "hazard_type", "severity",
+    "lat", "lng", "location", "images",
+]
+HAZARD_COLUMNS = set(HAZARD_LIST_COLUMNS) | {
+    "location_context", "description", "projected_repair_cost",
+    "projected_worsening", "future_worsening_description",
+}
+HAZARDS_PAGE_SIZE = 100
+HAZARDS_MAX_PAGE_SIZE = 1000
+
+def _encode_cursor(row):
+    raw = json.dumps([row.get("created_at"), row.get("id")], default=str)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor):
+    """(created_at, id) from a cursor, validated: both end up inside a PostgREST filter string."""
+    try:
+        created_at, hazard_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        created_at = datetime.fromisoformat(created_at).isoformat()
+        if isinstance(hazard_id, bool):
+            raise ValueError("bool id")
+        if isinstance(hazard_id, int):
+            hazard_id = str(hazard_id)
+        elif not (isinstance(hazard_id, str) and hazard_id.isascii() and hazard_id.isdigit()):
+            hazard_id = str(uuid.UUID(hazard_id))
+    except Exception:
+        raise BadRequest("Invalid 'cursor'")
+    return created_at, hazard_id
+
+@api.route('/hazards', methods=['GET'])
+def list_hazards():
+    """Keyset-paginated hazards listing, newest first.
+
+    Query params: limit, cursor, fields (comma list), bbox (lat_min,lat_max,lng_min,lng_max),
+    hazard_type (comma list), severity_min, severity_max, source (comma list), start, end.
+    """
+    args = request.args
 
-@app.route('/hazard_agent', methods=['POST'])
+    try:
+        limit = int(args.get("limit", HAZARDS_PAGE_SIZE))
+    except ValueError:
+        raise BadRequest("Invalid 'limit'")
+    limit = max(1, min(limit, HAZARDS_MAX_PAGE_SIZE))
+
+    fields = [f.strip() for f in args.get("fields", "").split(",") if f.strip()]
+    unknown = [f for f in fields if f not in HAZARD_COLUMNS]
+    if unknown:
+        raise BadRequest(f"Unknown field(s): {', '.join(unknown)}")
+    columns = fields or list(HAZARD_LIST_COLUMNS)
+    # id/created_at are always selected so the next cursor can be built
+    select_cols = list(dict.fromkeys(["id", "created_at"] + columns))
+
+    cache_key = tuple(sorted(args.items(multi=True)))
+    with _hazards_cache_lock:
+        cached = _hazards_cache.get(cache_key)
+    if cached is not None:
+        return jsonify(cached)
+
+    query = supabase.table("hazards").select(",".join(select_cols))
+
+    bbox = args.get("bbox")
+    if bbox:
+        parts = bbox.split(",")
+        if len(parts) != 4:
+            raise BadRequest("'bbox' must be lat_min,lat_max,lng_min,lng_max")
+        lat_min, lat_max, lng_min, lng_max = (_to_float("bbox", v) for v in parts)
+        if lat_min > lat_max: lat_min, lat_max = lat_max, lat_min
+        if lng_min > lng_max: lng_min, lng_max = lng_max, lng_min
+        query = query.gte("lat", lat_min).lte("lat", lat_max).gte("lng", lng_min).lte("lng", lng_max)
+
+    hazard_types = [t for t in args.get("hazard_type", "").split(",") if t]
+    if hazard_types:
+        query = query.in_("hazard_type", hazard_types)
+    sources = [s for s in args.get("source", "").split(",") if s]
+    if sources:
+        query = query.in_("source", sources)
+    if args.get("severity_min") is not None:
+        query = query.gte("severity", _to_float("severity_min", args.get("severity_min")))
+    if args.get("severity_max") is not None:
+        query = query.lte("severity", _to_float("severity_max", args.get("severity_max")))
+    if args.get("start"):
+        query = query.gte("created_at", args.get("start"))
+    if args.get("end"):
+        query = query.lte("created_at", args.get("end"))
+
+    # Keyset pagination on (created_at, id) so deep pages cost the same as the first
+    cursor = args.get("cursor")
+    if cursor:
+        created_at, hazard_id = _decode_cursor(cursor)
+        query = query.or_(
+            f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{hazard_id}")'
+        )
+
+    try:
+        resp = (
+            query.order("created_at", desc=True)
+                 .order("id", desc=True)
+                 .limit(limit + 1)
+                 .execute()
+        )
+    except Exception as e:
+        print("[Supabase Error]", e)
+        return jsonify({"error": "Failed to query hazards", "details": str(e)}), 500
+
+    rows = resp.data or []
+    next_cursor = _encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+    if fields:
+        rows = [{k: r.get(k) for k in columns} for r in rows]
+
+    payload = {"data": rows, "next_cursor": next_cursor}
+    with _hazards_cache_lock:
+        _hazards_cache[cache_key] = payload
+    return jsonify(payload)
+
+
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@api.route('/surveys/<survey_id>/trace', methods=['GET'])
+def survey_trace(survey_id):
+    trace = metrics.get_trace(survey_id)
+    if trace is None:
+        return jsonify({"error": "No trace for survey", "survey_id": survey_id}), 404
+    return jsonify(trace)
+
+
+@api.route('/surveys/<survey_id>/status', methods=['GET'])
+def survey_status(survey_id):
+    """Progress of a sharded survey, aggregated across its tiles."""
+    status = _get_tile_store().status(survey_id)
+    if status is None:
+        return jsonify({"error": "No sharded survey with this id", "survey_id": survey_id}), 404
+    return jsonify(status)
+
+
+@api.route('/hazard_agent', methods=['POST'])
 def hazard_agent():
     data = request.get_json(silent=True) or {}
 
@@ -281,9 +880,15 @@ def hazard_agent():
     if not hazard_id:
         return jsonify({"error": "Missing required field: hazard_id"}), 400
 
-    # 1. Fetch hazard from Supabase
-    resp = supabase.table("hazards").select("*").eq("id", hazard_id).limit(1).execute()
-    rows = resp.data or []
+    # 1. Fetch hazard from Supabase (shares the /hazards response cache)
+    cache_key = ("hazard", hazard_id)
+    with _hazards_cache_lock:
+        rows = _hazards_cache.get(cache_key)
+    if rows is None:
+        resp = supabase.table("hazards").select("*").eq("id", hazard_id).limit(1).execute()
+        rows = resp.data or []
+        with _hazards_cache_lock:
+            _hazards_cache[cache_key] = rows
     if not rows:
         return jsonify({"error": "Hazard not found", "hazard_id": hazard_id}), 404
     hazard = rows[0]
@@ -336,4 +941,5 @@ Tasks:
 
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5001)
\ No newline at end of file
+    # Development server; for multi-worker serving use: gunicorn -c gunicorn.conf.py
+    create_app().run(debug=True, port=5001)
\ No newline at end of file
@@ -1,14 +1,125 @@
-import os, mimetypes
+import argparse, os, mimetypes, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Iterable, List, Optional, Tuple
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
+from per_process import PerProcess
+
 load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET", "hazard-images")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Created on first use in each process, so a pre-forked server never shares its connections
+supabase: Client = PerProcess(lambda: create_client(SUPABASE_URL, SUPABASE_KEY))
+
+# Content-addressed uploads: objects live at cas/<sha[:2]>/<sha><ext>
+CAS_PREFIX = "cas"
+UPLOAD_INDEX_PATH = os.getenv(
+    "UPLOAD_INDEX_PATH", os.path.join(os.path.dirname(__file__), ".upload_index")
+)
+# Files above this size are streamed from disk instead of read into memory
+STREAM_THRESHOLD_BYTES = 4 * 1024 * 1024
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+
+
+def sha256_file(path: str | Path, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class UploadIndex:
+    """Append-only local record of object paths already present in the bucket."""
+
+    def __init__(self, path: str = UPLOAD_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._paths = set()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self._paths = {line.strip() for line in f if line.strip()}
+
+    def __contains__(self, storage_path: str) -> bool:
+        with self._lock:
+            return storage_path in self._paths
+
+    def add(self, storage_path: str):
+        with self._lock:
+            if storage_path in self._paths:
+                return
+            self._paths.add(storage_path)
+            with open(self.path, "a") as f:
+                f.write(storage_path + "\n")
+
+    def reconcile(self, bucket: str = SUPABASE_BUCKET, page_size: int = 1000) -> int:
+        """Replace the index with what the bucket actually holds under CAS_PREFIX."""
+        found = set()
+        store = supabase.storage.from_(bucket)
+        for shard in store.list(CAS_PREFIX, {"limit": page_size}) or []:
+            shard_path = f"{CAS_PREFIX}/{shard['name']}"
+            offset = 0
+            while True:
+                page = store.list(shard_path, {"limit": page_size, "offset": offset}) or []
+                found.update(f"{shard_path}/{obj['name']}" for obj in page)
+                if len(page) < page_size:
+                    break
+                offset += page_size
+        with self._lock:
+            self._paths = found
+            with open(self.path, "w") as f:
+                f.writelines(p + "\n" for p in sorted(found))
+        return len(found)
+
+
+_index: Optional[UploadIndex] = None
+_index_lock = threading.Lock()
+
+def get_upload_index(reconcile: bool = False) -> UploadIndex:
+    """
+    The process-wide UploadIndex. With reconcile=True the first call checks it against the
+    bucket listing, so a stale .upload_index never makes uploads skip objects that are gone.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = UploadIndex()
+            if reconcile:
+                try:
+                    print(f"[upload_index] reconciled with bucket: {_index.reconcile()} objects")
+                except Exception as e:
+                    print(f"[upload_index] reconcile failed ({e}); using the local index as-is")
+        return _index
+
+
+def _public_or_signed_url(bucket, storage_path, make_public, sign_seconds):
+    url = None
+    if make_public:
+        url = supabase.storage.from_(bucket).get_public_url(storage_path)
+    elif sign_seconds:
+        signed = supabase.storage.from_(bucket).create_signed_url(storage_path, sign_seconds)
+        url = signed.get("signedURL")
+    return url
+
+
+def _put_object(bucket, storage_path, file, ctype, upsert, content_addressed):
+    file_options = {
+        "cache-control": "3600",
+        "content-type": ctype,
+        "upsert": str(upsert).lower(),
+    }
+    try:
+        supabase.storage.from_(bucket).upload(path=storage_path, file=file, file_options=file_options)
+    except Exception as e:
+        # Another survey (or worker) uploaded the same content first
+        if not (content_addressed and "duplicate" in str(e).lower()):
+            raise
+    if content_addressed:
+        get_upload_index(reconcile=True).add(storage_path)
+
 
 def upload_local_file_to_supabase(
     file_path: str | Path,
@@ -17,30 +128,104 @@ def upload_local_file_to_supabase(
     make_public: bool = True,
     sign_seconds: Optional[int] = None,
     upsert: bool = True,
+    content_addressed: bool = False,
 ) -> Tuple[str, Optional[str]]:
+    """
+    Upload a local file to Supabase Storage and return (storage_path, url).
+
+    With content_addressed=True the object is keyed by its SHA-256 (storage_prefix is
+    ignored) and the upload is skipped when the local index says it already exists.
+    """
     p = Path(file_path).resolve()
     if not p.exists():
         raise FileNotFoundError(str(p))
 
-    storage_path = f"{storage_prefix.strip('/')}/{p.name}" if storage_prefix else p.name
-    data = p.read_bytes()
     ctype = mimetypes.guess_type(str(p))[0] or "application/octet-stream"
 
-    supabase.storage.from_(bucket).upload(
-        path=storage_path,
-        file=data,
-        file_options={
-            "cache-control": "3600",
-            "content-type": ctype,
-            "upsert": str(upsert).lower(),
-        },
-    )
+    if content_addressed:
+        digest = sha256_file(p)
+        storage_path = f"{CAS_PREFIX}/{digest[:2]}/{digest}{p.suffix.lower()}"
+        index = get_upload_index(reconcile=True)
+        if storage_path in index:
+            return storage_path, _public_or_signed_url(bucket, storage_path, make_public, sign_seconds)
+        # Same hash means same bytes, so there is never a reason to overwrite
+        upsert = False
+    else:
+        storage_path = f"{storage_prefix.strip('/')}/{p.name}" if storage_prefix else p.name
+
+    if p.stat().st_size > STREAM_THRESHOLD_BYTES:
+        with open(p, "rb") as fh:
+            _put_object(bucket, storage_path, fh, ctype, upsert, content_addressed)
+    else:
+        _put_object(bucket, storage_path, p.read_bytes(), ctype, upsert, content_addressed)
+
+    return storage_path, _public_or_signed_url(bucket, storage_path, make_public, sign_seconds)
+
+
+def upload_bytes_to_supabase(
+    data: bytes,
+    filename: str,
+    storage_prefix: str = "",
+    bucket: str = SUPABASE_BUCKET,
+    make_public: bool = True,
+    sign_seconds: Optional[int] = None,
+    upsert: bool = True,
+    content_addressed: bool = False,
+) -> Tuple[str, Optional[str]]:
+    """upload_local_file_to_supabase for in-memory bytes; filename supplies the object name and type."""
+    ctype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    if content_addressed:
+        digest = hashlib.sha256(data).hexdigest()
+        storage_path = f"{CAS_PREFIX}/{digest[:2]}/{digest}{Path(filename).suffix.lower()}"
+        if storage_path in get_upload_index(reconcile=True):
+            return storage_path, _public_or_signed_url(bucket, storage_path, make_public, sign_seconds)
+        upsert = False
+    else:
+        storage_path = f"{storage_prefix.strip('/')}/{filename}" if storage_prefix else filename
+
+    _put_object(bucket, storage_path, data, ctype, upsert, content_addressed)
+    return storage_path, _public_or_signed_url(bucket, storage_path, make_public, sign_seconds)
+
+
+def upload_many(
+    file_paths: Iterable[str | Path],
+    storage_prefixes: Optional[Iterable[str]] = None,
+    max_workers: int = UPLOAD_WORKERS,
+    **kwargs,
+) -> List[Tuple[Optional[Tuple[str, Optional[str]]], Optional[Exception]]]:
+    """
+    Upload files through a bounded thread pool.
+
+    Returns one (result, error) pair per input path, in input order, where result is
+    the (storage_path, url) tuple from upload_local_file_to_supabase.
+    """
+    paths = list(file_paths)
+    prefixes = list(storage_prefixes) if storage_prefixes is not None else [""] * len(paths)
+
+    def _one(item):
+        path, prefix = item
+        try:
+            return upload_local_file_to_supabase(path, storage_prefix=prefix, **kwargs), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(_one, zip(paths, prefixes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the local index of content-addressed uploads.")
+    parser.add_argument("--reconcile", action="store_true", help="Rebuild the index from the bucket listing")
+    parser.add_argument("--bucket", default=SUPABASE_BUCKET)
+    args = parser.parse_args()
+
+    index = UploadIndex()
+    if args.reconcile:
+        print(f"Reconciled {index.path}: {index.reconcile(args.bucket)} objects in {args.bucket}/{CAS_PREFIX}")
+    else:
+        print(f"{index.path}: {len(index._paths)} objects")
 
-    url = None
-    if make_public:
-        url = supabase.storage.from_(bucket).get_public_url(storage_path)
-    elif sign_seconds:
-        signed = supabase.storage.from_(bucket).create_signed_url(storage_path, sign_seconds)
-        url = signed.get("signedURL")
 
-    return storage_path, url
+if __name__ == "__main__":
+    main()
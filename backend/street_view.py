@@ -5,17 +5,28 @@ import math
 import os
 import time
 from collections import deque
-from typing import List, Tuple, Optional
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional, Tuple
 
 import requests
 from tqdm import tqdm
+
+import metrics
+from rate_control import get_limiter
 import tempfile
 import shutil
 import tempfile
 import shutil
 
-STREET_VIEW_IMAGE_URL = "https://maps.googleapis.com/maps/api/streetview"
-STREET_VIEW_METADATA_URL = "https://maps.googleapis.com/maps/api/streetview/metadata"
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single process only
+    fcntl = None
+
+# Base URL can be pointed at a local stand-in (see benchmark.py)
+STREET_VIEW_BASE_URL = os.environ.get("STREET_VIEW_BASE_URL", "https://maps.googleapis.com/maps/api/streetview")
+STREET_VIEW_IMAGE_URL = STREET_VIEW_BASE_URL
+STREET_VIEW_METADATA_URL = f"{STREET_VIEW_BASE_URL}/metadata"
 
 # Optional dotenv support to load API key from .env
 try:
@@ -104,28 +115,171 @@ def generate_grid(bbox: Tuple[float, float, float, float], step_deg: float) -> L
     return points
 
 
-def request_with_retries(url: str, params: dict, max_retries: int = 3, timeout: int = 20) -> requests.Response:
-    attempt = 0
-    while True:
-        attempt += 1
-        try:
-            resp = requests.get(url, params=params, timeout=timeout)
-        except requests.RequestException as e:
-            if attempt <= max_retries:
+def request_with_retries(url: str, params: dict, max_retries: int = 3, timeout: int = 20, api: str = "streetview") -> requests.Response:
+    limiter = get_limiter(api)
+    with metrics.timed(f"{api}_request"):
+        attempt = 0
+        while True:
+            attempt += 1
+            with limiter.call() as call:
+                try:
+                    resp = requests.get(url, params=params, timeout=timeout)
+                except requests.RequestException as e:
+                    call.throttled()  # timeouts/resets usually mean the upstream is overloaded
+                    if attempt > max_retries:
+                        metrics.record_call(api, "error")
+                        raise e
+                    resp = None
+                else:
+                    if resp.status_code == 429 or resp.status_code >= 500:
+                        call.throttled(resp.headers.get("Retry-After"))
+
+            if resp is None:
+                metrics.record_call(api, "retry")
                 time.sleep(min(2 ** attempt, 10))
                 continue
-            raise e
-
-        if resp.status_code in (200, 404):
-            return resp
-        if resp.status_code == 429:
-            retry_after = resp.headers.get("Retry-After")
-            wait_s = float(retry_after) if retry_after else min(2 ** attempt, 60)
-            time.sleep(wait_s)
-        elif resp.status_code >= 500 and attempt <= max_retries:
-            time.sleep(min(2 ** attempt, 10))
-        else:
-            return resp
+            if resp.status_code in (200, 404):
+                metrics.record_call(api, "ok")
+                return resp
+            if resp.status_code == 429:
+                metrics.record_call(api, "429")
+                # With Retry-After the limiter already holds back every caller of this API
+                if call.retry_after is None:
+                    time.sleep(min(2 ** attempt, 60))
+            elif resp.status_code >= 500 and attempt <= max_retries:
+                metrics.record_call(api, "retry")
+                time.sleep(min(2 ** attempt, 10))
+            else:
+                metrics.record_call(api, "error")
+                return resp
+
+
+# --- Road-aligned headings ---
+# In heading_mode="road" each pano is shot along the road in both directions, tilted down
+ROAD_PITCH = -20
+ROAD_MATCH_MAX_M = 25.0
+NEIGHBOR_PANO_MAX_M = 300.0
+_EARTH_RADIUS_M = 6371000.0
+
+
+def bearing_deg(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Initial great-circle bearing from point 1 to point 2, degrees clockwise from north."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dl = math.radians(lon2 - lon1)
+    x = math.sin(dl) * math.cos(p2)
+    y = math.cos(p1) * math.sin(p2) - math.sin(p1) * math.cos(p2) * math.cos(dl)
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance in meters."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * _EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def _to_xy(lat: float, lon: float, lat0: float) -> Tuple[float, float]:
+    """Local equirectangular meters; fine at the few-hundred-meter scale used here."""
+    return (math.radians(lon) * math.cos(math.radians(lat0)) * _EARTH_RADIUS_M,
+            math.radians(lat) * _EARTH_RADIUS_M)
+
+
+class RoadIndex:
+    """Nearest-road-segment lookup over LineString/MultiLineString features of a GeoJSON file."""
+
+    def __init__(self, segments: List[Tuple[Tuple[float, float], Tuple[float, float]]], cell_deg: float = 0.001):
+        self.segments = segments
+        self.cell_deg = cell_deg
+        self.cells = {}
+        for i, ((lat1, lon1), (lat2, lon2)) in enumerate(segments):
+            for ci in range(int(math.floor(min(lat1, lat2) / cell_deg)), int(math.floor(max(lat1, lat2) / cell_deg)) + 1):
+                for cj in range(int(math.floor(min(lon1, lon2) / cell_deg)), int(math.floor(max(lon1, lon2) / cell_deg)) + 1):
+                    self.cells.setdefault((ci, cj), []).append(i)
+
+    @classmethod
+    def from_geojson(cls, path: str) -> "RoadIndex":
+        with open(path, "r") as f:
+            data = json.load(f)
+        features = data.get("features", [data]) if isinstance(data, dict) else data
+        segments = []
+        for feature in features:
+            geom = feature.get("geometry", feature)
+            if geom.get("type") == "LineString":
+                lines = [geom["coordinates"]]
+            elif geom.get("type") == "MultiLineString":
+                lines = geom["coordinates"]
+            else:
+                continue
+            for line in lines:
+                # GeoJSON positions are [lon, lat]
+                for (lon1, lat1, *_), (lon2, lat2, *_) in zip(line, line[1:]):
+                    segments.append(((lat1, lon1), (lat2, lon2)))
+        return cls(segments)
+
+    def bearing_at(self, lat: float, lon: float, max_dist_m: float = ROAD_MATCH_MAX_M) -> Optional[float]:
+        """Bearing (0-360) of the nearest road segment within max_dist_m, or None."""
+        reach = int(math.ceil(max_dist_m / 111000.0 / self.cell_deg / max(math.cos(math.radians(lat)), 0.1)))
+        ci, cj = int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+        candidates = set()
+        for di in range(-reach, reach + 1):
+            for dj in range(-reach, reach + 1):
+                candidates.update(self.cells.get((ci + di, cj + dj), ()))
+
+        px, py = _to_xy(lat, lon, lat)
+        best, best_dist = None, max_dist_m
+        for i in candidates:
+            (lat1, lon1), (lat2, lon2) = self.segments[i]
+            ax, ay = _to_xy(lat1, lon1, lat)
+            bx, by = _to_xy(lat2, lon2, lat)
+            dx, dy = bx - ax, by - ay
+            seg_len2 = dx * dx + dy * dy
+            t = 0.0 if seg_len2 == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / seg_len2))
+            dist = math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+            if dist <= best_dist and seg_len2 > 0:
+                best, best_dist = i, dist
+        if best is None:
+            return None
+        (lat1, lon1), (lat2, lon2) = self.segments[best]
+        return bearing_deg(lat1, lon1, lat2, lon2)
+
+
+def bearings_from_panos(query: dict, pano_locs: List[Tuple[float, float]],
+                        max_dist_m: float = NEIGHBOR_PANO_MAX_M) -> dict:
+    """
+    Road bearing estimate for each {key: (lat, lon)} in query: the bearing to the nearest
+    other pano in pano_locs within max_dist_m (Street View panos are strung along roads).
+    Keys with no neighbour in range are left out.
+    """
+    if not pano_locs:
+        return {}
+    cell = max_dist_m / 111000.0
+    mean_lat = sum(lat for lat, _ in pano_locs) / len(pano_locs)
+    lon_cell = cell / max(math.cos(math.radians(mean_lat)), 0.1)
+    grid = {}
+    for loc in set(pano_locs):
+        grid.setdefault((int(loc[0] // cell), int(loc[1] // lon_cell)), []).append(loc)
+
+    out = {}
+    for key, (lat, lon) in query.items():
+        ci, cj = int(lat // cell), int(lon // lon_cell)
+        px, py = _to_xy(lat, lon, lat)
+        best, best_dist = None, max_dist_m
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for olat, olon in grid.get((ci + di, cj + dj), ()):
+                    ox, oy = _to_xy(olat, olon, lat)
+                    dist = math.hypot(ox - px, oy - py)
+                    if 1.0 < dist <= best_dist:  # skip the pano itself (several points snap to it)
+                        best, best_dist = (olat, olon), dist
+        if best is not None:
+            out[key] = bearing_deg(lat, lon, best[0], best[1])
+    return out
+
+
+def road_headings(bearing: float) -> List[int]:
+    """Views along the road in both directions."""
+    return [int(round(bearing)) % 360, int(round(bearing + 180)) % 360]
 
 
 def street_view_metadata(api_key: str, lat: float, lon: float) -> dict:
@@ -166,12 +320,240 @@ def street_view_image_url(
     return STREET_VIEW_IMAGE_URL, params
 
 
+def load_pano_state(path: str) -> dict:
+    """
+    Load the per-point pano state kept between surveys.
+
+    {"points": {"<grid lat>,<grid lon>": {"pano_id", "date", "pano_key"}},
+     "panos": {"<pano lat>_<pano lon>": {"pano_id", "date", "hazard_ids": [...]}}}
+    """
+    if path and os.path.exists(path):
+        with open(path, "r") as f:
+            state = json.load(f)
+    else:
+        state = {}
+    state.setdefault("points", {})
+    state.setdefault("panos", {})
+    return state
+
+
+def save_pano_state(path: str, state: dict):
+    # Unique temp name: several processes may save the same state file
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def pano_state_lock(path: str):
+    """Exclusive lock on a sidecar {path}.lock, held across processes for a load-merge-save."""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
 def save_image(content: bytes, out_path: str):
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
     with open(out_path, "wb") as f:
         f.write(content)
 
 
+def new_download_summary() -> dict:
+    return {"requests": 0, "downloaded_panos": set(), "unchanged_panos": set(), "touched_points": set(),
+            "point_panos": {}, "staged_points": {}, "staged_panos": {}, "complete_panos": set()}
+
+
+def commit_points(pano_state: dict, summary: dict, failed_panos=()) -> set:
+    """
+    Apply the pano state iter_downloads staged in summary, for points whose pano had every
+    view downloaded and is not in failed_panos (panos with an image that failed upload or
+    analysis). Committed points are added to summary["touched_points"] and returned; the
+    rest keep their previous state, so the next incremental survey fetches them again.
+    """
+    committed = set()
+    complete = summary.get("complete_panos", set())
+    for grid_key, point in summary.get("staged_points", {}).items():
+        pano_key = point["pano_key"]
+        if pano_key not in complete or pano_key in failed_panos:
+            continue
+        pano_state["points"][grid_key] = point
+        pano_state["panos"][pano_key] = summary["staged_panos"][pano_key]
+        committed.add(grid_key)
+    summary.setdefault("touched_points", set()).update(committed)
+    return committed
+
+
+class StreetViewImage(NamedTuple):
+    lat: float
+    lon: float
+    heading: int
+    pano_id: Optional[str]
+    content: bytes
+    filename: str
+
+
+def iter_downloads(
+    api_key: str,
+    points: List[Tuple[float, float]],
+    headings: List[int],
+    size: Tuple[int, int] = (640, 640),
+    fov: int = 90,
+    pitch: int = 0,
+    use_metadata: bool = True,
+    max_per_minute: int = 30000,
+    max_requests: Optional[int] = None,
+    pano_state: Optional[dict] = None,
+    skip_unchanged: bool = False,
+    skip_panos: Optional[set] = None,
+    heading_mode: str = "fixed",
+    road_index: Optional[RoadIndex] = None,
+    road_pitch: int = ROAD_PITCH,
+    summary: Optional[dict] = None,
+    log_writer=None,
+) -> Iterator[StreetViewImage]:
+    """
+    Generator behind run_downloader: yields each downloaded image as a StreetViewImage
+    instead of writing it to disk. summary (see new_download_summary) is filled in as it
+    runs; log_writer, a csv.writer, gets the downloads.csv rows.
+    """
+    if heading_mode not in ("fixed", "road"):
+        raise ValueError("heading_mode must be 'fixed' or 'road'")
+    if heading_mode == "road" and not use_metadata:
+        raise ValueError("heading_mode='road' needs the metadata pre-check")
+    limiter = RateLimiter(max_per_minute)
+    log = log_writer.writerow if log_writer is not None else (lambda row: None)
+    if summary is None:
+        summary = new_download_summary()
+    skip_panos = skip_panos or set()
+
+    prefetched = {}
+    road_bearings = {}
+    if heading_mode == "road":
+        for lat, lon in tqdm(points, desc="Metadata", unit="pt"):
+            prefetched[(lat, lon)] = street_view_metadata(api_key, lat, lon)
+        pano_locs = {}
+        for point, md in prefetched.items():
+            if md.get("status") == "OK":
+                loc = md.get("location") or {}
+                pano_locs[point] = (float(loc.get("lat", point[0])), float(loc.get("lng", point[1])))
+        if road_index is not None:
+            for point, (plat, plon) in pano_locs.items():
+                b = road_index.bearing_at(plat, plon)
+                if b is not None:
+                    road_bearings[point] = b
+        road_bearings.update(bearings_from_panos(
+            {k: v for k, v in pano_locs.items() if k not in road_bearings}, list(pano_locs.values())
+        ))
+        print(f"Road bearings found for {len(road_bearings)}/{len(pano_locs)} panos")
+
+    try:
+        for i, (lat, lon) in enumerate(tqdm(points, desc="Points", unit="pt")):
+            metrics.set_gauge("pothole_queue_depth", len(points) - i, {"queue": "download_points"})
+            pano_id: Optional[str] = None
+            date: Optional[str] = None
+            src = "location"
+            if (lat, lon) in road_bearings:
+                point_headings = road_headings(road_bearings[(lat, lon)])
+                point_pitch = road_pitch
+            else:
+                point_headings = headings
+                point_pitch = pitch
+            if use_metadata:
+                md = prefetched.get((lat, lon)) or street_view_metadata(api_key, lat, lon)
+                status = md.get("status", "UNKNOWN")
+                if status == "OK":
+                    grid_key = f"{lat},{lon}"
+                    pano_id = md.get("pano_id")
+                    date = md.get("date")
+                    loc = md.get("location") or {}
+                    lat = float(loc.get("lat", lat))
+                    lon = float(loc.get("lng", lon))
+                    src = "pano" if pano_id else "location"
+                    pano_key = f"{lat}_{lon}"
+                    summary["point_panos"][grid_key] = pano_key
+
+                    unchanged = False
+                    if pano_state is not None and pano_id:
+                        prev = pano_state["points"].get(grid_key) or {}
+                        unchanged = prev.get("pano_id") == pano_id and prev.get("date") == date
+                        # Staged only: commit_points() applies it once the pano made it through
+                        summary["staged_points"][grid_key] = {"pano_id": pano_id, "date": date, "pano_key": pano_key}
+                        if pano_key not in summary["staged_panos"]:
+                            entry = pano_state["panos"].get(pano_key) or {}
+                            same = entry.get("pano_id") == pano_id and entry.get("date") == date
+                            # New imagery: earlier hazards belong to the old capture
+                            summary["staged_panos"][pano_key] = {
+                                "pano_id": pano_id, "date": date,
+                                "hazard_ids": list(entry.get("hazard_ids", [])) if same else [],
+                            }
+
+                    if pano_id and (pano_key in summary["downloaded_panos"] or pano_key in summary["unchanged_panos"]
+                                    or pano_key in skip_panos):
+                        for hdg in point_headings:
+                            log([lat, lon, hdg, "", "DUPLICATE_PANO", src, pano_id, date])
+                        continue
+
+                    if skip_unchanged and unchanged:
+                        summary["unchanged_panos"].add(pano_key)
+                        summary["complete_panos"].add(pano_key)
+                        for hdg in point_headings:
+                            log([lat, lon, hdg, "", "UNCHANGED", src, pano_id, date])
+                        continue
+                    if pano_id:
+                        summary["downloaded_panos"].add(pano_key)
+                else:
+                    # no panorama nearby; skip
+                    for hdg in point_headings:
+                        log([lat, lon, hdg, "", status, "metadata", "", ""])
+                    continue
+
+            complete = True
+            for heading in point_headings:
+                if max_requests is not None and summary["requests"] >= max_requests:
+                    return
+                # Rate limit before each request
+                limiter.wait()
+                url, params = street_view_image_url(
+                    api_key=api_key,
+                    size=size,
+                    heading=heading,
+                    fov=fov,
+                    pitch=point_pitch,
+                    location=None if pano_id else (lat, lon),
+                    pano_id=pano_id,
+                )
+                resp = request_with_retries(url, params, max_retries=3)
+                summary["requests"] += 1
+                status = resp.status_code
+                if status == 200:
+                    pitch_tag = f"_pitch_{point_pitch}" if point_pitch else ""
+                    filename = f"lat_{lat}_lon_{lon}_hdg_{heading}{pitch_tag}_{src}.jpg"
+                    log([lat, lon, heading, filename, "OK", src, pano_id or "", date or ""])
+                    yield StreetViewImage(lat, lon, heading, pano_id, resp.content, filename)
+                else:
+                    complete = False
+                    log([lat, lon, heading, "", f"HTTP_{status}", src, pano_id or "", date or ""])
+            if pano_id and complete:
+                summary["complete_panos"].add(f"{lat}_{lon}")
+    finally:
+        metrics.set_gauge("pothole_queue_depth", 0, {"queue": "download_points"})
+
+
 def run_downloader(
     api_key: str,
     points: List[Tuple[float, float]],
@@ -183,63 +565,52 @@ def run_downloader(
     use_metadata: bool = True,
     max_per_minute: int = 30000,
     max_requests: Optional[int] = None,
-):
+    pano_state: Optional[dict] = None,
+    skip_unchanged: bool = False,
+    skip_panos: Optional[set] = None,
+    heading_mode: str = "fixed",
+    road_index: Optional[RoadIndex] = None,
+    road_pitch: int = ROAD_PITCH,
+) -> dict:
+    """
+    Download Street View images for each point and heading into output_dir.
+
+    With pano_state (see load_pano_state), each point's pano id and capture date from the
+    metadata call are staged in the summary for commit_points() to apply once the images
+    have been processed; with skip_unchanged, points whose pano id and date match the
+    previous survey are not downloaded again. A pano already downloaded in this
+    run (several grid points often snap to the same one) is never fetched twice, nor is
+    any pano in skip_panos.
+
+    Returns a summary (see new_download_summary) where point_panos maps "<grid lat>,<grid lon>" to the pano key
+    ("<pano lat>_<pano lon>", as in the image filenames).
+
+    With heading_mode="road", metadata for all points is fetched first (metadata calls are
+    free) and each pano gets just two views, along the road in both directions at road_pitch.
+    The road bearing comes from the nearest segment in road_index if given, else from the
+    bearing to the nearest neighbouring pano. Panos with no bearing fall back to headings.
+    Non-zero pitches are recorded in the filename as _pitch_<p> for ground projection.
+    """
     os.makedirs(output_dir, exist_ok=True)
-    limiter = RateLimiter(max_per_minute)
     log_path = os.path.join(output_dir, "downloads.csv")
     log_file = open(log_path, "a", newline="")
     log_writer = csv.writer(log_file)
     if os.stat(log_path).st_size == 0:
-        log_writer.writerow(["lat", "lon", "heading", "filename", "status", "source"])  # header
-
-    total_requests = 0
-    for lat, lon in tqdm(points, desc="Points", unit="pt"):
-        pano_id: Optional[str] = None
-        src = "location"
-        if use_metadata:
-            md = street_view_metadata(api_key, lat, lon)
-            status = md.get("status", "UNKNOWN")
-            if status == "OK":
-                pano_id = md.get("pano_id")
-                loc = md.get("location") or {}
-                lat = float(loc.get("lat", lat))
-                lon = float(loc.get("lng", lon))
-                src = "pano" if pano_id else "location"
-            else:
-                # no panorama nearby; skip
-                for hdg in headings:
-                    log_writer.writerow([lat, lon, hdg, "", status, "metadata"])
-                continue
+        log_writer.writerow(["lat", "lon", "heading", "filename", "status", "source", "pano_id", "date"])  # header
 
-        for heading in headings:
-            if max_requests is not None and total_requests >= max_requests:
-                log_file.flush()
-                log_file.close()
-                return
-            # Rate limit before each request
-            limiter.wait()
-            url, params = street_view_image_url(
-                api_key=api_key,
-                size=size,
-                heading=heading,
-                fov=fov,
-                pitch=pitch,
-                location=None if pano_id else (lat, lon),
-                pano_id=pano_id,
-            )
-            resp = request_with_retries(url, params, max_retries=3)
-            total_requests += 1
-            status = resp.status_code
-            if status == 200:
-                filename = f"lat_{lat}_lon_{lon}_hdg_{heading}_{src}.jpg"
-                out_path = os.path.join(output_dir, filename)
-                save_image(resp.content, out_path)
-                log_writer.writerow([lat, lon, heading, filename, "OK", src])
-            else:
-                log_writer.writerow([lat, lon, heading, "", f"HTTP_{status}", src])
-
-    log_file.flush()
-    log_file.close()
+    summary = new_download_summary()
+    try:
+        for image in iter_downloads(
+            api_key, points, headings, size=size, fov=fov, pitch=pitch, use_metadata=use_metadata,
+            max_per_minute=max_per_minute, max_requests=max_requests, pano_state=pano_state,
+            skip_unchanged=skip_unchanged, skip_panos=skip_panos, heading_mode=heading_mode,
+            road_index=road_index, road_pitch=road_pitch, summary=summary, log_writer=log_writer,
+        ):
+            save_image(image.content, os.path.join(output_dir, image.filename))
+    finally:
+        log_file.flush()
+        log_file.close()
+    return summary
 
 
 def parse_args():
@@ -259,6 +630,9 @@ def parse_args():
     parser.add_argument("--no_metadata", action="store_true", help="Skip Street View metadata pre-check")
     parser.add_argument("--max_per_minute", type=int, default=60, help="Rate limit requests per minute")
     parser.add_argument("--max_requests", type=int, default=None, help="Optional cap on total requests")
+    parser.add_argument("--heading_mode", choices=["fixed", "road"], default="fixed", help="'road': two views along the road per pano instead of --headings")
+    parser.add_argument("--road_geometry", type=str, default=None, help="GeoJSON of road LineStrings for --heading_mode road (else bearing to the nearest pano)")
+    parser.add_argument("--road_pitch", type=int, default=ROAD_PITCH, help="Camera pitch for road-aligned views")
     args = parser.parse_args()
     if not args.api_key:
         raise SystemExit("Missing API key. Set --api_key or GOOGLE_MAPS_API_KEY.")
@@ -287,10 +661,27 @@ def main():
         use_metadata=(not args.no_metadata),
         max_per_minute=args.max_per_minute,
         max_requests=args.max_requests,
+        heading_mode=args.heading_mode,
+        road_index=RoadIndex.from_geojson(args.road_geometry) if args.road_geometry else None,
+        road_pitch=args.road_pitch,
     )
 
 def generate_folder(lat_min, lat_max, lon_min, lon_max, grid_step: float = 0.002):
     """Generates a folder of Street View images for a given bounding box."""
+    temp_dir, _ = generate_folder_incremental(lat_min, lat_max, lon_min, lon_max, grid_step)
+    return temp_dir
+
+
+def generate_folder_incremental(lat_min, lat_max, lon_min, lon_max, grid_step: float = 0.002,
+                                pano_state: Optional[dict] = None, skip_unchanged: bool = False,
+                                heading_mode: str = "fixed", road_index: Optional[RoadIndex] = None):
+    """
+    Like generate_folder, but stages pano ids/capture dates against pano_state and, with
+    skip_unchanged, only downloads panos that changed since the previous survey.
+    heading_mode="road" takes two road-aligned views per pano (see run_downloader).
+
+    Returns (folder_path, run_downloader summary).
+    """
     _ensure_env_loaded()
     api_key = os.environ.get("GOOGLE_MAPS_API_KEY")
     if not api_key:
@@ -304,7 +695,7 @@ def generate_folder(lat_min, lat_max, lon_min, lon_max, grid_step: float = 0.002
         points = generate_grid((lat_min, lat_max, lon_min, lon_max), grid_step)
 
         # Call the existing downloader function
-        run_downloader(
+        summary = run_downloader(
             api_key=api_key,
             points=points,
             output_dir=temp_dir,
@@ -316,8 +707,12 @@ def generate_folder(lat_min, lat_max, lon_min, lon_max, grid_step: float = 0.002
             use_metadata=True,
             max_per_minute=30000,
             max_requests=None,
+            pano_state=pano_state,
+            skip_unchanged=skip_unchanged,
+            heading_mode=heading_mode,
+            road_index=road_index,
         )
-        return temp_dir
+        return temp_dir, summary
     except Exception as e:
         # Clean up the temporary directory in case of an error
         shutil.rmtree(temp_dir)
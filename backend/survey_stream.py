@@ -0,0 +1,129 @@
+"""
+survey_stream.py
+Bounded channel between the Street View downloader and the survey workers.
+
+Items carry image bytes. Up to memory_cap bytes are held in memory; past that, payloads
+are spilled to files in a private temp dir and read back (and deleted) by the consumer.
+Once the spill dir also holds disk_cap bytes, put() blocks until the consumer catches up,
+so memory and disk stay bounded however large the bbox is.
+
+The producer calls close() when it is done; a consumer that gives up calls cancel() so a
+blocked producer fails instead of hanging. cleanup() (or leaving the `with` block)
+removes the spill dir.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+
+import metrics
+
+DEFAULT_MEMORY_CAP = int(os.getenv("SURVEY_STREAM_MEMORY_MB", "64")) * 1024 * 1024
+DEFAULT_DISK_CAP = int(os.getenv("SURVEY_STREAM_SPILL_MB", "1024")) * 1024 * 1024
+
+
+class ChannelCancelled(Exception):
+    pass
+
+
+class SpillChannel:
+    def __init__(self, memory_cap: int = DEFAULT_MEMORY_CAP, disk_cap: int = DEFAULT_DISK_CAP, name: str = "survey_stream"):
+        self.memory_cap = memory_cap
+        self.disk_cap = disk_cap
+        self.name = name
+        self._cond = threading.Condition()
+        self._items = deque()   # (meta, data or None, spill_path or None, size)
+        self._mem = 0
+        self._disk = 0
+        self._closed = False
+        self._cancelled = False
+        self._spill_dir = None
+        self._seq = 0
+        self.spilled = 0
+        self.peak_memory = 0
+        self.peak_disk = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+    def _publish(self):
+        metrics.set_gauge("pothole_queue_depth", len(self._items), {"queue": self.name})
+        metrics.set_gauge("pothole_stream_buffer_bytes", self._mem, {"where": "memory"})
+        metrics.set_gauge("pothole_stream_buffer_bytes", self._disk, {"where": "disk"})
+
+    def put(self, meta, data: bytes):
+        size = len(data)
+        with self._cond:
+            while True:
+                if self._cancelled:
+                    raise ChannelCancelled()
+                # An item larger than the cap still goes through when the buffer is empty
+                if self._mem + size <= self.memory_cap or (self._mem == 0 and self._disk == 0):
+                    self._items.append((meta, data, None, size))
+                    self._mem += size
+                    self.peak_memory = max(self.peak_memory, self._mem)
+                    break
+                if self._disk + size <= self.disk_cap:
+                    if self._spill_dir is None:
+                        self._spill_dir = tempfile.mkdtemp(prefix="survey_spill_")
+                    self._seq += 1
+                    path = os.path.join(self._spill_dir, f"{self._seq}.bin")
+                    with open(path, "wb") as f:
+                        f.write(data)
+                    self._items.append((meta, None, path, size))
+                    self._disk += size
+                    self.spilled += 1
+                    self.peak_disk = max(self.peak_disk, self._disk)
+                    break
+                self._cond.wait()
+            self._publish()
+            self._cond.notify_all()
+
+    def get(self):
+        """Next (meta, data), or None once the channel is closed and drained."""
+        with self._cond:
+            while not self._items:
+                if self._closed or self._cancelled:
+                    return None
+                self._cond.wait()
+            meta, data, path, size = self._items.popleft()
+            if path is None:
+                self._mem -= size
+            else:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.remove(path)
+                self._disk -= size
+            self._publish()
+            self._cond.notify_all()
+            return meta, data
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._items.clear()
+            self._mem = self._disk = 0
+            self._publish()
+            self._cond.notify_all()
+
+    def cleanup(self):
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
@@ -0,0 +1,387 @@
+"""
+survey_tiles.py
+Tile queue for surveys sharded across worker processes (see survey_worker.py).
+
+partition_survey() splits a survey bbox into tiles holding roughly equal amounts of road,
+cutting only between grid rows/columns so every grid point lands in exactly one tile.
+Road density comes from a RoadIndex when one is configured; without it every grid point
+counts the same.
+
+TileStore keeps surveys and tiles in SQLite (SURVEY_TILE_DB). Put the file on storage all
+nodes can reach, or swap the class for a shared database with the same methods. A worker
+lease()s a tile, renew()s the lease while it works and complete()s or fail()s it; a lease
+that runs past its expiry is handed to the next worker that asks (reap() fails it once it
+is out of attempts), and results reported under a lost lease are ignored.
+
+Inserts made while running a tile go through claim_item()/record_item(), keyed per
+(pano, heading): a claim only succeeds while the lease is still held and only once per key
+for the tile, so a worker that lost its lease stops inserting and a re-queued tile skips
+images an earlier attempt already recorded. A crash between claim and insert loses that
+one image instead of duplicating it.
+"""
+
+import json
+import math
+import os
+import sqlite3
+import time
+import uuid
+from typing import List, NamedTuple, Optional, Tuple
+
+TILE_DB_PATH = os.getenv("SURVEY_TILE_DB", os.path.join(os.path.dirname(__file__), ".survey_tiles.db"))
+LEASE_SECONDS = int(os.getenv("SURVEY_TILE_LEASE_S", "120"))
+MAX_ATTEMPTS = int(os.getenv("SURVEY_TILE_MAX_ATTEMPTS", "3"))
+
+
+# --- Partitioning ---
+
+def _axis(lo: float, hi: float, step: float) -> List[float]:
+    values = []
+    v = lo
+    while v <= hi + 1e-9:
+        values.append(round(v, 6))
+        v += step
+    return values
+
+
+def _point_weights(lats, lons, step, road_index) -> List[List[float]]:
+    """Road segments near each grid point (plus one, so roadless cells still cost something)."""
+    if road_index is None:
+        return [[1.0] * len(lons) for _ in lats]
+    cell = road_index.cell_deg
+    reach = max(0, int(math.ceil(step / 2 / cell)))
+    weights = []
+    for lat in lats:
+        row = []
+        ci = int(math.floor(lat / cell))
+        for lon in lons:
+            cj = int(math.floor(lon / cell))
+            segments = set()
+            for di in range(-reach, reach + 1):
+                for dj in range(-reach, reach + 1):
+                    segments.update(road_index.cells.get((ci + di, cj + dj), ()))
+            row.append(1.0 + len(segments))
+        weights.append(row)
+    return weights
+
+
+def _split(weights, rows: Tuple[int, int], cols: Tuple[int, int], k: int, out: list):
+    """Recursive weighted bisection of weights[rows][cols] into k blocks."""
+    r0, r1 = rows
+    c0, c1 = cols
+    n_rows, n_cols = r1 - r0, c1 - c0
+    if k <= 1 or n_rows * n_cols <= 1:
+        out.append((rows, cols))
+        return
+    k_left = k // 2
+    # Cut across the longer side; fall back to the other one when it is a single line
+    by_row = n_rows >= n_cols if n_rows > 1 and n_cols > 1 else n_rows > 1
+    if by_row:
+        sums = [sum(weights[i][c0:c1]) for i in range(r0, r1)]
+    else:
+        sums = [sum(weights[i][j] for i in range(r0, r1)) for j in range(c0, c1)]
+    target = sum(sums) * k_left / k
+    acc, cut = 0.0, 1
+    for idx, s in enumerate(sums[:-1]):
+        acc += s
+        cut = idx + 1
+        if acc >= target:
+            break
+    if by_row:
+        _split(weights, (r0, r0 + cut), cols, k_left, out)
+        _split(weights, (r0 + cut, r1), cols, k - k_left, out)
+    else:
+        _split(weights, rows, (c0, c0 + cut), k_left, out)
+        _split(weights, rows, (c0 + cut, c1), k - k_left, out)
+
+
+def partition_survey(lat_min, lat_max, lon_min, lon_max, grid_step, n_tiles, road_index=None) -> List[dict]:
+    """
+    Up to n_tiles tiles {"bbox": [lat_min, lat_max, lon_min, lon_max], "points", "weight"}.
+
+    Tile bboxes start on a grid point and end half a step past their last one, so
+    generate_grid(tile bbox, grid_step) yields exactly that tile's share of the grid.
+    """
+    lats = _axis(lat_min, lat_max, grid_step)
+    lons = _axis(lon_min, lon_max, grid_step)
+    weights = _point_weights(lats, lons, grid_step, road_index)
+    blocks = []
+    _split(weights, (0, len(lats)), (0, len(lons)), max(1, n_tiles), blocks)
+    tiles = []
+    for (r0, r1), (c0, c1) in blocks:
+        tiles.append({
+            "bbox": [lats[r0], round(lats[r1 - 1] + grid_step / 2, 7), lons[c0], round(lons[c1 - 1] + grid_step / 2, 7)],
+            "points": (r1 - r0) * (c1 - c0),
+            "weight": round(sum(sum(weights[i][c0:c1]) for i in range(r0, r1)), 1),
+        })
+    return tiles
+
+
+# --- Shared store ---
+
+class Lease(NamedTuple):
+    survey_id: str
+    tile_id: int
+    token: str
+    bbox: list
+    params: dict
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS surveys (
+    survey_id TEXT PRIMARY KEY,
+    params TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS tiles (
+    survey_id TEXT NOT NULL,
+    tile_id INTEGER NOT NULL,
+    bbox TEXT NOT NULL,
+    points INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | leased | done | failed
+    worker TEXT,
+    token TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    PRIMARY KEY (survey_id, tile_id)
+);
+CREATE INDEX IF NOT EXISTS tiles_status ON tiles (status, lease_expires);
+CREATE TABLE IF NOT EXISTS tile_items (
+    survey_id TEXT NOT NULL,
+    tile_id INTEGER NOT NULL,
+    item_key TEXT NOT NULL,
+    hazard_id TEXT,
+    PRIMARY KEY (survey_id, tile_id, item_key)
+);
+"""
+
+
+class TileStore:
+    def __init__(self, path: str = TILE_DB_PATH, lease_seconds: int = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+
+    def _connect(self):
+        # One short-lived connection per call keeps the store safe to share across threads and processes
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return _Tx(db)
+
+    def create_survey(self, survey_id: str, params: dict, tiles: List[dict]):
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("INSERT INTO surveys (survey_id, params, created_at) VALUES (?, ?, ?)",
+                       (survey_id, json.dumps(params), time.time()))
+            db.executemany(
+                "INSERT INTO tiles (survey_id, tile_id, bbox, points) VALUES (?, ?, ?, ?)",
+                [(survey_id, i, json.dumps(t["bbox"]), t["points"]) for i, t in enumerate(tiles)],
+            )
+
+    def reap(self) -> List[str]:
+        """Fail expired tiles that are out of attempts; returns the surveys this closed."""
+        closed = []
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute(
+                "SELECT survey_id, tile_id FROM tiles WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (time.time(), self.max_attempts),
+            ).fetchall()
+            for row in rows:
+                db.execute(
+                    "UPDATE tiles SET status = 'failed', error = 'lease expired', worker = NULL, token = NULL, "
+                    "lease_expires = NULL WHERE survey_id = ? AND tile_id = ?",
+                    (row["survey_id"], row["tile_id"]),
+                )
+            for survey_id in {row["survey_id"] for row in rows}:
+                if self._finish_if_done(db, survey_id):
+                    closed.append(survey_id)
+        return closed
+
+    def lease(self, worker: str, survey_id: Optional[str] = None) -> Optional[Lease]:
+        """Claim the next pending (or expired) tile, oldest survey first."""
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                """
+                SELECT t.survey_id, t.tile_id, t.bbox, s.params FROM tiles t
+                JOIN surveys s ON s.survey_id = t.survey_id
+                WHERE (t.status = 'pending' OR (t.status = 'leased' AND t.lease_expires < ? AND t.attempts < ?))
+                  AND (? IS NULL OR t.survey_id = ?)
+                ORDER BY s.created_at, t.tile_id LIMIT 1
+                """,
+                (now, self.max_attempts, survey_id, survey_id),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE tiles SET status = 'leased', worker = ?, token = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE survey_id = ? AND tile_id = ?",
+                (worker, token, now + self.lease_seconds, row["survey_id"], row["tile_id"]),
+            )
+        return Lease(row["survey_id"], row["tile_id"], token, json.loads(row["bbox"]), json.loads(row["params"]))
+
+    def renew(self, lease: Lease) -> bool:
+        """Extend the lease; False once it has been lost to another worker."""
+        with self._connect() as db:
+            cur = db.execute(
+                "UPDATE tiles SET lease_expires = ? WHERE survey_id = ? AND tile_id = ? AND token = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, lease.survey_id, lease.tile_id, lease.token),
+            )
+            return cur.rowcount == 1
+
+    def complete(self, lease: Lease, result: dict) -> Tuple[bool, bool]:
+        """Record a tile's result. Returns (accepted, survey_finished)."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            cur = db.execute(
+                "UPDATE tiles SET status = 'done', result = ?, lease_expires = NULL "
+                "WHERE survey_id = ? AND tile_id = ? AND token = ? AND status = 'leased'",
+                (json.dumps(result), lease.survey_id, lease.tile_id, lease.token),
+            )
+            if cur.rowcount != 1:
+                return False, False
+            return True, self._finish_if_done(db, lease.survey_id)
+
+    def fail(self, lease: Lease, error: str) -> Tuple[bool, bool]:
+        """Re-queue the tile, or mark it failed after max_attempts. Returns (requeued, survey_finished)."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT attempts FROM tiles WHERE survey_id = ? AND tile_id = ? AND token = ? AND status = 'leased'",
+                (lease.survey_id, lease.tile_id, lease.token),
+            ).fetchone()
+            if row is None:
+                return False, False
+            status = "pending" if row["attempts"] < self.max_attempts else "failed"
+            db.execute(
+                "UPDATE tiles SET status = ?, error = ?, worker = NULL, token = NULL, lease_expires = NULL "
+                "WHERE survey_id = ? AND tile_id = ?",
+                (status, error[:1000], lease.survey_id, lease.tile_id),
+            )
+            return status == "pending", self._finish_if_done(db, lease.survey_id)
+
+    def claim_item(self, lease: Lease, key: str) -> bool:
+        """Reserve one insert for this tile; False if the lease is gone or the key was claimed before."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            held = db.execute(
+                "SELECT 1 FROM tiles WHERE survey_id = ? AND tile_id = ? AND token = ? AND status = 'leased' "
+                "AND lease_expires >= ?",
+                (lease.survey_id, lease.tile_id, lease.token, time.time()),
+            ).fetchone()
+            if held is None:
+                return False
+            cur = db.execute(
+                "INSERT OR IGNORE INTO tile_items (survey_id, tile_id, item_key) VALUES (?, ?, ?)",
+                (lease.survey_id, lease.tile_id, key),
+            )
+            return cur.rowcount == 1
+
+    def release_item(self, lease: Lease, key: str):
+        """Undo a claim whose insert failed, so a later attempt can retry it."""
+        with self._connect() as db:
+            db.execute(
+                "DELETE FROM tile_items WHERE survey_id = ? AND tile_id = ? AND item_key = ? AND hazard_id IS NULL",
+                (lease.survey_id, lease.tile_id, key),
+            )
+
+    def record_item(self, lease: Lease, key: str, hazard_id):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE tile_items SET hazard_id = ? WHERE survey_id = ? AND tile_id = ? AND item_key = ?",
+                (None if hazard_id is None else str(hazard_id), lease.survey_id, lease.tile_id, key),
+            )
+
+    def recorded_items(self, survey_id: str, tile_id: int) -> set:
+        """Keys already claimed for the tile by any attempt."""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT item_key FROM tile_items WHERE survey_id = ? AND tile_id = ?", (survey_id, tile_id)
+            ).fetchall()
+        return {row["item_key"] for row in rows}
+
+    def inserted_items(self, survey_id: str, tile_id: int) -> set:
+        """Keys whose insert went through (a hazard id was recorded), by any attempt."""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT item_key FROM tile_items WHERE survey_id = ? AND tile_id = ? AND hazard_id IS NOT NULL",
+                (survey_id, tile_id),
+            ).fetchall()
+        return {row["item_key"] for row in rows}
+
+    def _finish_if_done(self, db, survey_id) -> bool:
+        open_tiles = db.execute(
+            "SELECT COUNT(*) FROM tiles WHERE survey_id = ? AND status IN ('pending', 'leased')", (survey_id,)
+        ).fetchone()[0]
+        if open_tiles:
+            return False
+        cur = db.execute("UPDATE surveys SET finished_at = ? WHERE survey_id = ? AND finished_at IS NULL",
+                         (time.time(), survey_id))
+        # Only the caller that closes the survey gets True
+        return cur.rowcount == 1
+
+    def status(self, survey_id: str) -> Optional[dict]:
+        """Per-survey rollup across tiles (counts by status, summed tile results)."""
+        with self._connect() as db:
+            survey = db.execute("SELECT * FROM surveys WHERE survey_id = ?", (survey_id,)).fetchone()
+            if survey is None:
+                return None
+            tiles = db.execute("SELECT * FROM tiles WHERE survey_id = ? ORDER BY tile_id", (survey_id,)).fetchall()
+        now = time.time()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        totals = {}
+        points_done = 0
+        workers = set()
+        errors = []
+        for t in tiles:
+            status = t["status"]
+            if status == "leased" and t["lease_expires"] < now:
+                status = "pending"   # expired; the next lease() picks it up again
+            counts[status] += 1
+            if status == "leased":
+                workers.add(t["worker"])
+            if t["status"] == "done":
+                points_done += t["points"]
+                for k, v in json.loads(t["result"] or "{}").items():
+                    if isinstance(v, (int, float)):
+                        totals[k] = totals.get(k, 0) + v
+            if t["status"] == "failed":
+                errors.append({"tile_id": t["tile_id"], "error": t["error"]})
+        return {
+            "survey_id": survey_id,
+            "state": "complete" if survey["finished_at"] else ("running" if counts["leased"] or counts["done"] else "queued"),
+            "tiles": len(tiles),
+            "tiles_by_status": counts,
+            "points": sum(t["points"] for t in tiles),
+            "points_done": points_done,
+            "active_workers": sorted(workers),
+            "totals": totals,
+            "failed_tiles": errors,
+            "created_at": survey["created_at"],
+            "finished_at": survey["finished_at"],
+        }
+
+
+class _Tx:
+    """Connection context: commits an open transaction on success, rolls back on error, always closes."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, *exc):
+        try:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.db.close()
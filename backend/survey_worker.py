@@ -0,0 +1,183 @@
+"""
+survey_worker.py
+Worker for sharded surveys: leases tiles from the shared TileStore (survey_tiles.py) and
+runs the normal download -> upload -> analyze pipeline on each one.
+
+The lease is renewed in the background while a tile runs. A worker that dies simply stops
+renewing; its tile is re-queued once the lease expires. A worker that notices it lost its
+lease stops before its next insert, and every insert is claimed per (pano, heading) in the
+store first, so a re-run tile never inserts the same image twice (see _TileGate). The worker
+that completes the last tile of a survey marks it complete in the surveys table with the
+hazards summed over tiles.
+
+Start as many as you like, on any node that can reach SURVEY_TILE_DB:
+    python backend/survey_worker.py --processes 4
+    python backend/survey_worker.py --survey_id <id> --exit_when_idle
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+import metrics
+from survey_tiles import TileStore
+
+
+def _renew_until(store, lease, stop, lost):
+    interval = max(1.0, store.lease_seconds / 3)
+    while not stop.wait(interval):
+        if not store.renew(lease):
+            lost.set()
+            print(f"[worker] lost lease on tile {lease.survey_id}/{lease.tile_id}")
+            return
+
+
+class _TileGate:
+    """Cancellation check and per-item insert claims for server._survey_pipeline on one leased tile."""
+
+    def __init__(self, store, lease, lost):
+        self.store = store
+        self.lease = lease
+        self.lost = lost
+        self.recorded = store.recorded_items(lease.survey_id, lease.tile_id)
+        self.inserted = store.inserted_items(lease.survey_id, lease.tile_id)
+        self.skipped = set()  # recorded keys that have a hazard row (counted as inserted_earlier)
+        self._lock = threading.Lock()
+
+    def cancelled(self) -> bool:
+        return self.lost.is_set()
+
+    def is_recorded(self, key) -> bool:
+        if key in self.recorded:
+            if key in self.inserted:
+                with self._lock:
+                    self.skipped.add(key)
+            return True
+        return False
+
+    def claim(self, key) -> bool:
+        if self.lost.is_set():
+            return False
+        if self.store.claim_item(self.lease, key):
+            return True
+        # Either the key was claimed before or the lease expired between renewals; an
+        # expired lease nobody else took can still be renewed, and then the claim retried
+        if not self.store.renew(self.lease):
+            self.lost.set()
+            return False
+        return self.store.claim_item(self.lease, key)
+
+    def release(self, key):
+        self.store.release_item(self.lease, key)
+
+    def done(self, key, hazard_id):
+        self.store.record_item(self.lease, key, hazard_id)
+
+
+def run_tile(store, lease) -> dict:
+    """Run one leased tile through the survey pipeline and report the outcome to the store."""
+    import server
+
+    params = lease.params
+    stop, lost = threading.Event(), threading.Event()
+    gate = _TileGate(store, lease, lost)
+    renewer = threading.Thread(target=_renew_until, args=(store, lease, stop, lost), daemon=True)
+    renewer.start()
+    try:
+        with metrics.timed("survey_tile"):
+            pano_state, download_summary, inserted, failures = server._survey_pipeline(
+                *lease.bbox, params["grid_step"], params.get("incremental", False), params.get("adaptive"),
+                params.get("heading_mode", "fixed"), params.get("stream", False), gate=gate,
+            )
+        carried = server._record_survey_outcome(pano_state, download_summary, inserted, failures)
+    except server.SurveyCancelled:
+        # The tile belongs to another worker now; it skips whatever this run already inserted
+        print(f"[worker] tile {lease.survey_id}/{lease.tile_id} stopped: lease lost")
+        return {"error": "lease lost"}
+    except Exception as e:
+        stop.set()
+        requeued, finished = store.fail(lease, str(e))
+        print(f"[worker] tile {lease.survey_id}/{lease.tile_id} failed ({e}); "
+              f"{'re-queued' if requeued else 'giving up'}")
+        if finished:
+            _close_survey(store, lease.survey_id)
+        return {"error": str(e)}
+    finally:
+        stop.set()
+        renewer.join()
+
+    result = {
+        "inserted": len(inserted),
+        "inserted_earlier": len(gate.skipped),
+        "carried": carried,
+        "failed": len(failures),
+        "hazards_found": len(inserted) + len(gate.skipped) + carried,
+    }
+    accepted, finished = store.complete(lease, result)
+    if not accepted:
+        # Lost right at the end: the rows are in, and the worker now holding the tile
+        # skips them and reports them as inserted_earlier
+        print(f"[worker] tile {lease.survey_id}/{lease.tile_id} finished after its lease was lost; "
+              f"{len(inserted)} insert(s) will be counted by the tile's new holder")
+    if finished:
+        _close_survey(store, lease.survey_id)
+    return result
+
+
+def _close_survey(store, survey_id):
+    import server
+
+    status = store.status(survey_id)
+    print(f"[worker] survey {survey_id} finished: {status['tiles_by_status']}, totals {status['totals']}")
+    server._mark_survey_complete(survey_id, int(status["totals"].get("hazards_found", 0)))
+
+
+def work(worker_id: str, survey_id=None, exit_when_idle: bool = False, idle_sleep: float = 5.0, store=None) -> int:
+    """Lease and run tiles until there are none left (exit_when_idle) or forever. Returns tiles run."""
+    store = store or TileStore()
+    done = 0
+    while True:
+        for closed in store.reap():
+            _close_survey(store, closed)
+        lease = store.lease(worker_id, survey_id)
+        if lease is None:
+            if exit_when_idle:
+                return done
+            time.sleep(idle_sleep)
+            continue
+        print(f"[worker {worker_id}] tile {lease.survey_id}/{lease.tile_id} bbox {lease.bbox}")
+        run_tile(store, lease)
+        done += 1
+
+
+def _worker_main(worker_id, survey_id, exit_when_idle):
+    work(worker_id, survey_id, exit_when_idle)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run sharded survey tiles from the shared tile store.")
+    parser.add_argument("--worker_id", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes to start on this node")
+    parser.add_argument("--survey_id", default=None, help="Only take tiles of this survey")
+    parser.add_argument("--exit_when_idle", action="store_true", help="Stop once no tile is left to lease")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        work(args.worker_id, args.survey_id, args.exit_when_idle)
+        return
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=_worker_main, args=(f"{args.worker_id}-{i}", args.survey_id, args.exit_when_idle))
+        for i in range(args.processes)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()
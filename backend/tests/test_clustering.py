@@ -0,0 +1,48 @@
+import pytest
+
+cv = pytest.importorskip("CV_model.cv")
+
+
+def _det(est_lat, est_lon, filename="a.jpg", lat=40.0, lon=-74.0, hdg=0, conf=0.5):
+    return {"est_lat": est_lat, "est_lon": est_lon, "filename": filename, "lat": lat, "lon": lon,
+            "hdg": hdg, "conf": conf}
+
+
+def test_nearby_detections_from_different_panos_merge():
+    # ~1 m apart, seen from two panos and headings; a third one ~100 m away
+    dets = [
+        _det(40.00000, -74.00000, "a.jpg", 40.0, -74.0, 0, 0.4),
+        _det(40.00001, -74.00000, "b.jpg", 40.0001, -74.0, 90, 0.8),
+        _det(40.00100, -74.00000, "c.jpg", 40.001, -74.0, 0, 0.6),
+    ]
+    clusters = sorted(cv.cluster_detections(dets, radius_m=5.0), key=lambda c: c["lat"])
+    assert [c["n_detections"] for c in clusters] == [2, 1]
+    assert clusters[0]["n_panos"] == 2
+    assert clusters[0]["headings"] == "0 90"
+    assert clusters[0]["max_conf"] == 0.8
+
+
+def test_chains_merge_transitively_and_generators_are_accepted():
+    # Each neighbour is ~4 m from the next, the ends ~12 m apart
+    dets = (_det(40.0 + i * 0.000036, -74.0) for i in range(4))
+    clusters = cv.cluster_detections(dets, radius_m=5.0)
+    assert len(clusters) == 1 and clusters[0]["n_detections"] == 4
+
+
+def test_empty_input():
+    assert cv.cluster_detections([]) == []
+
+
+def test_sweeping_latitude_stripes_matches_clustering_everything_at_once():
+    # A north-south chain crossing stripe boundaries, plus scattered singles
+    dets = [_det(40.0 + i * 0.000036, -74.0, f"{i}.jpg") for i in range(30)]
+    dets += [_det(40.0 + i * 0.0005, -73.99, f"s{i}.jpg") for i in range(10)]
+    lat0 = sum(d["est_lat"] for d in dets) / len(dets)
+    stripe_deg = 5.0 / 111195.0
+    stripes = {}
+    for d in dets:
+        stripes.setdefault(int(d["est_lat"] // stripe_deg), []).append(d)
+
+    swept = cv.sweep_clusters((stripes[k] for k in sorted(stripes)), 5.0, lat0)
+    whole = cv.cluster_detections(dets, radius_m=5.0)
+    assert sorted(c["n_detections"] for c in swept) == sorted(c["n_detections"] for c in whole) == [1] * 10 + [30]
@@ -0,0 +1,21 @@
+import pytest
+
+main = pytest.importorskip("gemini_prompt.main")
+
+
+def test_plain_json_object():
+    assert main._parse('{"severity": 3, "description": "pothole"}') == {"severity": 3, "description": "pothole"}
+
+
+def test_fenced_reply_with_prose_falls_back_to_outermost_object():
+    text = 'Here you go:\n```json\n{"severity": 5, "meta": {"a": 1}}\n```\nThanks'
+    assert main._parse(text) == {"severity": 5, "meta": {"a": 1}}
+
+
+def test_single_item_list_is_unwrapped():
+    assert main._parse('[{"severity": 1}]') == {"severity": 1}
+
+
+@pytest.mark.parametrize("text", ["", "not json", "[1, 2]", '{"severity": ', "}{", '["a", "b"]'])
+def test_unusable_replies_return_none(text):
+    assert main._parse(text) is None
@@ -0,0 +1,34 @@
+import base64
+import json
+
+import pytest
+
+server = pytest.importorskip("server")
+from werkzeug.exceptions import BadRequest
+
+
+def _raw_cursor(created_at, hazard_id):
+    return base64.urlsafe_b64encode(json.dumps([created_at, hazard_id]).encode()).decode()
+
+
+def test_round_trip_with_integer_id():
+    row = {"created_at": "2025-05-01T12:30:00.123456+00:00", "id": 42}
+    assert server._decode_cursor(server._encode_cursor(row)) == ("2025-05-01T12:30:00.123456+00:00", "42")
+
+
+def test_round_trip_with_uuid_id():
+    row = {"created_at": "2025-05-01T12:30:00+00:00", "id": "0f8fad5b-d9cb-469f-a165-70867728950e"}
+    assert server._decode_cursor(server._encode_cursor(row))[1] == row["id"]
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64 json",
+    _raw_cursor("2025-05-01T12:30:00+00:00,id.gt.0", 1),
+    _raw_cursor("2025-05-01T12:30:00+00:00", "1),or(id.gt.0"),
+    _raw_cursor("2025-05-01T12:30:00+00:00", True),
+    _raw_cursor(None, 1),
+    _raw_cursor("2025-05-01", "１２"),
+])
+def test_rejects_malformed_or_injected_cursors(cursor):
+    with pytest.raises(BadRequest):
+        server._decode_cursor(cursor)
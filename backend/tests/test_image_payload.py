@@ -0,0 +1,54 @@
+import hashlib
+import io
+
+import pytest
+
+image_payload = pytest.importorskip("image_payload")
+from PIL import Image
+
+
+@pytest.fixture
+def payload_map(tmp_path, monkeypatch):
+    pmap = image_payload.PayloadMap(str(tmp_path / "map.jsonl"), max_entries=2)
+    monkeypatch.setattr(image_payload, "_map", pmap)
+    return pmap
+
+
+def _jpeg(size=(64, 48), quality=60):
+    out = io.BytesIO()
+    Image.new("RGB", size, (120, 120, 120)).save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+
+def test_small_clean_jpeg_passes_through_and_is_recorded(payload_map):
+    data = _jpeg()
+    result = image_payload.normalize_bytes(data, "a.jpg", max_dim=1280, quality=95)
+    assert result.data == data and not result.changed
+
+    # Second pass (the Gemini fetch of the uploaded copy) short-circuits on the map
+    again = image_payload.normalize_bytes(data, "a.jpg", max_dim=1280, quality=95)
+    assert again.data == data and again.size is None
+
+
+def test_oversized_image_is_downsized(payload_map):
+    result = image_payload.normalize_bytes(_jpeg((400, 300)), "big.jpg", max_dim=100)
+    assert result.changed and max(result.size) == 100
+    assert payload_map.is_derived(hashlib.sha256(result.data).hexdigest())
+
+
+def test_payload_map_is_capped_and_compacted(tmp_path):
+    path = tmp_path / "map.jsonl"
+    pmap = image_payload.PayloadMap(str(path), max_entries=2)
+    for i in range(5):
+        pmap.add({"derived_sha256": f"d{i}", "original_sha256": f"o{i}"})
+    assert not pmap.is_derived("d0") and not pmap.is_derived("d2")
+    assert pmap.is_derived("d3") and pmap.is_derived("d4")
+    assert len(path.read_text().splitlines()) <= 4
+
+    reloaded = image_payload.PayloadMap(str(path), max_entries=2)
+    assert reloaded.is_derived("d4") and not reloaded.is_derived("d0")
+
+
+def test_normalization_is_opt_in(monkeypatch):
+    monkeypatch.setattr(image_payload, "NORMALIZE_ENABLED", False)
+    assert image_payload.maybe_normalize(b"not an image") == b"not an image"
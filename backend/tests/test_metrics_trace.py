@@ -0,0 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+def _work(i):
+    with metrics.timed("test_pool_stage", i=i):
+        pass
+
+
+def test_spans_from_pool_threads_reach_the_trace_only_when_bound():
+    metrics.start_trace("trace-test")
+    try:
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            list(pool.map(metrics.bind_trace(_work), range(4)))
+            list(pool.map(_work, range(2)))  # unbound: recorded in the histogram only
+    finally:
+        metrics.end_trace()
+    spans = metrics.get_trace("trace-test")["spans"]
+    assert sorted(s["i"] for s in spans) == [0, 1, 2, 3]
+
+
+def test_bind_trace_without_a_trace_returns_the_callable():
+    assert metrics.bind_trace(_work) is _work
@@ -0,0 +1,78 @@
+import types
+
+import pytest
+
+street_view = pytest.importorskip("street_view")
+
+
+def _run(monkeypatch, pano_state, metadata, failing_headings=()):
+    """iter_downloads over fake metadata/image responses; returns (images, summary)."""
+    monkeypatch.setattr(street_view, "street_view_metadata", lambda key, lat, lon: metadata[(lat, lon)])
+
+    def fake_request(url, params, **kwargs):
+        status = 500 if params.get("heading") in {str(h) for h in failing_headings} else 200
+        return types.SimpleNamespace(status_code=status, content=b"jpeg")
+
+    monkeypatch.setattr(street_view, "request_with_retries", fake_request)
+    summary = street_view.new_download_summary()
+    images = list(street_view.iter_downloads(
+        "key", list(metadata), [0, 90], pano_state=pano_state, skip_unchanged=True, summary=summary,
+    ))
+    return images, summary
+
+
+def _md(pano_id, date, lat, lon):
+    return {"status": "OK", "pano_id": pano_id, "date": date, "location": {"lat": lat, "lng": lon}}
+
+
+def test_state_is_staged_until_committed(monkeypatch):
+    state = {"points": {}, "panos": {}}
+    images, summary = _run(monkeypatch, state, {(1.0, 2.0): _md("p1", "2024-01", 1.1, 2.1)})
+    assert len(images) == 2
+    assert state == {"points": {}, "panos": {}}  # nothing written while downloading
+
+    assert street_view.commit_points(state, summary) == {"1.0,2.0"}
+    assert state["points"]["1.0,2.0"] == {"pano_id": "p1", "date": "2024-01", "pano_key": "1.1_2.1"}
+    assert state["panos"]["1.1_2.1"]["hazard_ids"] == []
+
+
+def test_failed_download_or_analysis_keeps_previous_state(monkeypatch):
+    previous = {"pano_id": "p0", "date": "2023-01", "pano_key": "1.1_2.1"}
+    state = {"points": {"1.0,2.0": dict(previous)},
+             "panos": {"1.1_2.1": {"pano_id": "p0", "date": "2023-01", "hazard_ids": [5]}}}
+    metadata = {(1.0, 2.0): _md("p1", "2024-01", 1.1, 2.1)}
+
+    _, summary = _run(monkeypatch, state, metadata, failing_headings=(90,))
+    assert street_view.commit_points(state, summary) == set()
+    assert state["points"]["1.0,2.0"] == previous
+
+    _, summary = _run(monkeypatch, state, metadata)
+    assert street_view.commit_points(state, summary, failed_panos={"1.1_2.1"}) == set()
+    assert state["panos"]["1.1_2.1"]["hazard_ids"] == [5]
+
+
+def test_unchanged_pano_is_skipped_and_keeps_its_hazards(monkeypatch):
+    state = {"points": {"1.0,2.0": {"pano_id": "p1", "date": "2024-01", "pano_key": "1.1_2.1"}},
+             "panos": {"1.1_2.1": {"pano_id": "p1", "date": "2024-01", "hazard_ids": [7]}}}
+    images, summary = _run(monkeypatch, state, {(1.0, 2.0): _md("p1", "2024-01", 1.1, 2.1)})
+    assert images == []
+    assert summary["unchanged_panos"] == {"1.1_2.1"}
+    street_view.commit_points(state, summary)
+    assert state["panos"]["1.1_2.1"]["hazard_ids"] == [7]
+
+
+def test_new_imagery_resets_hazards_on_commit(monkeypatch):
+    state = {"points": {"1.0,2.0": {"pano_id": "p1", "date": "2024-01", "pano_key": "1.1_2.1"}},
+             "panos": {"1.1_2.1": {"pano_id": "p1", "date": "2024-01", "hazard_ids": [7]}}}
+    _, summary = _run(monkeypatch, state, {(1.0, 2.0): _md("p2", "2025-06", 1.1, 2.1)})
+    summary["staged_panos"]["1.1_2.1"]["hazard_ids"].append(9)  # found during this survey
+    street_view.commit_points(state, summary)
+    assert state["panos"]["1.1_2.1"] == {"pano_id": "p2", "date": "2025-06", "hazard_ids": [9]}
+
+
+def test_save_and_load_under_the_file_lock(tmp_path):
+    path = str(tmp_path / "pano_state.json")
+    with street_view.pano_state_lock(path):
+        street_view.save_pano_state(path, {"points": {"a": 1}, "panos": {}})
+    assert street_view.load_pano_state(path) == {"points": {"a": 1}, "panos": {}}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["pano_state.json", "pano_state.json.lock"]
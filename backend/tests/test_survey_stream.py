@@ -0,0 +1,45 @@
+import os
+import threading
+
+from survey_stream import ChannelCancelled, SpillChannel
+
+
+def test_spills_past_memory_cap_and_replays_in_order():
+    with SpillChannel(memory_cap=10, disk_cap=1000) as channel:
+        payloads = [bytes([i]) * 4 for i in range(6)]
+        for i, data in enumerate(payloads):
+            channel.put(i, data)
+        channel.close()
+
+        assert channel.spilled == 4
+        assert channel.peak_memory <= 10
+        spill_dir = channel._spill_dir
+        assert len(os.listdir(spill_dir)) == 4
+
+        assert list(channel) == list(enumerate(payloads))
+        assert os.listdir(spill_dir) == []
+    assert not os.path.exists(spill_dir)
+
+
+def test_put_blocks_when_full_and_cancel_unblocks_it():
+    channel = SpillChannel(memory_cap=4, disk_cap=4)
+    channel.put("a", b"1234")
+    channel.put("b", b"5678")  # spilled
+    errors = []
+
+    def producer():
+        try:
+            channel.put("c", b"9999")
+        except ChannelCancelled as e:
+            errors.append(e)
+
+    t = threading.Thread(target=producer)
+    t.start()
+    t.join(0.2)
+    assert t.is_alive()  # memory and disk both full
+
+    channel.cancel()
+    t.join(2)
+    assert not t.is_alive() and errors
+    assert channel.get() is None
+    channel.cleanup()
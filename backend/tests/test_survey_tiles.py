@@ -0,0 +1,110 @@
+import threading
+import types
+
+import pytest
+
+import survey_tiles
+from survey_tiles import TileStore, partition_survey
+from survey_worker import _TileGate
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(survey_tiles, "time", types.SimpleNamespace(time=c.time))
+    return c
+
+
+@pytest.fixture
+def store(tmp_path, clock):
+    s = TileStore(str(tmp_path / "tiles.db"), lease_seconds=60, max_attempts=2)
+    s.create_survey("s1", {"grid_step": 0.01}, [{"bbox": [0, 0.01, 0, 0.01], "points": 4}])
+    return s
+
+
+def test_partition_covers_every_grid_point_once():
+    tiles = partition_survey(0.0, 0.1, 0.0, 0.1, 0.01, 4)
+    assert len(tiles) == 4
+    assert sum(t["points"] for t in tiles) == 11 * 11
+
+
+def test_expired_lease_is_requeued_and_old_holder_is_ignored(store, clock):
+    first = store.lease("w1")
+    assert store.lease("w2") is None  # still held
+
+    clock.now += 61
+    second = store.lease("w2")
+    assert second is not None and second.tile_id == first.tile_id
+
+    assert store.renew(first) is False
+    assert store.complete(first, {"hazards_found": 1}) == (False, False)
+    assert store.complete(second, {"hazards_found": 2}) == (True, True)
+    assert store.status("s1")["totals"] == {"hazards_found": 2}
+
+
+def test_fail_requeues_until_out_of_attempts(store):
+    lease = store.lease("w1")
+    assert store.fail(lease, "boom") == (True, False)
+    lease = store.lease("w1")
+    assert store.fail(lease, "boom again") == (False, True)
+    status = store.status("s1")
+    assert status["state"] == "complete"
+    assert status["tiles_by_status"]["failed"] == 1
+
+
+def test_reap_fails_expired_tile_out_of_attempts(store, clock):
+    store.lease("w1")
+    clock.now += 61
+    store.lease("w2")  # second and last attempt
+    clock.now += 61
+    assert store.reap() == ["s1"]
+    assert store.lease("w3") is None
+
+
+def test_item_claims_need_the_lease_and_are_once_per_tile(store, clock):
+    first = store.lease("w1")
+    assert store.claim_item(first, "0.0_0.0|90") is True
+    assert store.claim_item(first, "0.0_0.0|90") is False
+    store.record_item(first, "0.0_0.0|90", 7)
+
+    assert store.claim_item(first, "0.0_0.0|180") is True
+    store.release_item(first, "0.0_0.0|180")  # insert failed
+
+    clock.now += 61
+    assert store.claim_item(first, "0.0_0.0|270") is False  # lease expired
+
+    second = store.lease("w2")
+    assert store.recorded_items("s1", second.tile_id) == {"0.0_0.0|90"}
+    assert store.claim_item(second, "0.0_0.0|90") is False
+    assert store.claim_item(second, "0.0_0.0|180") is True
+
+
+def test_gate_retries_a_claim_after_renewing_an_expired_untaken_lease(store, clock):
+    lease = store.lease("w1")
+    gate = _TileGate(store, lease, threading.Event())
+    clock.now += 61  # expired, but no other worker leased the tile
+    assert gate.claim("0.0_0.0|90") is True
+    assert not gate.cancelled()
+    assert gate.claim("0.0_0.0|90") is False  # claimed before: skipped, lease still held
+    assert not gate.cancelled()
+
+
+def test_gate_counts_only_inserted_keys_as_inserted_earlier(store, clock):
+    first = store.lease("w1")
+    store.claim_item(first, "a|0")
+    store.record_item(first, "a|0", 7)
+    store.claim_item(first, "b|0")  # crashed before the insert: no hazard id
+    clock.now += 61
+
+    second = store.lease("w2")
+    gate = _TileGate(store, second, threading.Event())
+    assert gate.is_recorded("a|0") and gate.is_recorded("b|0")
+    assert gate.skipped == {"a|0"}